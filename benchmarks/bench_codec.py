@@ -0,0 +1,74 @@
+"""
+Benchmark of encoding task lists and parsing etas, against the per-request dicts,
+strptime and json.dumps the app used before the codec module.
+
+Usage: python benchmarks/bench_codec.py [tasks]
+"""
+import json
+import os
+import sys
+import time
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+# pylint: disable=wrong-import-position
+import codec
+from codec import TaskEncoder, parse_datetime
+from records import TaskRecord
+
+ETA = "2023-06-20T14:00:00"
+
+
+def encode_with_dicts(records):
+    """Encoding as the app did it, through a dict per task and json.dumps"""
+    response = [record.to_dict() for record in records]
+    for task in response:
+        task["eta"] = task["eta"].isoformat()
+    return json.dumps(response)
+
+
+def best_of(func, repeat=5):
+    """Fastest of several runs of func, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    """Times list encoding on a task list and eta parsing"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    base = datetime(2023, 6, 20, 14, 0, 0)
+    records = [
+        TaskRecord(str(uuid.uuid4()), f"task {i}", base + timedelta(minutes=i), "OPEN")
+        for i in range(count)
+    ]
+
+    print(f"encoding {count} tasks (orjson: {codec.orjson is not None})")
+    encoder = TaskEncoder()
+    for name, func in (
+        ("dicts + json.dumps", lambda: encode_with_dicts(records)),
+        ("TaskEncoder, cold", lambda: TaskEncoder().encode_list(records)),
+        ("TaskEncoder, warm", lambda: encoder.encode_list(records)),
+    ):
+        print(f"{name:>20}: {best_of(func) * 1e3:8.1f} ms")
+
+    iterations = 100000
+    print("parsing an eta")
+    for name, func in (
+        ("strptime", lambda: datetime.strptime(ETA, "%Y-%m-%dT%H:%M:%S")),
+        ("parse_datetime", lambda: parse_datetime(ETA)),
+    ):
+        seconds = min(timeit.repeat(func, number=iterations, repeat=5))
+        print(f"{name:>20}: {seconds / iterations * 1e6:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
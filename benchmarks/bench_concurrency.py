@@ -0,0 +1,218 @@
+"""
+Concurrency benchmark of the threaded Flask server against the ASGI app.
+
+Serves a synthetic store with the werkzeug threaded server and, when uvicorn is
+installed, with uvicorn running asgi:application, each in its own process. An
+asyncio client then keeps a number of requests in flight and reports the
+throughput and p50/p99 latencies of reads, writes and a 90/10 mix of both.
+
+Usage: python benchmarks/bench_concurrency.py [--size 10000]
+           [--concurrency 1,16,64] [--requests 2000] [--backend pickle|columnar|sqlite]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+# pylint: disable=wrong-import-position
+from bench_suite import AUTH, BACKENDS, make_records, percentile, write_store
+import settings
+
+NEW_TASK = json.dumps(
+    {"description": "new task", "eta": "2023-06-20T14:00:00", "status": "OPEN"}
+)
+
+
+def store_settings(store_dir, backend):
+    """Patches the settings to keep the store in store_dir"""
+    return mock.patch.multiple(
+        settings,
+        TASK_DATA_FILE=os.path.join(store_dir, "tasks.pkl"),
+        TASK_JOURNAL_FILE=os.path.join(store_dir, "tasks.journal"),
+        TASK_DATABASE_FILE=os.path.join(store_dir, "tasks.sqlite3"),
+        TASK_LOCK_FILE=os.path.join(store_dir, "tasks.lock"),
+        ARCHIVE_FILE=os.path.join(store_dir, "tasks.archive"),
+        STORAGE_BACKEND=backend,
+        LOG_LEVEL="WARNING",
+    )
+
+
+def serve(server, port, store_dir, backend):
+    """Runs a server on port, in a child process"""
+    # pylint: disable=import-outside-toplevel
+    with store_settings(store_dir, backend):
+        if server == "flask":
+            from werkzeug.serving import make_server
+            from app import app
+
+            # Access logs would cost more than the requests being timed
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+        else:
+            import uvicorn
+
+            uvicorn.run(
+                "asgi:application", host="127.0.0.1", port=port, log_level="warning"
+            )
+
+
+def free_port():
+    """Finds a free local port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30.0):
+    """Waits until a server accepts connections on port"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+async def send_request(port, method, path, body=None):
+    """
+    Sends one request on a new connection and reads the whole response
+    :return: int: status code
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    payload = b"" if body is None else body.encode()
+    head = (
+        f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+        f"Authorization: {AUTH['Authorization']}\r\nConnection: close\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+    )
+    writer.write(head.encode() + payload)
+
+    response_head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+    length = None
+    for line in response_head.split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    # Reading to the end of the stream would also time the server's close
+    if length is None:
+        await reader.read()
+    else:
+        await reader.readexactly(length)
+    writer.close()
+    return int(response_head.split(" ", 2)[1])
+
+
+async def load(port, requests, concurrency, next_request):
+    """
+    Sends requests from concurrency clients
+    :return: tuple: elapsed seconds, sorted latencies in seconds
+    """
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            method, path, body = next_request()
+            start = time.perf_counter()
+            status = await send_request(port, method, path, body)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                raise RuntimeError(f"{method} {path}: {status}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started, sorted(latencies)
+
+
+def scenarios(task_ids):
+    """Request generators by scenario name"""
+
+    def read():
+        return "GET", f"/task/{random.choice(task_ids)}", None
+
+    def write():
+        return "POST", "/task", NEW_TASK
+
+    def mixed():
+        return write() if random.random() < 0.1 else read()
+
+    return {
+        "read": read,
+        "list": lambda: ("GET", "/tasks?limit=100", None),
+        "write": write,
+        "mixed": mixed,
+    }
+
+
+def benchmark_server(server, args, store_dir, task_ids):
+    """Runs every scenario against one server"""
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve, args=(server, port, store_dir, args.backend), daemon=True
+    )
+    process.start()
+    try:
+        wait_for(port)
+        for name, next_request in scenarios(task_ids).items():
+            for concurrency in (int(x) for x in args.concurrency.split(",")):
+                elapsed, latencies = asyncio.run(
+                    load(port, args.requests, concurrency, next_request)
+                )
+                print(
+                    f"{server:<8} {name:<8} {concurrency:>11} "
+                    f"{len(latencies) / elapsed:>10.0f} "
+                    f"{percentile(latencies, 50) * 1e3:>10.2f} "
+                    f"{percentile(latencies, 99) * 1e3:>10.2f}"
+                )
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    """Runs the benchmark against each server and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--concurrency", default="1,16,64")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--backend", default="pickle", choices=BACKENDS)
+    args = parser.parse_args()
+
+    servers = ["flask"]
+    try:
+        import uvicorn  # pylint: disable=import-outside-toplevel,unused-import
+
+        servers.append("asgi")
+    except ImportError:
+        print("uvicorn is not installed, only the Flask server is benchmarked")
+
+    print(
+        f"{'server':<8} {'scenario':<8} {'concurrency':>11} {'req/s':>10} "
+        f"{'p50 ms':>10} {'p99 ms':>10}"
+    )
+    for server in servers:
+        # Each server starts from the same store
+        with tempfile.TemporaryDirectory() as store_dir:
+            records = make_records(args.size)
+            with store_settings(store_dir, args.backend):
+                write_store(records, args.backend)
+            benchmark_server(server, args, store_dir, list(records))
+
+
+if __name__ == "__main__":
+    main()
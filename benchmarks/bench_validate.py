@@ -0,0 +1,55 @@
+"""
+Microbenchmark of validate_task against building a Schema on every call.
+
+Usage: python benchmarks/bench_validate.py [iterations]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+# pylint: disable=wrong-import-position
+from schema import Schema, Optional, Use
+from tasks import Status, validate_task
+
+VALID_TASK = {
+    "description": "Clean House",
+    "eta": datetime(2023, 6, 20, 14, 0, 0),
+    "status": "OPEN",
+    "_id": "1c5b2a84-3d6f-4f59-9d4c-1f8f5b8f2e11",
+}
+
+
+def validate_task_per_call_schema(task):
+    """validate_task as it was, building the schema on every call"""
+    schema = Schema(
+        {"description": str, "eta": datetime, "status": str, Optional("_id"): Use(str)}
+    )
+    schema.validate(task)
+    Status(task["status"])
+
+    return task
+
+
+def main():
+    """Times both validators on a valid task"""
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for name, validator in (
+        ("per-call Schema", validate_task_per_call_schema),
+        ("validate_task", validate_task),
+    ):
+        seconds = min(
+            timeit.repeat(
+                lambda v=validator: v(VALID_TASK), number=iterations, repeat=5
+            )
+        )
+        print(f"{name:>16}: {seconds / iterations * 1e6:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,39 @@
 """Flask app for task_master"""
-import json
-import logging
+import atexit
+import time
 from datetime import datetime
 from functools import wraps
 
 from flask import Flask, request, make_response, Response
 from flask_basicauth import BasicAuth
-from tasks import Tasks, InvalidTaskError, SchemaMissingKeyError
+from codec import TaskEncoder, dumps
+from logs import configure_logging, log_body
+import metrics
+from response_cache import ResponseCache
+from scheduler import DueScheduler
+from tasks import Tasks, ResyncRequiredError
+import settings
+from web import (
+    cache_key,
+    cached,
+    change_event,
+    changes_since,
+    changes_wait,
+    datetime_arg,
+    due_tasks_version,
+    error_response,
+    etag_matches,
+    include_archived_arg,
+    is_paginated,
+    json_list,
+    parse_batch_etas,
+    parse_eta,
+    parse_if_match,
+    read_pages,
+    resync_event,
+    task_records,
+    wants_event_stream,
+)
 
 app = Flask(__name__)
 
@@ -15,69 +42,287 @@ app.config["BASIC_AUTH_PASSWORD"] = "MasterOfTasks"
 
 basic_auth = BasicAuth(app)
 
+# Configure logging
+configure_logging()
+
 tasks = Tasks()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+response_cache = ResponseCache(settings.RESPONSE_CACHE_BYTES)
+tasks.add_change_listener(response_cache.clear)
+
+task_encoder = TaskEncoder()
+tasks.add_change_listener(task_encoder.forget)
+
+scheduler = DueScheduler(tasks)
+# Runs before tasks.close, registered earlier
+atexit.register(scheduler.close)
+tasks.add_change_listener(scheduler.changed)
+for webhook in settings.DUE_WEBHOOKS:
+    scheduler.add_webhook(webhook)
+
+REQUESTS = metrics.REGISTRY.register(
+    metrics.Counter(
+        "task_master_requests_total",
+        "Requests handled, by route, method and status",
+        ("route", "method", "status"),
+    )
+)
+REQUEST_ERRORS = metrics.REGISTRY.register(
+    metrics.Counter(
+        "task_master_request_errors_total",
+        "Requests answered with a 4xx or 5xx status, by route and status",
+        ("route", "status"),
+    )
+)
+REQUEST_SECONDS = metrics.REGISTRY.register(
+    metrics.Histogram(
+        "task_master_request_duration_seconds",
+        "Time to build responses, for the sampled requests",
+        ("route", "method"),
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "task_master_tasks",
+        "Tasks in the store, by status",
+        ("status",),
+        lambda: {(k,): v for k, v in tasks.count_tasks_by_status().items()},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "task_master_scheduled_tasks",
+        "OPEN tasks waiting for their eta to be sent to the due task targets",
+        (),
+        lambda: {(): scheduler.scheduled_count()},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.CallbackCounter(
+        "task_master_response_cache_hits_total",
+        "Encoded responses served from the response cache",
+        (),
+        lambda: {(): response_cache.stats()["hits"]},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.CallbackCounter(
+        "task_master_response_cache_misses_total",
+        "Encoded responses looked up in the response cache and not found",
+        (),
+        lambda: {(): response_cache.stats()["misses"]},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "task_master_response_cache_entries",
+        "Responses held in the response cache",
+        (),
+        lambda: {(): response_cache.stats()["entries"]},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "task_master_response_cache_bytes",
+        "Bytes of the response bodies held in the response cache",
+        (),
+        lambda: {(): response_cache.stats()["bytes"]},
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "task_master_archived_tasks",
+        "Tasks moved to the archive",
+        (),
+        lambda: {(): tasks.count_archived_tasks()},
+    )
+)
 
 
 def format_response(func):
-    """Decorator to format response to json"""
+    """Decorator to format response to json and record request metrics"""
 
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        # Invoke the original route function
-        try:
-            response = func(*args, **kwargs)
-        except (InvalidTaskError, SchemaMissingKeyError) as invalid_data:
-            logging.info(invalid_data)
-            return Response(str(invalid_data), status=400)
-        except Exception as server_error:  # pylint: disable=broad-exception-caught
-            logging.error(server_error)
-            return Response("Internal Server Error", status=500)
+        started = metrics.start_timer()
+        response = build_response(func, *args, **kwargs)
 
-        # Convert the response to JSON
-        json_response = json.dumps(response)
+        route = request.url_rule.rule
+        REQUESTS.inc(route, request.method, response.status_code)
+        if response.status_code >= 400:
+            REQUEST_ERRORS.inc(route, response.status_code)
+        REQUEST_SECONDS.observe_since(started, route, request.method)
 
-        # Create a Flask response with JSON content type
-        flask_response = make_response(json_response)
-        flask_response.headers["Content-Type"] = "application/json"
+        return response
 
-        logging.debug("Response = %s", json_response)
+    return decorated_function
 
-        return flask_response
 
-    return decorated_function
+def build_response(func, *args, **kwargs):
+    """Runs a route and formats what it returns, or the error it raises, as JSON"""
+    # Invoke the original route function
+    try:
+        response = func(*args, **kwargs)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        status, body, mimetype = error_response(error)
+        return Response(body, status=status, mimetype=mimetype)
+
+    # Streamed responses are already complete
+    if isinstance(response, Response):
+        return response
+
+    headers = {}
+    if isinstance(response, tuple):
+        response, headers = response
+
+    # Convert the response to JSON, unless the route already encoded it
+    json_response = response if isinstance(response, bytes) else dumps(response)
+
+    # Create a Flask response with JSON content type
+    flask_response = make_response(json_response)
+    flask_response.headers["Content-Type"] = "application/json"
+    flask_response.headers.update(headers)
+
+    log_body("Response", json_response)
+
+    return flask_response
+
+
+def conditional(get_version, cache=None):
+    """
+    Decorator tagging responses with an ETag built by get_version from the route
+    arguments, and answering requests whose If-None-Match holds it with a 304
+    without running the route.
+    With a cache, encoded responses are kept there by path, query and ETag, and
+    served from it while the ETag holds.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            etag = get_version(*args, **kwargs)
+            if etag_matches(request.headers.get("If-None-Match"), etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            if cache is None:
+                response = func(*args, **kwargs)
+            else:
+                response = cached_response(cache, etag, func, *args, **kwargs)
+
+            if isinstance(response, Response):
+                response.set_etag(etag)
+                return response
+
+            headers = {}
+            if isinstance(response, tuple):
+                response, headers = response
+
+            return response, dict(headers, ETag=f'"{etag}"')
+
+        return decorated_function
+
+    return decorator
+
+
+def cached_response(cache, etag, func, *args, **kwargs):
+    """
+    Gets the encoded response for the request from the cache, running the route
+    and caching what it returns on a miss. Streamed responses are not cached.
+    """
+
+    def build():
+        response = func(*args, **kwargs)
+        if isinstance(response, Response):
+            return response, {}
+
+        headers = {}
+        if isinstance(response, tuple):
+            response, headers = response
+
+        return response if isinstance(response, bytes) else dumps(response), headers
+
+    key = cache_key(request.path, request.args.items(multi=True), etag)
+    body, headers = cached(cache, key, build)
+    if isinstance(body, Response):
+        return body
+
+    return Response(body, headers=headers, mimetype="application/json")
 
 
 @app.route("/tasks")
 @basic_auth.required
 @format_response
+@conditional(tasks.get_version, response_cache)
 def tasks_get():
     """Route /tasks"""
-    response = tasks.get_tasks()
-    for task in response:
-        convert_datetime_to_iso(task)
+    records = task_records(tasks, request.args)
+    if records is None:
+        return paginate(
+            get_datetime_arg("duedate"),
+            get_datetime_arg("from"),
+            request.args.get("status"),
+        )
 
-    return response
+    return task_encoder.encode_list(records)
 
 
 @app.route("/tasks/due")
 @basic_auth.required
 @format_response
+@conditional(lambda: due_tasks_version(tasks, request.args), response_cache)
 def get_tasks_due():
     """Route /tasks/due"""
+    include_archived = include_archived_arg(request.args)
+
+    if is_paginated(request.args):
+        return paginate(
+            get_datetime_arg("duedate") or datetime.now(),
+            get_datetime_arg("from"),
+            request.args.get("status"),
+        )
 
-    due_date = None
+    records = tasks.get_due_task_records(
+        get_datetime_arg("duedate"),
+        get_datetime_arg("from"),
+        request.args.get("status"),
+        include_archived,
+    )
 
-    if "duedate" in request.args:
-        due_date = datetime.strptime(request.args.get("duedate"), "%Y-%m-%dT%H:%M:%S")
+    return task_encoder.encode_list(records)
 
-    response = tasks.get_due_tasks(due_date)
-    for task in response:
-        convert_datetime_to_iso(task)
 
-    return response
+@app.route("/tasks/search")
+@basic_auth.required
+@format_response
+@conditional(tasks.get_version, response_cache)
+def search_tasks():
+    """Route /tasks/search"""
+    records = tasks.search_task_records(
+        request.args.get("q", ""),
+        get_datetime_arg("duedate"),
+        get_datetime_arg("from"),
+        request.args.get("status"),
+    )
+
+    return task_encoder.encode_list(records)
+
+
+@app.route("/tasks/changes")
+@basic_auth.required
+@format_response
+def tasks_changes():
+    """Route /tasks/changes"""
+    since = changes_since(request.args, request.headers)
+
+    if wants_event_stream(request.headers):
+        return Response(stream_changes(since), mimetype="text/event-stream")
+
+    changes, next_version = tasks.get_changes(
+        since, changes_wait(request.args.get("wait"))
+    )
+    return {"changes": changes, "next": next_version}
 
 
 @app.route("/task", methods=["POST"])
@@ -87,36 +332,60 @@ def tasks_post():
     """Route for POST /task"""
     task = request.get_json()
 
-    logging.debug("Request body for POST task = %s", task)
+    log_body("Request body for POST task", task)
+
+    parse_eta(task)
+
+    return tasks.post_task(task)
+
+
+@app.route("/tasks/batch", methods=["POST"])
+@basic_auth.required
+@format_response
+def tasks_post_batch():
+    """Route for POST /tasks/batch"""
+    new_tasks = json_list(request.get_json())
+
+    log_body("Request body for POST tasks batch", new_tasks)
 
-    task["eta"] = datetime.strptime(task["eta"], "%Y-%m-%dT%H:%M:%S")
+    parse_batch_etas(new_tasks)
 
-    saved_task = tasks.post_task(task)
+    return tasks.post_tasks(new_tasks)
 
-    convert_datetime_to_iso(saved_task)
 
-    return saved_task
+@app.route("/tasks/complete", methods=["PATCH"])
+@basic_auth.required
+@format_response
+def complete_tasks():
+    """Route for completing many tasks"""
+    return tasks.complete_tasks(json_list(request.get_json(), str))
+
+
+@app.route("/tasks", methods=["DELETE"])
+@basic_auth.required
+@format_response
+def delete_tasks():
+    """Route for deleting many tasks"""
+    return tasks.delete_tasks(json_list(request.get_json(), str))
 
 
 @app.route("/task/<task_id>")
 @basic_auth.required
 @format_response
+@conditional(tasks.get_task_version)
 def get_task(task_id):
     """Route for GET /task>"""
-    response = tasks.get_tasks(task_id)
-
-    convert_datetime_to_iso(response[0])
-
-    return response
+    return task_encoder.encode_list(tasks.get_task_records(task_id))
 
 
 @app.route("/task/<task_id>", methods=["DELETE"])
 @basic_auth.required
+@format_response
 def delete_task(task_id):
     """Route for DELETE task"""
     tasks.delete_task(task_id)
 
-    return "", 204
+    return Response(status=204)
 
 
 @app.route("/task/<task_id>", methods=["PUT"])
@@ -127,14 +396,13 @@ def put_task(task_id):
 
     task = request.get_json()
 
-    logging.debug("Request body for PUT task = %s", task)
+    log_body("Request body for PUT task", task)
 
-    task["eta"] = datetime.strptime(task["eta"], "%Y-%m-%dT%H:%M:%S")
+    parse_eta(task)
 
-    updated_task = tasks.put_task(task_id, task)
-    convert_datetime_to_iso(updated_task)
-
-    return updated_task
+    return tasks.put_task(
+        task_id, task, parse_if_match(request.headers.get("If-Match"))
+    )
 
 
 @app.route("/task/<task_id>/complete", methods=["PATCH"])
@@ -143,15 +411,63 @@ def put_task(task_id):
 def complete_task(task_id):
     """Route for complete task"""
 
-    task = tasks.complete_task(task_id)
-    convert_datetime_to_iso(task)
-
-    return task
+    return tasks.complete_task(task_id)
 
 
-def convert_datetime_to_iso(response):
-    """datetime to ISO string conversion"""
-    response["eta"] = response["eta"].isoformat()
+@app.route("/metrics")
+@basic_auth.required
+def get_metrics():
+    """Route for metrics in the Prometheus text format"""
+    return Response(
+        metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def stream_changes(since):
+    """
+    Streams changes as server-sent events: one per batch of changes with the version
+    to resume from as its id, comments while nothing changes, and a resync event if
+    the client falls behind. Ends after settings.CHANGES_STREAM_SECONDS.
+    """
+    # The first changes are read eagerly so unknown versions still fail with a 410
+    changes, since = tasks.get_changes(since)
+    deadline = time.monotonic() + settings.CHANGES_STREAM_SECONDS
+
+    def events(changes, since):
+        while True:
+            yield change_event(changes, since)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                changes, since = tasks.get_changes(
+                    since, min(remaining, settings.CHANGES_MAX_WAIT)
+                )
+            except ResyncRequiredError as resync:
+                yield resync_event(resync)
+                return
+
+    return events(changes, since)
+
+
+def paginate(due_date, from_date, status):
+    """
+    Builds a page of tasks ordered by eta, with the cursor of the next page in the
+    X-Next-Cursor header, or streams every task from the cursor on with stream=true.
+    """
+    body, cursor = read_pages(
+        tasks, task_encoder, request.args, (due_date, from_date, status)
+    )
+    if not isinstance(body, bytes):
+        return Response(body, mimetype="application/json")
+
+    return body, {} if cursor is None else {"X-Next-Cursor": cursor}
+
+
+def get_datetime_arg(name):
+    """Parses an optional datetime query argument"""
+    return datetime_arg(request.args, name)
 
 
 if __name__ == "__main__":
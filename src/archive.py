@@ -0,0 +1,277 @@
+"""
+Compressed, append-only archive of finished tasks
+"""
+import logging
+import os
+import pickle
+import threading
+import zlib
+from bisect import bisect_right
+
+from journal import RECORD_HEADER
+from records import TaskRecord
+
+# Most tasks per archive record, so reading a task decompresses at most this many
+BATCH_SIZE = 1000
+
+
+class Archive:  # pylint: disable=too-many-instance-attributes
+    """
+    Append-only file of tasks moved out of the store, which are rarely read.
+
+    Tasks are appended in records of at most BATCH_SIZE tasks, each a zlib-compressed
+    pickled list of ``(task_id, fields)`` entries, framed like journal records.
+    Discarding a task appends an entry with None fields. Only the offset of the latest
+    record of each task is kept in memory, with its eta: reading a task decompresses
+    its record, and the last record read is kept for reads of the tasks next to it.
+    Records appended by other processes are picked up before each read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets = {}
+        self._etas = {}
+        # Etas of the archived tasks in order, None until due_version needs them
+        self._sorted_etas = None
+        # Offset following the last record indexed
+        self._size = 0
+        self._last_read = (None, {})
+        self._file = None
+
+    def __len__(self):
+        with self._lock:
+            self._catch_up()
+            return len(self._offsets)
+
+    def __contains__(self, task_id):
+        with self._lock:
+            self._catch_up()
+            return task_id in self._offsets
+
+    def load(self):
+        """
+        Indexes every intact record of the archive, truncating a torn tail
+        :return: None
+        """
+        with self._lock:
+            self._close_file()
+            self._clear()
+            self._catch_up()
+
+            if self._size < self._file_size():
+                logging.warning(
+                    "discarding torn or corrupt archive tail of %s after offset %d",
+                    self.path,
+                    self._size,
+                )
+                with open(self.path, "r+b") as file:
+                    file.truncate(self._size)
+
+    def get(self, task_id):
+        """
+        Gets an archived task by id
+        :param task_id: id of the task
+        :return: TaskRecord or None if the task is not archived
+        """
+        with self._lock:
+            self._catch_up()
+            offset = self._offsets.get(task_id)
+            if offset is None:
+                return None
+
+            if self._last_read[0] != offset:
+                with open(self.path, "rb") as file:
+                    _, _, entries = next(self._read_records(file, offset))
+                self._last_read = offset, dict(to_records(entries))
+            return self._last_read[1][task_id]
+
+    def all(self, status=None):
+        """
+        Gets every archived task, in the order they were archived
+        :param status: str: only return tasks with this status
+        :return: list: TaskRecord
+        """
+        with self._lock:
+            self._catch_up()
+            offsets = dict(self._offsets)
+            size = self._size
+
+        records = []
+        try:
+            with open(self.path, "rb") as file:
+                for offset, end, entries in self._read_records(file, 0):
+                    if end > size:
+                        break
+                    records.extend(
+                        record
+                        for task_id, record in to_records(entries)
+                        if offsets.get(task_id) == offset
+                        and status in (None, record.status)
+                    )
+        except FileNotFoundError:
+            pass
+
+        return records
+
+    def due_version(self, due_date):
+        """
+        Gets a version of the archived tasks due by a date, which changes whenever
+        the archive does or a later date makes more archived tasks due, without
+        reading the archive
+        :param due_date: Datetime.datetime: latest eta of the due tasks
+        :return: str: version
+        """
+        with self._lock:
+            self._catch_up()
+            if self._sorted_etas is None:
+                self._sorted_etas = sorted(self._etas.values())
+            return f"{self._size}.{bisect_right(self._sorted_etas, due_date)}"
+
+    def append(self, records):
+        """
+        Archives tasks, replacing archived tasks with the same ids. The records are
+        synced to disk before returning, so the tasks can then be deleted from the store.
+        :param records: list: TaskRecord
+        :return: None
+        """
+        self._write([(record.task_id, tuple(record)[1:]) for record in records])
+
+    def discard(self, task_ids):
+        """
+        Drops tasks from the archive, ignoring ids with no archived task
+        :param task_ids: list: ids of the tasks to drop
+        :return: list: ids of the tasks that were archived
+        """
+        with self._lock:
+            self._catch_up()
+            archived = [x for x in dict.fromkeys(task_ids) if x in self._offsets]
+
+        self._write([(task_id, None) for task_id in archived])
+        return archived
+
+    def close(self):
+        """
+        Closes the append handle, if open.
+        :return: None
+        """
+        with self._lock:
+            self._close_file()
+
+    def _write(self, entries):
+        """
+        Appends entries in records of at most BATCH_SIZE entries and syncs them
+        :param entries: list: ``(task_id, fields)`` tuples, fields None to discard
+        :return: None
+        """
+        if not entries:
+            return
+
+        with self._lock:
+            self._catch_up()
+            if self._file is None:
+                self._file = open(  # pylint: disable=consider-using-with
+                    self.path, "ab"
+                )
+
+            for start in range(0, len(entries), BATCH_SIZE):
+                batch = entries[start : start + BATCH_SIZE]
+                payload = zlib.compress(
+                    pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+                )
+                # One write per record, so appends of other processes cannot split it
+                self._file.write(
+                    RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+                )
+                self._index(self._size, batch)
+                self._size += RECORD_HEADER.size + len(payload)
+
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _catch_up(self):
+        """Indexes the records appended since the last one indexed, hold the lock"""
+        size = self._file_size()
+        if size == self._size:
+            return
+        if size < self._size:
+            # The archive was replaced, index it afresh
+            self._clear()
+
+        try:
+            with open(self.path, "rb") as file:
+                for offset, end, entries in self._read_records(file, self._size):
+                    self._index(offset, entries)
+                    self._size = end
+        except FileNotFoundError:
+            pass
+
+    def _clear(self):
+        """Forgets every indexed record, hold the lock"""
+        self._offsets = {}
+        self._etas = {}
+        self._sorted_etas = None
+        self._size = 0
+        self._last_read = (None, {})
+
+    def _index(self, offset, entries):
+        """Points the ids of a record's entries at it, hold the lock"""
+        for task_id, fields in entries:
+            if fields is None:
+                self._offsets.pop(task_id, None)
+                self._etas.pop(task_id, None)
+            else:
+                self._offsets[task_id] = offset
+                self._etas[task_id] = TaskRecord(task_id, *fields).eta
+        self._sorted_etas = None
+
+    def _file_size(self):
+        """Size of the archive file, 0 if there is none"""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _close_file(self):
+        """Closes the append handle, hold the lock"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _read_records(file, offset):
+        """
+        Reads the intact records from a record boundary, stopping at the end of the
+        archive or at the first torn or corrupt record.
+        :param file: archive opened for reading
+        :param offset: int: file offset to read from
+        :return: generator of (offset, offset following the record, entries)
+        """
+        file.seek(offset)
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            try:
+                entries = pickle.loads(zlib.decompress(payload))
+            except (pickle.UnpicklingError, zlib.error, EOFError, ValueError):
+                return
+
+            end = offset + RECORD_HEADER.size + length
+            yield offset, end, entries
+            offset = end
+
+
+def to_records(entries):
+    """
+    Builds the records of archive entries, skipping discarded tasks
+    :param entries: list: ``(task_id, fields)`` tuples
+    :return: generator of (task_id, TaskRecord)
+    """
+    for task_id, fields in entries:
+        if fields is not None:
+            yield task_id, TaskRecord(task_id, *fields)
@@ -0,0 +1,606 @@
+"""
+asyncio ASGI app for task_master, serving the routes of app.py.
+
+Run it with any ASGI server, e.g. ``uvicorn asgi:application --app-dir src``.
+
+The event loop only parses requests and writes responses. Routes that read tasks
+run in the loop's default thread pool, and routes that change tasks run one at a
+time on a persistence thread, so pickling and fsync never block the loop. The
+persistence thread only applies and queues changes: waiting for their group commit
+happens in the thread pool, so the changes of concurrent requests share an fsync.
+Long polls and event streams of changes wait on the event loop, woken by a change
+listener, so that idle clients hold no thread. It
+shares the Tasks instance, caches and metrics of app.py.
+"""
+import asyncio
+import base64
+import binascii
+import hmac
+import json
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl, unquote
+
+from codec import dumps
+from logs import log_body
+import metrics
+from persistence import deferred_waits
+import settings
+from tasks import CHANGES_REFRESH_INTERVAL, ResyncRequiredError
+from web import (
+    InvalidQueryError,
+    cache_key,
+    cached,
+    change_event,
+    changes_since,
+    changes_wait,
+    datetime_arg,
+    due_tasks_version,
+    error_response,
+    etag_matches,
+    include_archived_arg,
+    is_paginated,
+    json_list,
+    parse_batch_etas,
+    parse_eta,
+    parse_if_match,
+    read_pages,
+    resync_event,
+    task_records,
+    wants_event_stream,
+)
+from app import (
+    REQUEST_ERRORS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    app as flask_app,
+    response_cache,
+    scheduler,
+    task_encoder,
+    tasks,
+)
+
+# Changes run in order on a single thread, off the event loop
+persistence_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="persistence"
+)
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+
+# (event loop, asyncio.Event) of each request waiting for changes
+change_waiters = set()
+change_waiters_lock = threading.Lock()
+
+
+class Headers(dict):
+    """Request headers by lowercase name, looked up regardless of case."""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
+# pylint: disable=too-few-public-methods
+class Request:
+    """The parts of an HTTP request the routes use."""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qsl(scope["query_string"].decode("latin-1"))
+        # The first value of a repeated argument wins, as in Flask's request.args
+        self.args = dict(reversed(self.query))
+        self.headers = Headers(
+            (name.decode("latin-1").lower(), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        )
+        self.body = body
+
+    def get_json(self):
+        """Parses the request body as JSON"""
+        try:
+            return json.loads(self.body)
+        except ValueError as invalid_json:
+            raise InvalidQueryError(f"invalid JSON body: {invalid_json}") from None
+
+    def datetime_arg(self, name):
+        """Parses an optional datetime query argument"""
+        return datetime_arg(self.args, name)
+
+    def json_list(self, item_type=None):
+        """Gets the request body, which must be a JSON list of item_type if given"""
+        return json_list(self.get_json(), item_type)
+
+
+class Reply:
+    """An HTTP response: body bytes, or an iterator of chunks to stream."""
+
+    def __init__(self, status=200, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = list(headers or [])
+
+
+def json_reply(value, headers=()):
+    """Reply with a JSON body, value may already be encoded"""
+    body = value if isinstance(value, bytes) else dumps(value)
+    log_body("Response", body)
+    return Reply(200, body, JSON_HEADERS + list(headers))
+
+
+def is_authorized(request):
+    """Checks the Basic credentials against those of the Flask app"""
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "basic":
+        return False
+
+    try:
+        username, _, password = (
+            base64.b64decode(credentials).decode("latin-1").partition(":")
+        )
+    except (binascii.Error, ValueError):
+        return False
+
+    return hmac.compare_digest(
+        username, flask_app.config["BASIC_AUTH_USERNAME"]
+    ) and hmac.compare_digest(password, flask_app.config["BASIC_AUTH_PASSWORD"])
+
+
+def conditional(request, etag, build):
+    """
+    Answers with a 304 if the client has etag, or else with the response build
+    returns, through the response cache, tagged with etag
+    """
+    etag_header = [(b"etag", f'"{etag}"'.encode())]
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Reply(304, headers=etag_header)
+
+    def build_entry():
+        reply = build()
+        return reply.body, reply.headers
+
+    key = cache_key(request.path, request.query, etag)
+    body, headers = cached(response_cache, key, build_entry)
+    return Reply(200, body, headers + etag_header)
+
+
+def paginate(request, due_date, from_date, status):
+    """A page of tasks or a stream of every task, as paginate in app.py"""
+    body, cursor = read_pages(
+        tasks, task_encoder, request.args, (due_date, from_date, status)
+    )
+    if not isinstance(body, bytes):
+        return Reply(200, body, JSON_HEADERS)
+
+    headers = [] if cursor is None else [(b"x-next-cursor", cursor.encode())]
+    return json_reply(body, headers)
+
+
+def get_tasks(request):
+    """Route GET /tasks"""
+
+    def build():
+        records = task_records(tasks, request.args)
+        if records is None:
+            return paginate(
+                request,
+                request.datetime_arg("duedate"),
+                request.datetime_arg("from"),
+                request.args.get("status"),
+            )
+        return json_reply(task_encoder.encode_list(records))
+
+    return conditional(request, tasks.get_version(), build)
+
+
+def get_tasks_due(request):
+    """Route GET /tasks/due"""
+    status = request.args.get("status")
+    from_date = request.datetime_arg("from")
+    include_archived = include_archived_arg(request.args)
+
+    def build():
+        if is_paginated(request.args):
+            return paginate(
+                request,
+                request.datetime_arg("duedate") or datetime.now(),
+                from_date,
+                status,
+            )
+
+        records = tasks.get_due_task_records(
+            request.datetime_arg("duedate"), from_date, status, include_archived
+        )
+        return json_reply(task_encoder.encode_list(records))
+
+    return conditional(request, due_tasks_version(tasks, request.args), build)
+
+
+def search_tasks(request):
+    """Route GET /tasks/search"""
+
+    def build():
+        records = tasks.search_task_records(
+            request.args.get("q", ""),
+            request.datetime_arg("duedate"),
+            request.datetime_arg("from"),
+            request.args.get("status"),
+        )
+        return json_reply(task_encoder.encode_list(records))
+
+    return conditional(request, tasks.get_version(), build)
+
+
+async def get_changes(request):
+    """Route GET /tasks/changes"""
+    since = changes_since(request.args, request.headers)
+
+    if wants_event_stream(request.headers):
+        # The first changes are read eagerly so unknown versions still fail with a 410
+        changes, since = await wait_for_changes(since, 0)
+        return Reply(
+            200,
+            stream_changes(changes, since),
+            [(b"content-type", b"text/event-stream")],
+        )
+
+    changes, next_version = await wait_for_changes(
+        since, changes_wait(request.args.get("wait"))
+    )
+    return json_reply({"changes": changes, "next": next_version})
+
+
+async def stream_changes(changes, since):
+    """
+    Streams changes as server-sent events, as app.stream_changes does, waiting for
+    them on the event loop
+    :param changes: list: first changes, from wait_for_changes
+    :param since: str: version to resume from after them
+    :return: async generator of events
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.CHANGES_STREAM_SECONDS
+    while True:
+        yield change_event(changes, since)
+
+        if loop.time() >= deadline:
+            return
+        try:
+            changes, since = await wait_for_changes(
+                since, min(deadline - loop.time(), settings.CHANGES_MAX_WAIT)
+            )
+        except ResyncRequiredError as resync:
+            yield resync_event(resync)
+            return
+
+
+async def wait_for_changes(since, timeout):
+    """
+    Tasks.get_changes waiting on the event loop: it checks for changes in the thread
+    pool, and waits for a change listener to wake it, or to check again for other
+    processes' changes after CHANGES_REFRESH_INTERVAL.
+    :param since: str: version as Tasks.get_version returns it
+    :param timeout: float: seconds to wait for a change if there is none yet
+    :return: tuple: list of changes, version to ask from next
+    :raises ResyncRequiredError: as Tasks.get_changes
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    changed = asyncio.Event()
+    waiter = (loop, changed)
+    with change_waiters_lock:
+        change_waiters.add(waiter)
+    try:
+        while True:
+            changed.clear()
+            changes, next_version = await loop.run_in_executor(
+                None, tasks.get_changes, since
+            )
+            remaining = deadline - loop.time()
+            if changes or remaining <= 0:
+                return changes, next_version
+            try:
+                await asyncio.wait_for(
+                    changed.wait(), min(remaining, CHANGES_REFRESH_INTERVAL)
+                )
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with change_waiters_lock:
+            change_waiters.discard(waiter)
+
+
+def wake_change_waiters(_):
+    """Change listener waking the requests waiting for changes"""
+    with change_waiters_lock:
+        waiters = list(change_waiters)
+
+    for loop, changed in waiters:
+        try:
+            loop.call_soon_threadsafe(changed.set)
+        except RuntimeError:
+            pass  # The loop is closed, its waiter is on its way out
+
+
+tasks.add_change_listener(wake_change_waiters)
+
+
+def get_task(request, task_id):
+    """Route GET /task/<task_id>"""
+    return conditional(
+        request,
+        tasks.get_task_version(task_id),
+        lambda: json_reply(task_encoder.encode_list(tasks.get_task_records(task_id))),
+    )
+
+
+def post_task(request):
+    """Route POST /task"""
+    task = request.get_json()
+    log_body("Request body for POST task", task)
+    parse_eta(task)
+
+    return json_reply(tasks.post_task(task))
+
+
+def post_tasks(request):
+    """Route POST /tasks/batch"""
+    new_tasks = request.json_list()
+    log_body("Request body for POST tasks batch", new_tasks)
+
+    parse_batch_etas(new_tasks)
+
+    return json_reply(tasks.post_tasks(new_tasks))
+
+
+def complete_tasks(request):
+    """Route PATCH /tasks/complete"""
+    return json_reply(tasks.complete_tasks(request.json_list(str)))
+
+
+def delete_tasks(request):
+    """Route DELETE /tasks"""
+    return json_reply(tasks.delete_tasks(request.json_list(str)))
+
+
+def delete_task(_, task_id):
+    """Route DELETE /task/<task_id>"""
+    tasks.delete_task(task_id)
+
+    return Reply(204)
+
+
+def put_task(request, task_id):
+    """Route PUT /task/<task_id>"""
+    task = request.get_json()
+    log_body("Request body for PUT task", task)
+    parse_eta(task)
+
+    if_match = parse_if_match(request.headers.get("if-match"))
+
+    return json_reply(tasks.put_task(task_id, task, if_match))
+
+
+def complete_task(_, task_id):
+    """Route PATCH /task/<task_id>/complete"""
+    return json_reply(tasks.complete_task(task_id))
+
+
+def get_metrics(_):
+    """Route GET /metrics"""
+    return Reply(
+        200,
+        metrics.REGISTRY.render().encode(),
+        [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")],
+    )
+
+
+# (method, route as in app.py, handler, whether it changes tasks)
+ROUTES = [
+    ("GET", "/tasks", get_tasks, False),
+    ("GET", "/tasks/due", get_tasks_due, False),
+    ("GET", "/tasks/search", search_tasks, False),
+    ("GET", "/tasks/changes", get_changes, False),
+    ("POST", "/task", post_task, True),
+    ("POST", "/tasks/batch", post_tasks, True),
+    ("PATCH", "/tasks/complete", complete_tasks, True),
+    ("DELETE", "/tasks", delete_tasks, True),
+    ("GET", "/task/<task_id>", get_task, False),
+    ("DELETE", "/task/<task_id>", delete_task, True),
+    ("PUT", "/task/<task_id>", put_task, True),
+    ("PATCH", "/task/<task_id>/complete", complete_task, True),
+    ("GET", "/metrics", get_metrics, False),
+]
+
+_ROUTE_PATTERNS = [
+    (
+        method,
+        re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", route) + "$"),
+        route,
+        handler,
+        changes,
+    )
+    for method, route, handler, changes in ROUTES
+]
+
+
+def match_route(method, path):
+    """
+    Finds the route of a request
+    :return: tuple: route, handler, whether it changes tasks and path arguments,
+        or None if no route matches the path
+    :raises InvalidQueryError: if routes match the path, but not the method
+    """
+    path_matches = False
+    for route_method, pattern, route, handler, changes in _ROUTE_PATTERNS:
+        found = pattern.match(path)
+        if found is None:
+            continue
+        path_matches = True
+        if route_method == method:
+            arguments = {name: unquote(x) for name, x in found.groupdict().items()}
+            return route, handler, changes, arguments
+
+    return "method not allowed" if path_matches else None
+
+
+def handle(request, handler, arguments):
+    """Runs a route, turning errors into responses as format_response does"""
+    try:
+        return handler(request, **arguments)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return error_reply(error)
+
+
+async def handle_async(request, handler, arguments):
+    """handle for routes that are coroutines, run on the event loop"""
+    try:
+        return await handler(request, **arguments)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return error_reply(error)
+
+
+def error_reply(error):
+    """
+    Turns an error raised by a route into a response, as format_response does
+    :param error: Exception: error of the route
+    :return: Reply
+    """
+    status, body, mimetype = error_response(error)
+    headers = [] if mimetype is None else [(b"content-type", mimetype.encode())]
+    return Reply(status, body, headers)
+
+
+def handle_change(request, handler, arguments):
+    """
+    Runs a route that changes tasks, leaving the wait for its group commit
+    :return: tuple: Reply, list of ``(writer, ticket)`` pairs to pass to commit
+    """
+    with deferred_waits() as waits:
+        reply = handle(request, handler, arguments)
+    return reply, waits
+
+
+def commit(reply, waits):
+    """
+    Waits for the group commit of a route's changes
+    :param reply: Reply: reply of the route
+    :param waits: list: ``(writer, ticket)`` pairs from handle_change
+    :return: Reply: the route's reply, or an error if its changes were not written
+    """
+    try:
+        for writer, ticket in waits:
+            writer.wait(ticket)
+    except OSError as write_error:
+        logging.error(write_error)
+        return Reply(500, b"Internal Server Error")
+    return reply
+
+
+async def read_body(receive):
+    """Reads the whole request body"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def send_reply(send, reply):
+    """Sends a reply, pulling streamed chunks off the event loop"""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": reply.status,
+            "headers": reply.headers,
+        }
+    )
+    if isinstance(reply.body, bytes):
+        await send({"type": "http.response.body", "body": reply.body})
+        return
+
+    chunks = reply.body
+    if not hasattr(chunks, "__aiter__"):
+        chunks = pull_chunks(chunks)
+    async for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def pull_chunks(chunks):
+    """
+    Iterates over the chunks of a streamed reply, pulling each in the thread pool
+    :param chunks: iterable: chunks, produced by blocking code
+    :return: async generator of chunks
+    """
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def lifespan(receive, send):
+    """Stops the due task scheduler and closes the tasks store on shutdown"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, scheduler.close)
+            await loop.run_in_executor(persistence_executor, tasks.close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI entry point"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    started = metrics.start_timer()
+    request = Request(scope, await read_body(receive))
+    matched = match_route(request.method, request.path)
+
+    if not is_authorized(request):
+        route = None
+        reply = Reply(401, b"Unauthorized", [(b"www-authenticate", b'Basic realm=""')])
+    elif matched is None:
+        route = None
+        reply = Reply(404, b"Not Found")
+    elif isinstance(matched, str):
+        route = None
+        reply = Reply(405, b"Method Not Allowed")
+    else:
+        route, handler, changes, arguments = matched
+        loop = asyncio.get_running_loop()
+        if asyncio.iscoroutinefunction(handler):
+            reply = await handle_async(request, handler, arguments)
+        elif changes:
+            reply, waits = await loop.run_in_executor(
+                persistence_executor, handle_change, request, handler, arguments
+            )
+            if waits:
+                reply = await loop.run_in_executor(None, commit, reply, waits)
+        else:
+            reply = await loop.run_in_executor(
+                None, handle, request, handler, arguments
+            )
+
+    if route is not None:
+        REQUESTS.inc(route, request.method, reply.status)
+        if reply.status >= 400:
+            REQUEST_ERRORS.inc(route, reply.status)
+        REQUEST_SECONDS.observe_since(started, route, request.method)
+
+    await send_reply(send, reply)
@@ -0,0 +1,94 @@
+"""
+Log of the latest task changes, for clients to sync from
+"""
+import threading
+from collections import deque
+from itertools import takewhile
+
+CREATED = "created"
+UPDATED = "updated"
+COMPLETED = "completed"
+DELETED = "deleted"
+ARCHIVED = "archived"
+
+
+class ResyncRequiredError(Exception):
+    """Exception for versions the change log no longer has the changes since."""
+
+
+class ChangesUnavailableError(Exception):
+    """Exception for changes asked of a store other processes share."""
+
+
+class ChangeLog:
+    """
+    The latest changes to tasks, as (version, operation, task_id) entries in
+    version order, where version is the store version the change made. Only the
+    latest size entries are kept. Versions start over, in a new epoch, whenever
+    any task may have changed (e.g. on load).
+    """
+
+    def __init__(self, size):
+        """
+        :param size: int: number of entries kept
+        """
+        self._entries = deque(maxlen=size)
+        self._epoch = None
+        self._version = 0
+        # Changes up to this version may have been dropped
+        self._start = 0
+        self._changed = threading.Condition()
+
+    def reset(self, epoch):
+        """
+        Starts a new epoch, dropping every entry
+        :param epoch: str: new epoch
+        :return: None
+        """
+        with self._changed:
+            self._entries.clear()
+            self._epoch = epoch
+            self._version = 0
+            self._start = 0
+            self._changed.notify_all()
+
+    def append(self, version, operation, task_ids):
+        """
+        Adds the changes a store version made, waking the clients waiting for one
+        :param version: int: store version
+        :param operation: str: CREATED, UPDATED, COMPLETED or DELETED
+        :param task_ids: ids of the changed tasks
+        :return: None
+        """
+        with self._changed:
+            for task_id in task_ids:
+                if len(self._entries) == self._entries.maxlen:
+                    self._start = self._entries[0][0] if self._entries else version
+                self._entries.append((version, operation, task_id))
+            self._version = version
+            self._changed.notify_all()
+
+    def since(self, epoch, version, timeout=0):
+        """
+        Gets the entries after a version, waiting for one if there is none yet
+        :param epoch: str: epoch of the version
+        :param version: int: version
+        :param timeout: float: seconds to wait at most
+        :return: tuple: list of entries, latest version
+        :raises ResyncRequiredError: if entries after version were dropped, or the
+            version is from another epoch
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._version != version or self._epoch != epoch, timeout
+            )
+            if epoch != self._epoch or not self._start <= version <= self._version:
+                raise ResyncRequiredError(
+                    f"changes since {epoch}.{version} are no longer known, resync"
+                )
+
+            entries = list(
+                takewhile(lambda entry: entry[0] > version, reversed(self._entries))
+            )
+            entries.reverse()
+            return entries, self._version
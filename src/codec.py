@@ -0,0 +1,138 @@
+"""
+Parsing and JSON encoding of tasks for the task_master API
+"""
+import json
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speed-up
+    orjson = None
+
+
+def parse_datetime(value):
+    """
+    Parses an ISO 8601 date and time such as 2023-06-20T14:00:00, with optional
+    fractional seconds and UTC offset ('Z' or '+02:00'). Times with an offset are
+    converted to naive local time, which is how etas are stored and compared.
+    :param value: str: date and time to parse
+    :return: datetime: naive datetime
+    :raises ValueError: if value is not an ISO 8601 date and time
+    """
+    if not isinstance(value, str) or len(value) < 19 or value[10] != "T":
+        raise ValueError(f"invalid ISO 8601 date and time {value!r}")
+
+    if value[-1] in "Zz":
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def _default(value):
+    """Encodes datetimes for json.dumps as orjson does"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    """
+    Encodes a value as compact JSON, with datetimes as ISO 8601 strings, using
+    orjson when it is installed
+    :param value: JSON-serializable value
+    :return: bytes: JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(value)  # pylint: disable=no-member
+    return json.dumps(value, separators=(",", ":"), default=_default).encode()
+
+
+def _encode_time(value):
+    """Encodes an optional datetime as a JSON string or null"""
+    return "null" if value is None else f'"{value.isoformat()}"'
+
+
+def encode_task(record):
+    """
+    Encodes a task as the JSON object of its dict form
+    :param record: TaskRecord: task to encode
+    :return: bytes: JSON
+    """
+    if orjson is not None:
+        # A short-lived dict is the fastest way into orjson, which encodes the eta
+        return orjson.dumps(  # pylint: disable=no-member
+            {
+                "description": record.description,
+                "eta": record.eta,
+                "status": record.status,
+                "_id": record.task_id,
+                "created_at": record.created_at,
+                "updated_at": record.updated_at,
+                "version": record.version,
+            }
+        )
+
+    return (
+        f'{{"description":{encode_basestring_ascii(record.description)},'
+        f'"eta":"{record.eta.isoformat()}",'
+        f'"status":{encode_basestring_ascii(record.status)},'
+        f'"_id":{encode_basestring_ascii(record.task_id)},'
+        f'"created_at":{_encode_time(record.created_at)},'
+        f'"updated_at":{_encode_time(record.updated_at)},'
+        f'"version":{record.version}}}'
+    ).encode()
+
+
+class TaskEncoder:
+    """
+    Encodes TaskRecords to JSON bytes, caching the encoding of each task by task
+    id along with the record it was built from, so a task is only encoded again
+    once it changes and lists are joined from cached bytes. Past max_entries tasks,
+    further tasks are encoded without being cached. forget() drops the
+    encodings of changed tasks and can be registered as a Tasks change listener.
+    """
+
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self._encoded = {}
+
+    def encode(self, record):
+        """
+        Encodes a task as a JSON object
+        :param record: TaskRecord: task to encode
+        :return: bytes: JSON
+        """
+        entry = self._encoded.get(record.task_id)
+        if entry is not None and (entry[0] is record or entry[0] == record):
+            return entry[1]
+
+        encoded = encode_task(record)
+        if entry is not None or len(self._encoded) < self.max_entries:
+            self._encoded[record.task_id] = (record, encoded)
+
+        return encoded
+
+    def encode_list(self, records):
+        """
+        Encodes tasks as a JSON array
+        :param records: iterable: TaskRecord
+        :return: bytes: JSON
+        """
+        return b"[" + b",".join(map(self.encode, records)) + b"]"
+
+    def forget(self, task_ids):
+        """
+        Drops the cached encodings of tasks
+        :param task_ids: list: ids of changed tasks, None to drop every encoding
+        :return: None
+        """
+        if task_ids is None:
+            self._encoded.clear()
+            return
+
+        for task_id in task_ids:
+            self._encoded.pop(task_id, None)
@@ -0,0 +1,582 @@
+"""
+Columnar storage backend for tasks
+"""
+from array import array
+from collections import Counter
+from collections.abc import MutableMapping
+from heapq import nsmallest
+from itertools import compress
+
+from records import TaskRecord
+from snapshot import (
+    EPOCH,
+    MICROSECOND,
+    IndexedSnapshot,
+    SnapshotRecords,
+    from_microseconds,
+    to_microseconds,
+)
+from storage import PickleStorage, as_record
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - numpy is an optional speed-up
+    numpy = None
+
+# Status code of deleted rows, until the columns are compacted
+DELETED = 0
+
+# Deleted rows kept before compacting, as long as they are fewer than the live ones
+COMPACT_MIN_DELETED = 1024
+
+# Markers in IdTable slots, which otherwise hold row numbers + 1
+EMPTY = 0
+REMOVED = -1
+
+
+class StringColumn:
+    """
+    Strings kept as UTF-8 in one buffer, with an offset and length per row, rather
+    than as a str object each. Strings replaced by longer ones are appended and
+    their old bytes left unused until compact.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array("Q")
+        self._lengths = array("I")
+        self.unused = 0
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, row):
+        offset = self._offsets[row]
+        return str(
+            self._data[offset : offset + self._lengths[row]], "utf-8", "surrogatepass"
+        )
+
+    def __setitem__(self, row, text):
+        # Lone surrogates JSON may have carried in are kept
+        data = text.encode("utf-8", "surrogatepass")
+        self.unused += self._lengths[row]
+        if len(data) <= self._lengths[row]:
+            offset = self._offsets[row]
+            self._data[offset : offset + len(data)] = data
+            self.unused -= len(data)
+        else:
+            self._offsets[row] = len(self._data)
+            self._data += data
+        self._lengths[row] = len(data)
+
+    def append(self, text):
+        """
+        Adds a row
+        :param text: str: string of the row
+        :return: None
+        """
+        data = text.encode("utf-8", "surrogatepass")
+        self._offsets.append(len(self._data))
+        self._lengths.append(len(data))
+        self._data += data
+
+    def clear(self, row):
+        """
+        Empties a row, leaving its bytes unused
+        :param row: int: row number
+        :return: None
+        """
+        self.unused += self._lengths[row]
+        self._lengths[row] = 0
+
+    def compact(self, live):
+        """
+        Builds a column of the live rows, without unused bytes
+        :param live: iterable: truth value per row
+        :return: StringColumn
+        """
+        column = StringColumn()
+        for row in compress(range(len(self)), live):
+            offset = self._offsets[row]
+            column._offsets.append(len(column._data))  # pylint: disable=W0212
+            column._lengths.append(self._lengths[row])  # pylint: disable=W0212
+            column._data += self._data[offset : offset + self._lengths[row]]
+        return column
+
+    def copy(self):
+        """
+        Copies the column
+        :return: StringColumn
+        """
+        column = StringColumn()
+        column._data = self._data[:]  # pylint: disable=protected-access
+        column._offsets = array("Q", self._offsets)  # pylint: disable=W0212
+        column._lengths = array("I", self._lengths)  # pylint: disable=W0212
+        column.unused = self.unused
+        return column
+
+
+class IdTable:
+    """
+    Open-addressing hash table from task ids to row numbers, holding an int64 per
+    slot instead of a dict entry and an int object per task. Ids are compared
+    against the ids column, so the table does not keep them.
+    """
+
+    def __init__(self, ids, size=8):
+        """
+        :param ids: StringColumn: ids by row
+        :param size: int: number of slots, a power of 2
+        """
+        self._ids = ids
+        self._slots = array("q", bytes(8 * size))
+        self._used = 0
+        self.count = 0
+
+    def _find(self, task_id):
+        """
+        Probes the slots for an id
+        :param task_id: id to look up
+        :return: tuple: slot holding the id or the first free slot, whether found
+        """
+        mask = len(self._slots) - 1
+        perturb = hash(task_id) & 0xFFFFFFFFFFFFFFFF
+        index = perturb & mask
+        free = None
+        while True:
+            row = self._slots[index] - 1
+            if row == EMPTY - 1:
+                return (index if free is None else free), False
+            if row == REMOVED - 1:
+                if free is None:
+                    free = index
+            elif self._ids[row] == task_id:
+                return index, True
+            # The probe sequence of dicts, so every slot is eventually visited
+            perturb >>= 5
+            index = (index * 5 + perturb + 1) & mask
+
+    def get(self, task_id):
+        """
+        Gets the row of an id
+        :param task_id: id to look up
+        :return: int: row number, None if the id has no row
+        """
+        index, found = self._find(task_id)
+        return self._slots[index] - 1 if found else None
+
+    def add(self, task_id, row):
+        """
+        Maps an id that has no row yet to a row
+        :param task_id: id of the task
+        :param row: int: row number
+        :return: None
+        """
+        if 3 * (self._used + 1) > 2 * len(self._slots):
+            self._resize(2 * (self.count + 1))
+
+        index, _ = self._find(task_id)
+        if self._slots[index] == EMPTY:
+            self._used += 1
+        self._slots[index] = row + 1
+        self.count += 1
+
+    def remove(self, task_id):
+        """
+        Unmaps an id that has a row
+        :param task_id: id of the task
+        :return: None
+        """
+        index, _ = self._find(task_id)
+        self._slots[index] = REMOVED
+        self.count -= 1
+
+    def _resize(self, count):
+        """Rebuilds the table with room for count ids, dropping removed slots"""
+        size = 8
+        while size < count:
+            size *= 2
+
+        rows = [x - 1 for x in self._slots if x > EMPTY]
+        self._slots = array("q", bytes(8 * size))
+        self._used = self.count = 0
+        for row in rows:
+            self.add(self._ids[row], row)
+
+    @classmethod
+    def build(cls, ids, live):
+        """
+        Builds the table of the live rows of an ids column
+        :param ids: StringColumn: ids by row
+        :param live: iterable: truth value per row
+        :return: IdTable
+        """
+        rows = list(compress(range(len(ids)), live))
+        size = 8
+        while 3 * len(rows) > 2 * size:
+            size *= 2
+
+        table = cls(ids, size)
+        for row in rows:
+            table.add(ids[row], row)
+        return table
+
+    def copy(self, ids):
+        """
+        Copies the table
+        :param ids: StringColumn: copy of the ids column
+        :return: IdTable
+        """
+        table = IdTable(ids)
+        table._slots = array("q", self._slots)  # pylint: disable=protected-access
+        table._used = self._used  # pylint: disable=protected-access
+        table.count = self.count
+        return table
+
+
+class TaskColumns(MutableMapping):  # pylint: disable=too-many-instance-attributes
+    """
+    Tasks by id, as a dict, held in parallel columns instead of one object per task:
+    etas as int64 microseconds since EPOCH, uint8 status codes, created_at and
+    updated_at as int64 microseconds (NO_TIME for None), uint64 versions, and ids and
+    descriptions in StringColumns, with an IdTable finding rows by id. Rows are in
+    creation order. Replaced tasks keep their row, deleted ones are marked DELETED
+    until compact drops them.
+
+    Scans over the columns use NumPy when it is installed, and otherwise batches of
+    C-level compress and map calls over the arrays.
+    """
+
+    def __init__(self):
+        self.etas = array("q")
+        self.codes = array("B")
+        self.created = array("q")
+        self.updated = array("q")
+        self.versions = array("Q")
+        self.ids = StringColumn()
+        self.descriptions = StringColumn()
+        self.status_names = [None]
+        self._status_codes = {}
+        self._rows = IdTable(self.ids)
+
+    def status_code(self, status):
+        """
+        Gets the code of a status
+        :param status: str: status
+        :return: int: code, None if no task was ever stored with the status
+        """
+        return self._status_codes.get(status)
+
+    def record(self, row):
+        """
+        Builds the record of a row
+        :param row: int: row number
+        :return: TaskRecord
+        """
+        return TaskRecord(
+            self.ids[row],
+            self.descriptions[row],
+            EPOCH + self.etas[row] * MICROSECOND,
+            self.status_names[self.codes[row]],
+            from_microseconds(self.created[row]),
+            from_microseconds(self.updated[row]),
+            self.versions[row],
+        )
+
+    def records(self, rows):
+        """
+        Builds the records of rows
+        :param rows: list: row numbers
+        :return: list: TaskRecord
+        """
+        etas = map(MICROSECOND.__mul__, map(self.etas.__getitem__, rows))
+        return list(
+            map(
+                TaskRecord,
+                map(self.ids.__getitem__, rows),
+                map(self.descriptions.__getitem__, rows),
+                map(EPOCH.__add__, etas),
+                map(self.status_names.__getitem__, map(self.codes.__getitem__, rows)),
+                map(from_microseconds, map(self.created.__getitem__, rows)),
+                map(from_microseconds, map(self.updated.__getitem__, rows)),
+                map(self.versions.__getitem__, rows),
+            )
+        )
+
+    def sort_key(self, row):
+        """(eta, task_id) of a row, with the eta in microseconds"""
+        return self.etas[row], self.ids[row]
+
+    def __getitem__(self, task_id):
+        row = self._rows.get(task_id)
+        if row is None:
+            raise KeyError(task_id)
+        return self.record(row)
+
+    def __setitem__(self, task_id, record):
+        code = self._status_codes.get(record.status)
+        if code is None:
+            code = self._status_codes[record.status] = len(self.status_names)
+            self.status_names.append(record.status)
+
+        row = self._rows.get(task_id)
+        if row is None:
+            self.etas.append(to_microseconds(record.eta))
+            self.codes.append(code)
+            self.created.append(to_microseconds(record.created_at))
+            self.updated.append(to_microseconds(record.updated_at))
+            self.versions.append(record.version)
+            self.ids.append(task_id)
+            self.descriptions.append(record.description)
+            self._rows.add(task_id, len(self.codes) - 1)
+        else:
+            self.etas[row] = to_microseconds(record.eta)
+            self.codes[row] = code
+            self.created[row] = to_microseconds(record.created_at)
+            self.updated[row] = to_microseconds(record.updated_at)
+            self.versions[row] = record.version
+            self.descriptions[row] = record.description
+
+    def __delitem__(self, task_id):
+        row = self._rows.get(task_id)
+        if row is None:
+            raise KeyError(task_id)
+
+        self._rows.remove(task_id)
+        self.codes[row] = DELETED
+        self.ids.clear(row)
+        self.descriptions.clear(row)
+
+        deleted = len(self.codes) - len(self)
+        if deleted > max(len(self), COMPACT_MIN_DELETED):
+            self.compact()
+
+    def __contains__(self, task_id):
+        return self._rows.get(task_id) is not None
+
+    def __iter__(self):
+        return map(self.ids.__getitem__, compress(range(len(self.codes)), self.codes))
+
+    def __len__(self):
+        return self._rows.count
+
+    def values(self):
+        """Builds every record, as a list rather than a view"""
+        return self.records(list(compress(range(len(self.codes)), self.codes)))
+
+    def compact(self):
+        """
+        Drops deleted rows and unused string bytes
+        :return: None
+        """
+        live = self.codes
+        self.etas = array("q", compress(self.etas, live))
+        self.created = array("q", compress(self.created, live))
+        self.updated = array("q", compress(self.updated, live))
+        self.versions = array("Q", compress(self.versions, live))
+        self.ids = self.ids.compact(live)
+        self.descriptions = self.descriptions.compact(live)
+        self.codes = array("B", compress(live, live))
+        self._rows = IdTable.build(self.ids, self.codes)
+
+    def copy(self):
+        """
+        Copies the columns, records are built from them so nothing else is shared
+        :return: TaskColumns
+        """
+        copy = TaskColumns()
+        copy.etas = array("q", self.etas)
+        copy.codes = array("B", self.codes)
+        copy.created = array("q", self.created)
+        copy.updated = array("q", self.updated)
+        copy.versions = array("Q", self.versions)
+        copy.ids = self.ids.copy()
+        copy.descriptions = self.descriptions.copy()
+        copy.status_names = self.status_names.copy()
+        # pylint: disable=protected-access
+        copy._status_codes = self._status_codes.copy()
+        copy._rows = self._rows.copy(copy.ids)
+        return copy
+
+    def scan(self, start=None, end=None, code=None, limit=None):
+        """
+        Finds the rows with start <= eta <= end and a status code. With a limit,
+        rows that cannot be among the first limit by eta may be left out.
+        :param start: int: lower eta bound in microseconds, unbounded if None
+        :param end: int: upper eta bound in microseconds, unbounded if None
+        :param code: int: status code, any status if None
+        :param limit: int: number of rows wanted by eta order, all if None
+        :return: list: row numbers in creation order
+        """
+        if not self.ids:
+            return []
+
+        if numpy is not None:  # pragma: no cover
+            etas = numpy.frombuffer(self.etas, numpy.int64)
+            rows = numpy.flatnonzero(self._mask(start, end, code))
+            if limit is not None and len(rows) > limit:
+                # Ties at start may be dropped by the caller, so keep enough rows
+                row_etas = etas[rows]
+                wanted = limit + int(numpy.count_nonzero(row_etas == start))
+                if wanted < len(rows):
+                    threshold = numpy.partition(row_etas, wanted - 1)[wanted - 1]
+                    rows = rows[row_etas <= threshold]
+            return rows.tolist()
+
+        codes = self.codes if code is None else map(code.__eq__, self.codes)
+        rows = list(compress(range(len(self.codes)), codes))
+        if start is not None:
+            etas = map(self.etas.__getitem__, rows)
+            rows = list(compress(rows, map(start.__le__, etas)))
+        if end is not None:
+            etas = map(self.etas.__getitem__, rows)
+            rows = list(compress(rows, map(end.__ge__, etas)))
+        if limit is not None and len(rows) > limit:
+            etas = list(map(self.etas.__getitem__, rows))
+            wanted = limit + etas.count(start)
+            if wanted < len(rows):
+                threshold = nsmallest(wanted, etas)[-1]
+                rows = list(compress(rows, map(threshold.__ge__, etas)))
+        return rows
+
+    def scan_updated(self, start):
+        """
+        Finds the rows updated at or after start
+        :param start: int: lower updated_at bound in microseconds
+        :return: list: row numbers in (updated_at, task_id) order
+        """
+        if numpy is not None and self.ids:  # pragma: no cover
+            codes = numpy.frombuffer(self.codes, numpy.uint8)
+            updated = numpy.frombuffer(self.updated, numpy.int64)
+            rows = numpy.flatnonzero((codes != DELETED) & (updated >= start)).tolist()
+        else:
+            rows = list(compress(range(len(self.codes)), self.codes))
+            updated = map(self.updated.__getitem__, rows)
+            # NO_TIME sorts before any start, so tasks never updated are left out
+            rows = list(compress(rows, map(start.__le__, updated)))
+
+        rows.sort(key=lambda row: (self.updated[row], self.ids[row]))
+        return rows
+
+    def count(self, start=None, end=None, code=None):
+        """
+        Counts the rows scan would find
+        :return: int: number of rows
+        """
+        if numpy is not None and self.ids:  # pragma: no cover
+            return int(numpy.count_nonzero(self._mask(start, end, code)))
+
+        return len(self.scan(start, end, code))
+
+    def count_by_status(self):
+        """
+        Counts tasks by status
+        :return: dict: number of tasks per status that has any
+        """
+        if numpy is not None and self.ids:  # pragma: no cover
+            codes = numpy.frombuffer(self.codes, numpy.uint8)
+            counts = enumerate(numpy.bincount(codes).tolist())
+        else:
+            counts = Counter(self.codes).items()
+
+        return {
+            self.status_names[code]: count
+            for code, count in counts
+            if code != DELETED and count
+        }
+
+    def _mask(self, start, end, code):  # pragma: no cover
+        """NumPy mask of the rows scan finds"""
+        codes = numpy.frombuffer(self.codes, numpy.uint8)
+        etas = numpy.frombuffer(self.etas, numpy.int64)
+        mask = codes != DELETED if code is None else codes == code
+        if start is not None:
+            mask &= etas >= start
+        if end is not None:
+            mask &= etas <= end
+        return mask
+
+
+class ColumnarStorage(PickleStorage):
+    """
+    PickleStorage holding tasks in TaskColumns, which take several times less memory
+    than a TaskRecord per task. Queries scan the columns instead of keeping eta and
+    status indexes. Records are built on each read, so they are equal but not
+    identical from one read to the next.
+
+    Snapshots and the journal are those of PickleStorage.
+    """
+
+    def _load_snapshot(self, snapshot):
+        if isinstance(snapshot, IndexedSnapshot):
+            snapshot = SnapshotRecords(snapshot, snapshot.read_ids())
+
+        columns = TaskColumns()
+        for task_id, record in snapshot.items():
+            columns[task_id] = as_record(task_id, record)
+        self.records = columns
+
+    def _apply(self, entries):
+        for operation, task_id, record in entries:
+            if operation == "put":
+                self.records[task_id] = record
+            elif task_id in self.records:
+                del self.records[task_id]
+
+    def _range_by_eta(
+        self, start, end, status, after, limit
+    ):  # pylint: disable=too-many-arguments
+        columns = self.records
+        code = None
+        if status is not None:
+            code = columns.status_code(status)
+            if code is None:
+                return []
+
+        start = None if start is None else to_microseconds(start)
+        end = None if end is None else to_microseconds(end)
+        if after is not None:
+            after = to_microseconds(after[0]), after[1]
+            start = after[0] if start is None else max(start, after[0])
+
+        rows = columns.scan(start, end, code, limit)
+        if after is not None:
+            rows = [x for x in rows if columns.sort_key(x) > after]
+
+        if limit is None:
+            rows.sort(key=columns.sort_key)
+        else:
+            rows = nsmallest(limit, rows, key=columns.sort_key)
+
+        return columns.records(rows)
+
+    def range_by_update(self, start):
+        with self._reading():
+            rows = self.records.scan_updated(to_microseconds(start))
+            return self.records.records(rows)
+
+    def count_by_eta(self, start=None, end=None, status=None):
+        with self._reading():
+            code = None
+            if status is not None:
+                code = self.records.status_code(status)
+                if code is None:
+                    return 0
+
+            return self.records.count(
+                None if start is None else to_microseconds(start),
+                None if end is None else to_microseconds(end),
+                code,
+            )
+
+    def filter_by_status(self, status):
+        with self._reading():
+            code = self.records.status_code(status)
+            if code is None:
+                return []
+
+            return self.records.records(self.records.scan(code=code))
+
+    def count_by_status(self):
+        with self._reading():
+            return self.records.count_by_status()
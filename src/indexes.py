@@ -0,0 +1,176 @@
+"""
+Secondary indexes over tasks
+"""
+from bisect import bisect_left, bisect_right, insort
+
+
+class EtaIndex:
+    """Task ids kept sorted by (eta, task_id) for range queries on eta."""
+
+    def __init__(self):
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, eta, task_id):
+        """
+        Adds a task to the index
+        :param eta: datetime: eta of the task
+        :param task_id: id of the task
+        :return: None
+        """
+        insort(self._keys, (eta, task_id))
+
+    def remove(self, eta, task_id):
+        """
+        Removes a task from the index, ignoring tasks that are not indexed
+        :param eta: datetime: eta the task was indexed with
+        :param task_id: id of the task
+        :return: None
+        """
+        key = (eta, task_id)
+        position = bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            del self._keys[position]
+
+    def rebuild(self, tasks):
+        """
+        Replaces the index content
+        :param tasks: dict: task_id -> TaskRecord
+        :return: None
+        """
+        self.load(sorted((task.eta, task_id) for task_id, task in tasks.items()))
+
+    def load(self, keys):
+        """
+        Replaces the index content with keys that are already sorted
+        :param keys: list: (eta, task_id) keys in order
+        :return: None
+        """
+        self._keys = keys
+
+    def range(self, start=None, end=None):
+        """
+        Gets ids of tasks with start <= eta <= end, in eta order
+        :param start: datetime: lower bound, unbounded if None
+        :param end: datetime: upper bound, unbounded if None
+        :return: list: task ids
+        """
+        low = 0 if start is None else bisect_left(self._keys, (start,))
+        high = len(self._keys) if end is None else self._upper_position(end)
+
+        return [task_id for _, task_id in self._keys[low:high]]
+
+    def page(self, after=None, start=None, end=None, limit=None):
+        """
+        Gets (eta, task_id) keys in range that sort after a previously returned key
+        :param after: tuple: last key of the previous page, from the start if None
+        :param start: datetime: lower bound, unbounded if None
+        :param end: datetime: upper bound, unbounded if None
+        :param limit: int: maximum number of keys, unlimited if None
+        :return: list: (eta, task_id) keys in order
+        """
+        low = 0 if start is None else bisect_left(self._keys, (start,))
+        if after is not None:
+            low = max(low, bisect_right(self._keys, after))
+        high = len(self._keys) if end is None else self._upper_position(end)
+        if limit is not None:
+            high = min(high, low + limit)
+
+        return self._keys[low:high]
+
+    def count(self, start=None, end=None):
+        """
+        Counts tasks with start <= eta <= end without materialising their ids
+        :param start: datetime: lower bound, unbounded if None
+        :param end: datetime: upper bound, unbounded if None
+        :return: int: number of tasks in range
+        """
+        low = 0 if start is None else bisect_left(self._keys, (start,))
+        high = len(self._keys) if end is None else self._upper_position(end)
+
+        return max(high - low, 0)
+
+    def _upper_position(self, end):
+        # (end,) sorts before every (end, task_id), so step over equal etas
+        position = bisect_right(self._keys, (end,))
+        while position < len(self._keys) and self._keys[position][0] == end:
+            position += 1
+        return position
+
+
+class UpdateIndex(EtaIndex):
+    """
+    Task ids kept sorted by (updated_at, task_id) for the tasks changed since a time.
+    Tasks without an updated_at are not indexed.
+    """
+
+    def rebuild(self, tasks):
+        self.load(
+            sorted(
+                (task.updated_at, task_id)
+                for task_id, task in tasks.items()
+                if task.updated_at is not None
+            )
+        )
+
+
+class StatusIndex:
+    """Task ids grouped by status, in insertion order."""
+
+    def __init__(self):
+        self._ids = {}
+
+    def add(self, status, task_id):
+        """
+        Adds a task to the index
+        :param status: str: status of the task
+        :param task_id: id of the task
+        :return: None
+        """
+        self._ids.setdefault(status, {})[task_id] = None
+
+    def remove(self, status, task_id):
+        """
+        Removes a task from the index, ignoring tasks that are not indexed
+        :param status: str: status the task was indexed with
+        :param task_id: id of the task
+        :return: None
+        """
+        self._ids.get(status, {}).pop(task_id, None)
+
+    def rebuild(self, tasks):
+        """
+        Replaces the index content
+        :param tasks: dict: task_id -> TaskRecord
+        :return: None
+        """
+        self._ids = {}
+        for task_id, task in tasks.items():
+            self.add(task.status, task_id)
+
+    def load(self, ids_by_status):
+        """
+        Replaces the index content
+        :param ids_by_status: dict: status -> list of task ids in insertion order
+        :return: None
+        """
+        self._ids = {
+            status: dict.fromkeys(ids) for status, ids in ids_by_status.items()
+        }
+
+    def ids(self, status):
+        """
+        Gets the ids of tasks with a status
+        :param status: str: status to look up
+        :return: dict keys view: task ids
+        """
+        return self._ids.get(status, {}).keys()
+
+    def counts(self):
+        """
+        Counts tasks by status
+        :return: dict: number of tasks per status that has any
+        """
+        return {status: len(ids) for status, ids in self._ids.items() if ids}
@@ -0,0 +1,240 @@
+"""
+Append-only journal for task_master
+"""
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+from contextlib import contextmanager
+
+# Every record is framed as <payload length><crc32 of payload><payload>
+RECORD_HEADER = struct.Struct("<II")
+
+
+class Journal:
+    """
+    Append-only log of task mutations.
+
+    Each record is a pickled list of ``(operation, task_id, task)`` entries, so
+    a record is applied as a whole or not at all. A record that was only partly
+    written (e.g. the process died mid-write) fails its length or checksum test
+    and is cut off on the next replay.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.record_count = 0
+        self._file = None
+
+    def replay(self):
+        """
+        Reads every intact record in the journal, truncating a torn tail.
+        :return: list: entries in the order they were appended
+        """
+        self.record_count = 0
+        entries, valid_offset = self.read_from(0)
+
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return entries
+
+        if valid_offset < size:
+            logging.warning(
+                "discarding torn or corrupt journal tail of %s after offset %d",
+                self.path,
+                valid_offset,
+            )
+            self.close()
+            with open(self.path, "r+b") as file:
+                file.truncate(valid_offset)
+
+        return entries
+
+    def read_from(self, offset):
+        """
+        Reads the intact records following a record boundary, stopping at the end of
+        the journal or at the first torn or corrupt record.
+        :param offset: int: file offset to read from
+        :return: tuple: list of entries, offset following the last intact record
+        """
+        entries = []
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(offset)
+                while True:
+                    header = file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, checksum = RECORD_HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        break
+                    try:
+                        entries.extend(pickle.loads(payload))
+                    except (pickle.UnpicklingError, EOFError, ValueError):
+                        break
+                    offset = file.tell()
+                    self.record_count += 1
+        except FileNotFoundError:
+            pass
+
+        return entries, offset
+
+    def append(self, entries):
+        """
+        Appends a single record holding the given entries.
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: None
+        """
+        payload = pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._file is None:
+            self._file = open(self.path, "ab")  # pylint: disable=consider-using-with
+        self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        self.record_count += 1
+
+    def sync(self):
+        """
+        Forces appended records to disk with fsync.
+        :return: None
+        """
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def truncate(self):
+        """
+        Empties the journal, used once its records are covered by a snapshot.
+        :return: None
+        """
+        self.close()
+        with open(self.path, "wb"):
+            pass
+        self.record_count = 0
+
+    def roll_back(self, offset, record_count):
+        """
+        Cuts the journal back to an earlier size, dropping the records appended since,
+        e.g. when appending them failed partway.
+        :param offset: int: journal size to go back to
+        :param record_count: int: number of records before offset
+        :return: None
+        """
+        self.close()
+        if offset < self.size():
+            with open(self.path, "r+b") as file:
+                file.truncate(offset)
+        self.record_count = record_count
+
+    def size(self):
+        """
+        Gets the size of the journal, the offset the next record is appended at.
+        :return: int: size in bytes
+        """
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def discard_before(self, offset, record_count):
+        """
+        Drops the records before offset, once a snapshot covers them, keeping the
+        records appended since. The journal is replaced atomically, so a crash
+        leaves either journal, and replaying covered records on the snapshot is
+        harmless as it already holds their outcome.
+        :param offset: int: journal size when the snapshot was taken
+        :param record_count: int: number of records before offset
+        :return: None
+        """
+        self.close()
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(offset)
+                tail = file.read()
+        except FileNotFoundError:
+            tail = b""
+
+        if not tail:
+            self.truncate()
+            return
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(tail)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.record_count -= record_count
+
+    def close(self):
+        """
+        Closes the append handle, if open.
+        :return: None
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_snapshot(path, data):
+    """
+    Atomically replaces the snapshot at path with the pickled data.
+    :param path: str: snapshot file
+    :param data: object to pickle
+    :return: int: size of the snapshot in bytes
+    """
+    temp_path, size = prepare_snapshot(path, data)
+    os.replace(temp_path, path)
+
+    return size
+
+
+def prepare_snapshot(path, data):
+    """
+    Writes the pickled data next to the snapshot at path, for os.replace to put in
+    its place, so the slow part of a snapshot can be done apart from the switch.
+    :param path: str: snapshot file
+    :param data: object to pickle
+    :return: tuple: path of the written file, its size in bytes
+    """
+    with open_temp_file(path) as (file, temp_path):
+        pickle.dump(data, file)
+        size = file.tell()
+
+    return temp_path, size
+
+
+@contextmanager
+def open_temp_file(path):
+    """
+    Creates a file next to path for os.replace to put in its place. Its name is
+    unique, so processes writing snapshots at the same time do not overwrite each
+    other's, and it is removed if writing it fails.
+    :param path: str: file to replace
+    :return: context manager giving the file opened for writing and its path
+    """
+    directory, name = os.path.split(path)
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix=f"{name}.", suffix=".tmp", dir=directory or os.curdir
+    )
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            yield file, temp_path
+    except BaseException:
+        remove_file(temp_path)
+        raise
+
+
+def remove_file(path):
+    """
+    Removes a file, if it still exists
+    :param path: str: file to remove
+    :return: None
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,163 @@
+"""
+Locks for task_master
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class StoreLock:
+    """
+    Advisory lock on the task files, shared by every process using them.
+
+    The lock file also holds the snapshot generation, a counter bumped each time
+    the journal is compacted into a new snapshot, so other processes can tell a
+    compacted journal from one that has only grown.
+
+    The lock is reentrant within a process, nested acquisitions keep the mode
+    of the outermost one.
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError("multi-process mode needs fcntl file locking")
+
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def exclusive(self):
+        """Holds the lock for writing"""
+        with self._locked(fcntl.LOCK_EX):
+            yield
+
+    @contextmanager
+    def shared(self):
+        """Holds the lock for reading"""
+        with self._locked(fcntl.LOCK_SH):
+            yield
+
+    @contextmanager
+    def _locked(self, mode):
+        with self._thread_lock:
+            if self._depth == 0:
+                fcntl.flock(self._fd, mode)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def read_generation(self):
+        """
+        Reads the snapshot generation, hold the lock while calling this
+        :return: int: generation, 0 before the first compaction
+        """
+        content = os.pread(self._fd, 32, 0)
+        return int(content) if content.strip() else 0
+
+    def write_generation(self, generation):
+        """
+        Writes the snapshot generation, hold the lock exclusively while calling this
+        :param generation: int: new generation
+        :return: None
+        """
+        content = str(generation).encode()
+        os.pwrite(self._fd, content, 0)
+        os.ftruncate(self._fd, len(content))
+
+    def close(self):
+        """
+        Closes the lock file
+        :return: None
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class ReadWriteLock:
+    """
+    Lock held by any number of threads reading at once, or by one thread writing.
+
+    Threads waiting to write go ahead of threads starting to read, so a steady
+    stream of reads cannot starve writes. The lock is reentrant: a thread writing
+    can take it again to read or write, and a thread reading can read again. A
+    thread reading cannot take it to write, as two such threads would deadlock.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """Holds the lock for reading"""
+        thread = threading.get_ident()
+        with self._condition:
+            # Nested reads go ahead of waiting writers, which wait for them
+            if self._writer != thread and thread not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers[thread] = self._readers.get(thread, 0) + 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers[thread] -= 1
+                if not self._readers[thread]:
+                    del self._readers[thread]
+                    if not self._readers:
+                        self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """
+        Holds the lock for writing
+        :raises RuntimeError: if the calling thread holds the lock for reading only
+        """
+        thread = threading.get_ident()
+        with self._condition:
+            if self._writer == thread:
+                self._write_depth += 1
+            else:
+                if thread in self._readers:
+                    raise RuntimeError("cannot write while holding the lock to read")
+
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._condition.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = thread
+                self._write_depth = 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._writer = None
+                    self._condition.notify_all()
+
+    def is_writing(self):
+        """
+        Whether the calling thread holds the lock for writing
+        :return: bool
+        """
+        return self._writer == threading.get_ident()
@@ -0,0 +1,90 @@
+"""
+Logging setup for task_master
+"""
+import atexit
+import logging
+import queue
+import random
+import reprlib
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+import settings
+
+_listener = None  # pylint: disable=invalid-name
+
+# Cuts containers and strings in bodies short before they are formatted
+_body_repr = reprlib.Repr()
+_body_repr.maxlist = _body_repr.maxdict = 20
+_body_repr.maxstring = 100
+
+
+def configure_logging(handler=None):
+    """
+    Sets up the root logger as set in settings. Records are put on a queue by the
+    logging thread and written by a QueueListener thread, so log I/O never blocks
+    a request. Calling it again replaces the previous setup.
+    :param handler: logging.Handler: where records are written, stderr if None
+    :return: None
+    """
+    global _listener  # pylint: disable=global-statement,invalid-name
+
+    if handler is None:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(settings.LOG_FORMAT))
+
+    stop_logging()
+    records = queue.SimpleQueue()
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for previous_handler in root.handlers[:]:
+        root.removeHandler(previous_handler)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(settings.LOG_LEVEL)
+
+
+def stop_logging():
+    """
+    Writes the queued records and stops the listener thread
+    :return: None
+    """
+    global _listener  # pylint: disable=global-statement,invalid-name
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+def log_body(message, body):
+    """
+    Logs a request or response body at DEBUG, for a sample of
+    settings.LOG_BODY_SAMPLE_RATE of the calls, cut to settings.LOG_BODY_MAX_CHARS.
+    Bodies that are not logged are never formatted.
+    :param message: str: what the body is
+    :param body: bytes, str or object: the body
+    :return: None
+    """
+    if (
+        not logging.getLogger().isEnabledFor(logging.DEBUG)
+        or random.random() >= settings.LOG_BODY_SAMPLE_RATE
+    ):
+        return
+
+    limit = settings.LOG_BODY_MAX_CHARS
+    if isinstance(body, (bytes, str)):
+        text = body[:limit]
+        if isinstance(text, bytes):
+            text = text.decode(errors="replace")
+        if len(body) > limit:
+            text += f"... ({len(body)} in total)"
+    else:
+        text = _body_repr.repr(body)
+        if len(text) > limit:
+            text = text[:limit] + "..."
+
+    logging.debug("%s = %s", message, text)
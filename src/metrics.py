@@ -0,0 +1,231 @@
+"""
+Metrics for task_master, exposed in the Prometheus text format
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+
+import settings
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def sampled():
+    """
+    Whether to time this call, for a share of settings.METRICS_SAMPLE_RATE of calls
+    :return: bool
+    """
+    rate = settings.METRICS_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def start_timer():
+    """
+    Starts timing a sampled call
+    :return: float: start time, None if the call is not sampled
+    """
+    return time.perf_counter() if sampled() else None
+
+
+def _escape(value):
+    """Escapes a label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    """Formats label pairs as {name="value",...}"""
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    """Formats a sample value, integers without a decimal point"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        Adds to the count of the given label values
+        :param label_values: values of label_names, in order
+        :param amount: number to add
+        :return: None
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        """Gets the count of the given label values"""
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        """
+        Formats the samples of the metric
+        :return: list: lines
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram:
+    """Distribution of observed values in buckets, per combination of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Records an observed value
+        :param value: float: observed value, e.g. seconds
+        :param label_values: values of label_names, in order
+        :return: None
+        """
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per bucket counts, the last one past every bound, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1)
+                series.append(0.0)
+            series[position] += 1
+            series[-1] += value
+
+    def observe_since(self, started, *label_values):
+        """
+        Records the time elapsed since start_timer, if the call was sampled
+        :param started: float: result of start_timer
+        :param label_values: values of label_names, in order
+        :return: None
+        """
+        if started is not None:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def count(self, *label_values):
+        """Gets the number of observations of the given label values"""
+        series = self._series.get(label_values)
+        return 0 if series is None else sum(series[:-1])
+
+    def render(self):
+        """
+        Formats the samples of the metric
+        :return: list: lines
+        """
+        with self._lock:
+            all_series = sorted((labels, list(x)) for labels, x in self._series.items())
+
+        lines = []
+        for labels, series in all_series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(
+                    self.label_names, labels, f'le="{bound}"'
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            formatted_labels = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{formatted_labels} {series[-1]!r}")
+            lines.append(f"{self.name}_count{formatted_labels} {cumulative}")
+        return lines
+
+
+class Gauge:  # pylint: disable=too-few-public-methods
+    """Values read when the metrics are rendered, from a callback."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names, callback):
+        """
+        :param callback: callable returning a dict of label values tuple to value
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.callback = callback
+
+    def render(self):
+        """
+        Formats the samples of the metric
+        :return: list: lines
+        """
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in sorted(self.callback().items())
+        ]
+
+
+class CallbackCounter(Gauge):  # pylint: disable=too-few-public-methods
+    """Monotonic counts kept elsewhere, read when the metrics are rendered."""
+
+    kind = "counter"
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry
+        :param metric: Counter, Histogram, Gauge or CallbackCounter
+        :return: the metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Formats every metric in the Prometheus text exposition format
+        :return: str: metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,212 @@
+"""
+Durability modes for writing the task journal
+"""
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+SYNC = "sync"
+GROUP_COMMIT = "group-commit"
+ASYNC = "async"
+MODES = (SYNC, GROUP_COMMIT, ASYNC)
+
+# Tickets of group-commit waits deferred by the calling thread, see deferred_waits
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_waits():
+    """
+    Defers the group-commit waits of the calling thread's writes, so that a thread
+    applying changes one at a time can leave waiting for them to other threads
+    :return: context manager giving a list of the deferred ``(writer, ticket)`` pairs,
+        wait for each with JournalWriter.wait once it exits
+    """
+    previous = getattr(_deferred, "waits", None)
+    _deferred.waits = []
+    try:
+        yield _deferred.waits
+    finally:
+        _deferred.waits = previous
+
+
+class JournalWriter:  # pylint: disable=too-many-instance-attributes
+    """
+    Writes journal records in one of three durability modes:
+
+    - ``sync``: every write is appended and fsynced before it returns.
+    - ``group-commit``: writes are queued for a background flusher, which appends and
+      fsyncs them in batches; each write returns once its batch is on disk.
+    - ``async``: writes are queued for the background flusher and return at once.
+
+    The flusher writes a batch once ``max_pending`` records are queued, or every
+    ``interval`` seconds otherwise. ``lock`` guards the journal file, hold it to
+    read or replace the journal without the flusher writing to it.
+    """
+
+    def __init__(self, journal, mode=SYNC, interval=0.01, max_pending=100):
+        if mode not in MODES:
+            raise ValueError(
+                f"unknown persistence mode {mode!r}, expected one of {MODES}"
+            )
+
+        self.journal = journal
+        self.mode = mode
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = threading.RLock()
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._queued_count = 0
+        self._flushed_count = 0
+        self._error = None
+        # Tickets up to this one were in the batch that failed with _error
+        self._error_ticket = 0
+        self._closed = False
+        self._thread = None
+
+        if mode != SYNC:
+            self._thread = threading.Thread(
+                target=self._run, name="journal-flusher", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+
+    def write(self, entries):
+        """
+        Writes one journal record, waiting for it to reach disk unless mode is async
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: None
+        """
+        self.wait(self.queue(entries))
+
+    def queue(self, entries):
+        """
+        Queues one journal record for the flusher, or writes it in sync mode. Records
+        are written in the order they are queued.
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: int: ticket to wait for the record with, None in sync mode
+        """
+        if self.mode == SYNC:
+            with self.lock:
+                offset = self.journal.size()
+                record_count = self.journal.record_count
+                try:
+                    self.journal.append(entries)
+                    self.journal.sync()
+                except OSError:
+                    self._roll_back(offset, record_count)
+                    raise
+            return None
+
+        with self._condition:
+            self._pending.append(entries)
+            self._queued_count += 1
+            if len(self._pending) >= self.max_pending:
+                self._condition.notify_all()
+            return self._queued_count
+
+    def wait(self, ticket):
+        """
+        Waits for a queued record to reach disk in group-commit mode, or only notes
+        the ticket inside deferred_waits
+        :param ticket: int: ticket from queue
+        :return: None
+        """
+        if self.mode != GROUP_COMMIT or ticket is None:
+            return
+
+        deferred = getattr(_deferred, "waits", None)
+        if deferred is not None:
+            deferred.append((self, ticket))
+            return
+
+        with self._condition:
+            while self._flushed_count < ticket and not self._failed(ticket):
+                self._condition.wait()
+            if self._flushed_count < ticket:
+                raise self._error
+
+    def _failed(self, ticket):
+        """Whether the last flush failed with the record of a ticket, hold _condition"""
+        return self._error is not None and ticket <= self._error_ticket
+
+    def flush(self):
+        """
+        Appends and fsyncs every queued record
+        :return: None
+        """
+        with self.lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+                queued_count = self._queued_count
+
+            offset = self.journal.size()
+            record_count = self.journal.record_count
+            try:
+                if batch:
+                    for entries in batch:
+                        self.journal.append(entries)
+                    self.journal.sync()
+            except OSError as write_error:
+                logging.error(
+                    "error writing %d journal records -- %s", len(batch), write_error
+                )
+                self._roll_back(offset, record_count)
+                with self._condition:
+                    # Kept for the next flush, ahead of records queued since
+                    self._pending[:0] = batch
+                    self._error = write_error
+                    self._error_ticket = queued_count
+                    self._condition.notify_all()
+                raise
+
+            with self._condition:
+                self._flushed_count = queued_count
+                self._error = None
+                self._condition.notify_all()
+
+    def _roll_back(self, offset, record_count):
+        """
+        Cuts records of a failed batch off the journal, so none is left torn ahead of
+        the batch written again
+        """
+        try:
+            self.journal.roll_back(offset, record_count)
+        except OSError as roll_back_error:
+            logging.error(
+                "error cutting failed records off the journal -- %s", roll_back_error
+            )
+
+    def close(self):
+        """
+        Stops the flusher once every queued record is written, then closes the journal
+        :return: None
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.journal.close()
+
+    def _run(self):
+        """Flusher loop, writing a batch when it is full or every interval"""
+        while True:
+            with self._condition:
+                if not self._closed and len(self._pending) < self.max_pending:
+                    self._condition.wait(self.interval)
+                closed = self._closed
+
+            try:
+                self.flush()
+            except OSError:
+                pass  # Reported by flush, waiting writers raise the error
+
+            if closed:
+                return
@@ -0,0 +1,73 @@
+"""
+Task records shared by Tasks and the storage backends
+"""
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+
+class TaskRecord(NamedTuple):
+    """
+    Immutable stored task. Records are never changed in place, updates replace them
+    with a new record, so they can be shared with callers without copying.
+
+    Tasks stamps records with when they were created and last updated and a version
+    counting their changes. Records stored before then have None and 0.
+    """
+
+    task_id: str
+    description: str
+    eta: datetime
+    status: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    version: int = 0
+
+    @classmethod
+    def from_dict(cls, task_id, task):
+        """
+        Builds a record from a validated task dict
+        :param task_id: id of the task
+        :param task: dict: task
+        :return: TaskRecord
+        """
+        return cls(task_id, task["description"], task["eta"], task["status"])
+
+    def to_dict(self):
+        """
+        Builds the task dict for the record
+        :return: dict: task with '_id'
+        """
+        return {
+            "description": self.description,
+            "eta": self.eta,
+            "status": self.status,
+            "_id": self.task_id,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "version": self.version,
+        }
+
+    def stamp(self, previous, now):
+        """
+        Stamps the record as the change of a task made at a time
+        :param previous: TaskRecord: record the change replaces, None for a new task
+        :param now: datetime: time of the change
+        :return: TaskRecord
+        """
+        # pylint: disable=no-member
+        if previous is None:
+            return self._replace(created_at=now, updated_at=now, version=1)
+
+        return self._replace(
+            created_at=previous.created_at, updated_at=now, version=previous.version + 1
+        )
+
+    @property
+    def eta_key(self):
+        """(eta, task_id), the key records are ordered and paginated by"""
+        return self.eta, self.task_id
+
+    @property
+    def updated_key(self):
+        """(updated_at, task_id), the key records are ordered by for modified_since"""
+        return self.updated_at, self.task_id
@@ -0,0 +1,88 @@
+"""
+Cache of serialized responses for task_master
+"""
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Least recently used cache of encoded response bodies, bounded by the total
+    size of the bodies it holds.
+
+    Keys must include the version of the data a response was built from, so an
+    entry is never served after a change. clear() is called on every change to
+    free the entries that can no longer be hit.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Gets a cached response, counting the hit or miss
+        :param key: hashable key of the response
+        :return: tuple: body bytes and headers, None if the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, headers):
+        """
+        Caches a response, evicting the least recently used ones over max_bytes.
+        Bodies larger than max_bytes are not cached.
+        :param key: hashable key of the response
+        :param body: bytes: encoded response body
+        :param headers: dict: headers to send with the body
+        :return: None
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+
+            self._entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted_body, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted_body)
+
+    def clear(self, *_):
+        """
+        Drops every cached response, usable as a Tasks change listener
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Gets the hit and miss counters and the current size
+        :return: dict: hits, misses, entries and bytes
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
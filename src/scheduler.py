@@ -0,0 +1,372 @@
+"""
+Notifications of tasks becoming due, sent to callbacks and webhooks
+"""
+import heapq
+import logging
+import threading
+import urllib.request
+from collections import deque
+from datetime import datetime
+from functools import partial
+
+from codec import dumps
+import metrics
+from tasks import Status
+import settings
+
+OPEN = Status.OPEN.value
+
+# Longest wait of the scheduler between two checks for due tasks, in case the clock
+# is set forward
+MAX_WAIT = 60.0
+
+# Stale heap entries kept before the heap is rebuilt, as long as they are fewer than
+# the scheduled tasks
+COMPACT_MIN_STALE = 1024
+
+DISPATCH_LAG_SECONDS = metrics.REGISTRY.register(
+    metrics.Histogram(
+        "task_master_dispatch_lag_seconds",
+        "Time from the eta of due tasks to their delivery, by target",
+        ("target",),
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+    )
+)
+DISPATCHED_TASKS = metrics.REGISTRY.register(
+    metrics.Counter(
+        "task_master_dispatched_tasks_total",
+        "Due tasks sent to notification targets, by target and outcome",
+        ("target", "outcome"),
+    )
+)
+DISPATCH_RETRIES = metrics.REGISTRY.register(
+    metrics.Counter(
+        "task_master_dispatch_retries_total",
+        "Failed sends of due tasks that were retried, by target",
+        ("target",),
+    )
+)
+
+
+def post_json(url, timeout, tasks):
+    """
+    Posts due tasks to a webhook as a JSON list
+    :param url: str: webhook URL
+    :param timeout: float: seconds to wait for the webhook
+    :param tasks: list: task dicts
+    :return: None
+    :raises OSError: if the webhook cannot be reached or answers with an error status
+    """
+    request = urllib.request.Request(
+        url,
+        data=dumps(tasks),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+
+class Dispatcher:  # pylint: disable=too-many-instance-attributes
+    """
+    Sends due tasks to one target from a thread of its own, so a slow or failing
+    target does not hold back the others. Tasks are sent in batches of at most
+    batch_size, tasks that become due while a send is in progress going together
+    in the next batch. Failed sends are retried up to retries times, waiting
+    backoff seconds before the first retry and twice as long before each next one.
+    """
+
+    def __init__(
+        self, name, send, batch_size=100, retries=5, backoff=0.5
+    ):  # pylint: disable=too-many-arguments
+        """
+        :param name: str: name of the target in logs and metrics
+        :param send: callable sending a list of task dicts, raising if it fails
+        :param batch_size: int: most tasks per send
+        :param retries: int: retries of a failed send before its tasks are dropped
+        :param backoff: float: seconds before the first retry
+        """
+        self.name = name
+        self._send = send
+        self._batch_size = batch_size
+        self._retries = retries
+        self._backoff = backoff
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"dispatcher-{name}", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, records):
+        """
+        Queues due tasks for sending
+        :param records: list: TaskRecord
+        :return: None
+        """
+        with self._condition:
+            self._queue.extend(records)
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Stops the thread once the send in progress is done, dropping queued tasks
+        :return: None
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        """Sender loop, sending a batch whenever tasks are queued"""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if self._closed:
+                    if self._queue:
+                        logging.warning(
+                            "dropping %d due tasks not sent to %s on close",
+                            len(self._queue),
+                            self.name,
+                        )
+                    return
+
+                count = min(len(self._queue), self._batch_size)
+                batch = [self._queue.popleft() for _ in range(count)]
+
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        """
+        Sends a batch, retrying with backoff
+        :param batch: list: TaskRecord
+        :return: None
+        """
+        tasks = [record.to_dict() for record in batch]
+        wait = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                self._send(tasks)
+            except Exception as send_error:  # pylint: disable=broad-exception-caught
+                if attempt == self._retries or self._closed:
+                    logging.error(
+                        "dropping %d due tasks not sent to %s -- %s",
+                        len(batch),
+                        self.name,
+                        send_error,
+                    )
+                    DISPATCHED_TASKS.inc(self.name, "failed", amount=len(batch))
+                    return
+
+                logging.warning(
+                    "error sending due tasks to %s, retrying in %ss -- %s",
+                    self.name,
+                    wait,
+                    send_error,
+                )
+                DISPATCH_RETRIES.inc(self.name)
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed, wait)
+                wait *= 2
+            else:
+                now = datetime.now()
+                for record in batch:
+                    lag = (now - record.eta).total_seconds()
+                    DISPATCH_LAG_SECONDS.observe(max(lag, 0.0), self.name)
+                DISPATCHED_TASKS.inc(self.name, "delivered", amount=len(batch))
+                return
+
+
+class DueScheduler:  # pylint: disable=too-many-instance-attributes
+    """
+    Sends OPEN tasks to the registered targets once their eta passes, so that clients
+    need not poll /tasks/due. Scheduled tasks are kept in a min-heap by eta, whose
+    entries for tasks changed or removed since are skipped when they come up.
+
+    The scheduler is a change listener of the tasks: it only takes note of the changed
+    ids, and its thread reads the changed tasks back to reschedule them. A task is sent
+    once per eta: tasks already due when the tasks are loaded are not sent, and neither
+    is a due task changed without moving its eta. Each process sends the tasks it sees
+    become due, so only one process should have targets.
+    """
+
+    def __init__(self, tasks):
+        """
+        :param tasks: Tasks: tasks to schedule, read with get_task_records
+        """
+        self._tasks = tasks
+        self._heap = []
+        # OPEN tasks by id, waiting for their eta or with their eta passed
+        self._scheduled = {}
+        self._passed = {}
+        self._dispatchers = []
+        self._pending = set()
+        self._stale = False
+        self._closed = False
+        self._condition = threading.Condition()
+        # Started with the first target, changes are ignored until then
+        self._thread = None
+
+    def add_callback(self, name, callback):
+        """
+        Calls a function with the tasks that become due from now on, from a thread of
+        its own
+        :param name: str: name of the callback in logs and metrics
+        :param callback: callable taking a list of task dicts, raising if it fails
+        :return: None
+        """
+        self._add_dispatcher(
+            Dispatcher(
+                name,
+                callback,
+                settings.DUE_BATCH_SIZE,
+                settings.DUE_RETRIES,
+                settings.DUE_RETRY_BACKOFF,
+            )
+        )
+
+    def add_webhook(self, url):
+        """
+        Posts the tasks that become due from now on to a URL, as a JSON list
+        :param url: str: webhook URL
+        :return: None
+        """
+        self.add_callback(url, partial(post_json, url, settings.DUE_WEBHOOK_TIMEOUT))
+
+    def _add_dispatcher(self, dispatcher):
+        """
+        Adds a target. With the first one, the tasks are scheduled, taking changes
+        from then on, and the scheduler thread is started.
+        """
+        with self._condition:
+            self._dispatchers.append(dispatcher)
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="due-scheduler", daemon=True
+            )
+
+        self._rebuild()
+        self._thread.start()
+
+    def changed(self, task_ids):
+        """
+        Change listener, rescheduling changed tasks
+        :param task_ids: ids of the changed tasks, None if any task may have changed
+        :return: None
+        """
+        with self._condition:
+            if self._thread is None:
+                return
+            if task_ids is None:
+                self._stale = True
+                self._pending.clear()
+            else:
+                self._pending.update(task_ids)
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Stops the scheduler and its targets
+        :return: None
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            thread.join()
+        for dispatcher in self._dispatchers:
+            dispatcher.close()
+
+    def scheduled_count(self):
+        """
+        Counts the tasks waiting for their eta
+        :return: int: number of tasks
+        """
+        with self._condition:
+            return len(self._scheduled)
+
+    def _run(self):
+        """Scheduler loop, applying changes and dispatching tasks as they become due"""
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                stale, self._stale = self._stale, False
+                pending, self._pending = self._pending, set()
+
+            if stale:
+                self._rebuild()
+            for task_id in pending:
+                self._reschedule(task_id)
+
+            due = self._pop_due(datetime.now())
+            if due:
+                for dispatcher in self._dispatchers:
+                    dispatcher.put(due)
+
+            with self._condition:
+                if not (self._closed or self._stale or self._pending):
+                    self._condition.wait(self._wait_time())
+
+    def _rebuild(self):
+        """Schedules every OPEN task afresh, those already due as passed"""
+        now = datetime.now()
+        records = self._tasks.get_task_records(status=OPEN)
+        with self._condition:
+            self._scheduled = {x.task_id: x for x in records if x.eta > now}
+            self._passed = {x.task_id: x.eta for x in records if x.eta <= now}
+            self._heap = [(x.eta, x.task_id) for x in self._scheduled.values()]
+            heapq.heapify(self._heap)
+
+    def _reschedule(self, task_id):
+        """Schedules a changed task again, or stops scheduling it"""
+        records = self._tasks.get_task_records(task_id)
+        record = records[0] if records else None
+        with self._condition:
+            if record is None or record.status != OPEN:
+                self._scheduled.pop(task_id, None)
+                self._passed.pop(task_id, None)
+                return
+            if self._passed.get(task_id) == record.eta:
+                return
+
+            self._passed.pop(task_id, None)
+            scheduled = self._scheduled.get(task_id)
+            self._scheduled[task_id] = record
+            if scheduled is None or scheduled.eta != record.eta:
+                heapq.heappush(self._heap, (record.eta, task_id))
+
+    def _pop_due(self, now):
+        """
+        Takes the tasks due at a time off the heap
+        :param now: datetime: time
+        :return: list: TaskRecord of the due tasks, in eta order
+        """
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                eta, task_id = heapq.heappop(self._heap)
+                record = self._scheduled.get(task_id)
+                if record is not None and record.eta == eta:
+                    del self._scheduled[task_id]
+                    self._passed[task_id] = eta
+                    due.append(record)
+
+            stale = len(self._heap) - len(self._scheduled)
+            if stale > max(len(self._scheduled), COMPACT_MIN_STALE):
+                self._heap = [(x.eta, x.task_id) for x in self._scheduled.values()]
+                heapq.heapify(self._heap)
+
+        return due
+
+    def _wait_time(self):
+        """Seconds until the next scheduled eta, at most MAX_WAIT"""
+        if not self._heap:
+            return MAX_WAIT
+        wait = (self._heap[0][0] - datetime.now()).total_seconds()
+        return min(max(wait, 0.0), MAX_WAIT)
@@ -0,0 +1,277 @@
+"""
+Full-text search over task descriptions
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+
+# Words are runs of letters, digits and underscores, compared case-insensitively
+WORD = re.compile(r"\w+")
+
+# Candidates below which prefix terms are checked against each candidate's words
+# instead of gathering every task with a word that has the prefix
+PREFIX_CHECK_LIMIT = 1000
+
+# New words from one update above which the word list is sorted again rather than
+# inserted into
+SORT_WORDS_LIMIT = 20
+
+# Sorts after every word starting with a given prefix
+MAX_CHARACTER = chr(0x10FFFF)
+
+# Tasks indexed between checks for close while catching up with every task
+CLOSE_CHECK_INTERVAL = 1000
+
+
+class InvalidSearchError(ValueError):
+    """Exception for search queries without any word."""
+
+
+def tokenize(text):
+    """
+    Splits text into the words it is indexed under
+    :param text: str: text to split
+    :return: set: distinct words, lower case
+    """
+    return set(WORD.findall(text.casefold()))
+
+
+def parse_query(query):
+    """
+    Parses a search query: words that must all be in a task's description, where
+    a word ending with * matches any word starting with it.
+    :param query: str: query
+    :return: list: (word, whether it is a prefix) terms
+    :raises InvalidSearchError: if the query has no word
+    """
+    terms = []
+    for part in query.casefold().split():
+        words = WORD.findall(part)
+        terms.extend((word, False) for word in words)
+        if words and part.endswith("*"):
+            terms[-1] = (words[-1], True)
+
+    if not terms:
+        raise InvalidSearchError(f"search query {query!r} has no word")
+
+    return terms
+
+
+class SearchIndex:  # pylint: disable=too-many-instance-attributes
+    """
+    Inverted index from words to the ids of the tasks whose description has them,
+    with the words kept sorted for prefix lookups. Words of a single task, the most
+    common kind, map to its id rather than to a set, and the index keeps the
+    description it indexed per task, shared with the record, rather than its words.
+
+    It is told about changes as a change listener, which only notes the changed
+    ids, so changes cost next to nothing. Searches bring the index up to date with
+    the noted changes first, reading the changed tasks from the storage. When any
+    task may have changed, e.g. after a load, every task is read and only those
+    whose description changed are indexed again. warm_up does this in a thread of
+    its own, so the first search after a load does not.
+    """
+
+    def __init__(self, storage):
+        """
+        :param storage: TaskStorage: storage the tasks are read from
+        """
+        self._storage = storage
+        self._postings = {}
+        self._words = []
+        self._descriptions = {}
+        self._pending = set()
+        self._stale = True
+        # The pending lock is only held to note changes, never while reading tasks,
+        # as listeners may be called with the storage locked
+        self._pending_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._warm_up_thread = None
+        self._closed = threading.Event()
+
+    def changed(self, task_ids):
+        """
+        Change listener noting changed tasks
+        :param task_ids: list: ids of the changed tasks, None if any may have changed
+        :return: None
+        """
+        with self._pending_lock:
+            if task_ids is None:
+                self._stale = True
+                self._pending = set()
+            elif not self._stale:
+                self._pending.update(task_ids)
+
+    def warm_up(self):
+        """
+        Brings the index up to date in a background thread, unless one is running
+        :return: None
+        """
+        if self._warm_up_thread is not None and self._warm_up_thread.is_alive():
+            return
+
+        self._warm_up_thread = threading.Thread(
+            target=self._warm_up, name="search-warm-up", daemon=True
+        )
+        self._warm_up_thread.start()
+
+    def _warm_up(self):
+        """Updates the index until it is no longer stale or the index is closed"""
+        while not self._closed.is_set():
+            with self._update_lock:
+                self._update()
+            with self._pending_lock:
+                if not self._stale:
+                    return
+
+    def close(self):
+        """
+        Stops the warm-up thread, leaving the index stale if it was not done
+        :return: None
+        """
+        self._closed.set()
+        if self._warm_up_thread is not None:
+            self._warm_up_thread.join()
+
+    def search(self, query):
+        """
+        Finds the tasks matching a query
+        :param query: str: query, as parse_query takes it
+        :return: set: task ids
+        :raises InvalidSearchError: if the query has no word
+        """
+        terms = parse_query(query)
+
+        with self._update_lock:
+            self._update()
+            return self._match(terms)
+
+    def _update(self):
+        """Applies the noted changes, hold the update lock while calling this"""
+        with self._pending_lock:
+            stale = self._stale
+            pending = self._pending
+            self._stale = False
+            self._pending = set()
+
+        if stale:
+            descriptions = {x.task_id: x.description for x in self._storage.all()}
+            # Tasks that are gone
+            descriptions.update(
+                dict.fromkeys(self._descriptions.keys() - descriptions.keys())
+            )
+        else:
+            descriptions = {}
+            for task_id in pending:
+                record = self._storage.get(task_id)
+                descriptions[task_id] = None if record is None else record.description
+
+        new_words = []
+        for number, (task_id, description) in enumerate(descriptions.items()):
+            if stale and number % CLOSE_CHECK_INTERVAL == 0 and self._closed.is_set():
+                # Left for the next update to finish
+                self.changed(None)
+                break
+            if description != self._descriptions.get(task_id):
+                self._unindex(task_id)
+                if description is not None:
+                    new_words += self._index(task_id, description)
+
+        # Inserting a word moves the words after it, sorting compares every word
+        new_words = [x for x in new_words if not self._is_listed(x)]
+        if len(new_words) < SORT_WORDS_LIMIT:
+            for word in new_words:
+                insort(self._words, word)
+        else:
+            self._words += new_words
+            self._words.sort()
+        # Words no task has any more are left in the list, and dropped once they
+        # are half of it, rather than moving the words after each of them
+        if len(self._words) > 2 * len(self._postings):
+            self._words = [x for x in self._words if x in self._postings]
+
+    def _is_listed(self, word):
+        """Tells whether a word is in the sorted list of words"""
+        position = bisect_left(self._words, word)
+        return position < len(self._words) and self._words[position] == word
+
+    def _index(self, task_id, description):
+        """
+        Adds a task under its words
+        :return: list: words no task had before
+        """
+        self._descriptions[task_id] = description
+        new_words = []
+        for word in tokenize(description):
+            posting = self._postings.setdefault(word, task_id)
+            if posting is task_id:
+                new_words.append(word)
+            elif isinstance(posting, set):
+                posting.add(task_id)
+            else:
+                self._postings[word] = {posting, task_id}
+        return new_words
+
+    def _unindex(self, task_id):
+        """Removes a task from the postings of its words"""
+        description = self._descriptions.pop(task_id, None)
+        if description is None:
+            return
+
+        for word in tokenize(description):
+            posting = self._postings[word]
+            if not isinstance(posting, set):
+                del self._postings[word]
+                continue
+
+            posting.discard(task_id)
+            if len(posting) == 1:
+                self._postings[word] = posting.pop()
+
+    def _posting(self, word):
+        """Gets the ids of the tasks with a word, as a set not to be changed"""
+        posting = self._postings.get(word)
+        if posting is None:
+            return set()
+        if isinstance(posting, set):
+            return posting
+        return {posting}
+
+    def _has_prefix(self, task_id, prefix):
+        """Tells whether a task has a word starting with prefix"""
+        return any(x.startswith(prefix) for x in tokenize(self._descriptions[task_id]))
+
+    def _match(self, terms):
+        """
+        Intersects the tasks of each term, rarest exact words first
+        :param terms: list: (word, whether it is a prefix) terms
+        :return: set: task ids
+        """
+        postings = sorted(
+            (self._posting(word) for word, prefix in terms if not prefix), key=len
+        )
+        prefixes = [word for word, prefix in terms if prefix]
+
+        # Few enough candidates are checked for the prefixes one by one
+        if postings and len(postings[0]) < PREFIX_CHECK_LIMIT:
+            return {
+                task_id
+                for task_id in postings[0].intersection(*postings[1:])
+                if all(self._has_prefix(task_id, prefix) for prefix in prefixes)
+            }
+
+        for prefix in prefixes:
+            found = set()
+            start = bisect_left(self._words, prefix)
+            end = bisect_left(self._words, prefix + MAX_CHARACTER, start)
+            for word in self._words[start:end]:
+                posting = self._postings.get(word)
+                if isinstance(posting, set):
+                    found |= posting
+                elif posting is not None:
+                    found.add(posting)
+            postings.append(found)
+
+        # Intersections walk the smaller set, so start from the smallest
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
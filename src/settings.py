@@ -3,3 +3,83 @@ Settings for task_master
 """
 
 TASK_DATA_FILE = "data/stored_tasks.pkl"
+TASK_JOURNAL_FILE = "data/stored_tasks.journal"
+
+# Number of journal records after which the journal is folded into a new snapshot
+JOURNAL_COMPACT_THRESHOLD = 1000
+
+# Format snapshots are written in: "indexed" snapshots are memory-mapped at load and
+# their tasks decoded on first read, "pickle" snapshots are unpickled whole. Either
+# format is read. SNAPSHOT_WARM_UP decodes indexed snapshots in a background thread.
+SNAPSHOT_FORMAT = "indexed"
+SNAPSHOT_WARM_UP = True
+
+# Whether the search index is built in a background thread at load, rather than by
+# the first search
+SEARCH_WARM_UP = True
+
+# Largest page of tasks returned for a `limit` query, and page size used when streaming
+MAX_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 500
+
+# How mutations reach disk: "sync" fsyncs each one before responding, "group-commit" waits
+# for a background flusher that fsyncs them in batches, "async" responds without waiting
+PERSISTENCE_MODE = "sync"
+# The flusher writes a batch every FLUSH_INTERVAL seconds, or once FLUSH_MAX_PENDING
+# changes are queued
+FLUSH_INTERVAL = 0.01
+FLUSH_MAX_PENDING = 100
+
+# Where tasks are stored: "pickle" keeps them in memory, persisted to TASK_DATA_FILE and
+# TASK_JOURNAL_FILE, "columnar" does the same with tasks packed in arrays for less
+# memory and scanned on each query, "sqlite" keeps them in the TASK_DATABASE_FILE database
+STORAGE_BACKEND = "pickle"
+TASK_DATABASE_FILE = "data/stored_tasks.sqlite3"
+
+# Lets several processes (e.g. gunicorn workers) share the pickle store. Writes lock
+# TASK_LOCK_FILE and each process picks up the others' changes from the journal.
+# Needs PERSISTENCE_MODE = "sync". Versions are kept by each process, so GET
+# /tasks/changes is turned off: set it with several processes on the sqlite store too.
+MULTI_PROCESS = False
+TASK_LOCK_FILE = "data/stored_tasks.lock"
+
+# Memory budget in bytes of the cache of encoded GET /tasks and /tasks/due responses,
+# 0 disables the cache
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Number of task changes kept for GET /tasks/changes, clients further behind must
+# resync. Long polls wait at most CHANGES_MAX_WAIT seconds, and event streams end after
+# CHANGES_STREAM_SECONDS for clients to reconnect from the last event.
+CHANGE_LOG_SIZE = 10000
+CHANGES_MAX_WAIT = 30
+CHANGES_STREAM_SECONDS = 300
+
+# OPEN tasks are POSTed as a JSON list to each of DUE_WEBHOOKS once their eta passes, in
+# batches of at most DUE_BATCH_SIZE. Failed sends are retried DUE_RETRIES times, waiting
+# DUE_RETRY_BACKOFF seconds before the first retry and twice as long before each next
+# one. Every process sends the tasks it sees become due, so run a single process with
+# webhooks.
+DUE_WEBHOOKS = []
+DUE_BATCH_SIZE = 100
+DUE_RETRIES = 5
+DUE_RETRY_BACKOFF = 0.5
+DUE_WEBHOOK_TIMEOUT = 10
+
+# DONE and CANCELLED tasks last changed more than ARCHIVE_AFTER_DAYS days ago are moved
+# out of the store into ARCHIVE_FILE, a compressed append-only file, checked every
+# ARCHIVE_INTERVAL seconds. Archived tasks are only read by id, or with
+# include_archived=true. None keeps every task in the store.
+ARCHIVE_FILE = "data/stored_tasks.archive"
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_INTERVAL = 3600
+
+# Logging: level of the root logger, format of each line, and the share of request and
+# response bodies logged at DEBUG level, cut to LOG_BODY_MAX_CHARS
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s level=%(levelname)s logger=%(name)s %(message)s"
+LOG_BODY_SAMPLE_RATE = 0.01
+LOG_BODY_MAX_CHARS = 1000
+
+# Share of requests whose latency is recorded for /metrics, 0 turns timing off. Request
+# and error counts are always kept.
+METRICS_SAMPLE_RATE = 1.0
@@ -0,0 +1,380 @@
+"""
+Indexed snapshots of the task store, memory-mapped and decoded lazily
+"""
+import json
+import mmap
+import pickle
+import struct
+import zlib
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+from itertools import compress
+
+from journal import open_temp_file, prepare_snapshot as prepare_pickle_snapshot
+from records import TaskRecord
+import settings
+
+MAGIC = b"TASKSNAP"
+VERSION = 2
+
+PREFIX = struct.Struct("<8sI")
+# magic, version, number of tasks, offsets of the ids, statuses, status numbers, etas,
+# order, stamps, update order and entries sections, crc32 of everything from the ids on.
+# Version 1 snapshots have no stamps or update order sections.
+HEADERS = {
+    1: struct.Struct("<8sIQQQQQQQI"),
+    2: struct.Struct("<8sIQQQQQQQQQI"),
+}
+HEADER = HEADERS[VERSION]
+# Per task, in creation order: offset and length of its description, its crc32
+ENTRY = struct.Struct("<QII")
+STATUS = struct.Struct("<H")
+ETA = struct.Struct("<q")
+# Per task, in creation order: created_at, updated_at and version
+STAMPS = struct.Struct("<qqq")
+# Stands for a created_at or updated_at of None
+NO_TIME = -(2**63)
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class CorruptSnapshotError(ValueError):
+    """Exception for a snapshot failing its checksums."""
+
+
+def to_microseconds(value):
+    """
+    Packs a time for a snapshot
+    :param value: datetime: time, or None
+    :return: int: microseconds since EPOCH, NO_TIME for None
+    """
+    return NO_TIME if value is None else (value - EPOCH) // MICROSECOND
+
+
+def from_microseconds(value):
+    """
+    Unpacks a time from a snapshot
+    :param value: int: microseconds since EPOCH, NO_TIME for None
+    :return: datetime: time, or None
+    """
+    return None if value == NO_TIME else EPOCH + value * MICROSECOND
+
+
+def prepare_snapshot(path, records):
+    """
+    Writes the tasks next to the snapshot at path, for os.replace to put in its
+    place, in the format set by settings.SNAPSHOT_FORMAT
+    :param path: str: snapshot file
+    :param records: mapping: task_id -> TaskRecord
+    :return: tuple: path of the written file, its size in bytes
+    """
+    if settings.SNAPSHOT_FORMAT == "pickle":
+        return prepare_pickle_snapshot(path, dict(records))
+
+    return prepare_indexed_snapshot(path, records)
+
+
+def prepare_indexed_snapshot(path, records):  # pylint: disable=too-many-locals
+    """
+    Writes the tasks in the indexed format next to the snapshot at path.
+
+    The file holds a header and the task descriptions, then sections read whole to
+    build the indexes: the ids as a JSON list, the status names, a status number
+    and an eta per task, the task numbers in eta order, the created_at, updated_at
+    and version of each task, the numbers of the tasks with an updated_at in
+    updated_at order and a fixed-size entry per task locating its description. The
+    header checksum covers the sections, each description has its own.
+    :param path: str: snapshot file
+    :param records: mapping: task_id -> TaskRecord
+    :return: tuple: path of the written file, its size in bytes
+    """
+    statuses = {}
+    numbers = []
+    etas = []
+    stamps = []
+    entries = []
+
+    with open_temp_file(path) as (file, temp_path):
+        file.write(bytes(HEADER.size))
+        offset = HEADER.size
+        for record in records.values():
+            # Lone surrogates JSON may have carried in are kept
+            description = record.description.encode("utf-8", "surrogatepass")
+            file.write(description)
+            entries.append(
+                ENTRY.pack(offset, len(description), zlib.crc32(description))
+            )
+            numbers.append(statuses.setdefault(record.status, len(statuses)))
+            etas.append((record.eta - EPOCH) // MICROSECOND)
+            stamps.append(
+                STAMPS.pack(
+                    to_microseconds(record.created_at),
+                    to_microseconds(record.updated_at),
+                    record.version,
+                )
+            )
+            offset += len(description)
+
+        count = len(entries)
+        keys = [x.eta_key for x in records.values()]
+        updated = sorted(
+            (x.updated_key, number)
+            for number, x in enumerate(records.values())
+            if x.updated_at is not None
+        )
+        sections = [
+            json.dumps(list(records)).encode(),
+            json.dumps(list(statuses)).encode(),
+            struct.pack(f"<{count}H", *numbers),
+            struct.pack(f"<{count}q", *etas),
+            struct.pack(f"<{count}I", *sorted(range(count), key=keys.__getitem__)),
+            b"".join(stamps),
+            struct.pack(f"<{len(updated)}I", *(number for _, number in updated)),
+            b"".join(entries),
+        ]
+        offsets = []
+        checksum = 0
+        for section in sections:
+            offsets.append(offset)
+            file.write(section)
+            checksum = zlib.crc32(section, checksum)
+            offset += len(section)
+
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, count, *offsets, checksum))
+
+    return temp_path, offset
+
+
+def read_snapshot(path):
+    """
+    Reads the snapshot at path, in either format
+    :param path: str: snapshot file
+    :return: IndexedSnapshot, or dict of the tasks for a pickled snapshot
+    :raises FileNotFoundError: if there is no snapshot
+    :raises CorruptSnapshotError: if an indexed snapshot fails its checksum
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            file.seek(0)
+            return pickle.load(file)
+
+        return IndexedSnapshot(file)
+
+
+def read_records(path):
+    """
+    Reads every task of the snapshot at path, in either format
+    :param path: str: snapshot file
+    :return: dict: task_id -> TaskRecord, or dict for tasks pickled as dicts
+    """
+    snapshot = read_snapshot(path)
+    if isinstance(snapshot, IndexedSnapshot):
+        return SnapshotRecords(snapshot, snapshot.read_ids()).to_dict()
+    return snapshot
+
+
+class IndexedSnapshot:  # pylint: disable=too-many-instance-attributes
+    """
+    Memory-mapped indexed snapshot. Its index is checked against the checksum in
+    the header when it is opened, and each description against its own checksum
+    when its task is decoded.
+    """
+
+    def __init__(self, file):
+        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < PREFIX.size:
+            raise CorruptSnapshotError(f"snapshot {file.name} is truncated")
+        _, version = PREFIX.unpack_from(self._map)
+        if version not in HEADERS:
+            raise CorruptSnapshotError(f"unknown snapshot version {version}")
+        if len(self._map) < HEADERS[version].size:
+            raise CorruptSnapshotError(f"snapshot {file.name} is truncated")
+
+        fields = list(HEADERS[version].unpack_from(self._map))
+        if version == 1:
+            # Tasks of version 1 snapshots were never stamped
+            fields[8:8] = [None, None]
+        (
+            _,
+            _,
+            self.count,
+            self._ids_offset,
+            self._statuses_offset,
+            self._numbers_offset,
+            self._etas_offset,
+            self._order_offset,
+            self._stamps_offset,
+            self._updates_offset,
+            self._entries_offset,
+            checksum,
+        ) = fields
+        if (
+            self._entries_offset + self.count * ENTRY.size != len(self._map)
+            or zlib.crc32(self._map[self._ids_offset :]) != checksum
+        ):
+            raise CorruptSnapshotError(f"snapshot {file.name} fails its checksum")
+
+        self.statuses = json.loads(
+            self._map[self._statuses_offset : self._numbers_offset]
+        )
+
+    def read_ids(self):
+        """
+        Reads the ids of the tasks
+        :return: list: task ids in creation order
+        """
+        return json.loads(self._map[self._ids_offset : self._statuses_offset])
+
+    def read_index(self):
+        """
+        Reads what the indexes are built from, without decoding any task
+        :return: tuple: ids in creation order, dict of ids in creation order by
+            status, (eta, task_id) keys in order, (updated_at, task_id) keys in order
+        """
+        ids = self.read_ids()
+        numbers = struct.unpack_from(f"<{self.count}H", self._map, self._numbers_offset)
+        etas = struct.unpack_from(f"<{self.count}q", self._map, self._etas_offset)
+        order = struct.unpack_from(f"<{self.count}I", self._map, self._order_offset)
+
+        ids_by_status = {
+            status: list(compress(ids, map(number.__eq__, numbers)))
+            for number, status in enumerate(self.statuses)
+        }
+        etas = map(MICROSECOND.__mul__, map(etas.__getitem__, order))
+        eta_keys = list(zip(map(EPOCH.__add__, etas), map(ids.__getitem__, order)))
+
+        updated_keys = []
+        if self._stamps_offset is not None:
+            stamps = struct.unpack_from(
+                f"<{3 * self.count}q", self._map, self._stamps_offset
+            )
+            updated = stamps[1::3]
+            order = struct.unpack_from(
+                f"<{(self._entries_offset - self._updates_offset) // 4}I",
+                self._map,
+                self._updates_offset,
+            )
+            updated_keys = list(
+                zip(
+                    map(from_microseconds, map(updated.__getitem__, order)),
+                    map(ids.__getitem__, order),
+                )
+            )
+
+        return ids, ids_by_status, eta_keys, updated_keys
+
+    def record(self, task_id, number):
+        """
+        Decodes a task
+        :param task_id: id of the task
+        :param number: int: number of the task in creation order
+        :return: TaskRecord
+        :raises CorruptSnapshotError: if the description fails its checksum
+        """
+        offset, length, checksum = ENTRY.unpack_from(
+            self._map, self._entries_offset + number * ENTRY.size
+        )
+        description = self._map[offset : offset + length]
+        if zlib.crc32(description) != checksum:
+            raise CorruptSnapshotError(f"task {task_id} of the snapshot is corrupt")
+
+        (eta,) = ETA.unpack_from(self._map, self._etas_offset + number * ETA.size)
+        (status,) = STATUS.unpack_from(
+            self._map, self._numbers_offset + number * STATUS.size
+        )
+        record = TaskRecord(
+            task_id,
+            str(description, "utf-8", "surrogatepass"),
+            EPOCH + eta * MICROSECOND,
+            self.statuses[status],
+        )
+        if self._stamps_offset is None:
+            return record
+
+        created_at, updated_at, version = STAMPS.unpack_from(
+            self._map, self._stamps_offset + number * STAMPS.size
+        )
+        return record._replace(
+            created_at=from_microseconds(created_at),
+            updated_at=from_microseconds(updated_at),
+            version=version,
+        )
+
+
+class SnapshotRecords(MutableMapping):
+    """
+    Tasks by id, as a dict, starting from an indexed snapshot whose tasks are only
+    decoded when first read. Until then, the dict holds the task's number in the
+    snapshot in its place.
+    """
+
+    def __init__(self, snapshot, ids):
+        """
+        :param snapshot: IndexedSnapshot: snapshot the tasks are decoded from
+        :param ids: list: ids of its tasks, in creation order
+        """
+        self.snapshot = snapshot
+        self._records = dict(zip(ids, range(len(ids))))
+
+    def __getitem__(self, task_id):
+        record = self._records[task_id]
+        if record.__class__ is int:
+            record = self._records[task_id] = self.snapshot.record(task_id, record)
+        return record
+
+    def get(self, key, default=None):
+        if key in self._records:
+            return self[key]
+        return default
+
+    def __setitem__(self, task_id, record):
+        self._records[task_id] = record
+
+    def __delitem__(self, task_id):
+        del self._records[task_id]
+
+    def __contains__(self, task_id):
+        return task_id in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def values(self):
+        """Decodes every task, as a list rather than a view"""
+        return [self[task_id] for task_id in self._records]
+
+    def copy(self):
+        """
+        Copies the mapping, sharing the snapshot and the tasks decoded so far
+        :return: SnapshotRecords
+        """
+        copy = SnapshotRecords(self.snapshot, [])
+        copy._records = self._records.copy()  # pylint: disable=protected-access
+        return copy
+
+    def undecoded(self):
+        """
+        Gets the ids of the tasks not decoded yet
+        :return: list: task ids
+        """
+        return [
+            task_id
+            for task_id, record in self._records.items()
+            if record.__class__ is int
+        ]
+
+    def to_dict(self):
+        """
+        Decodes every task left
+        :return: dict: task_id -> TaskRecord
+        """
+        for task_id in self.undecoded():
+            self._records[task_id] = self.snapshot.record(
+                task_id, self._records[task_id]
+            )
+        return self._records
@@ -0,0 +1,347 @@
+"""
+SQLite storage backend for tasks
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from persistence import SYNC
+from records import TaskRecord
+from storage import TaskStorage
+import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    eta TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT,
+    updated_at TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_eta ON tasks (eta, id);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, eta, id);
+CREATE TABLE IF NOT EXISTS store_version (version INTEGER NOT NULL);
+INSERT INTO store_version (version)
+SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM store_version);
+"""
+
+# Columns added to the tasks table since it was first created, for older databases
+ADDED_COLUMNS = {
+    "created_at": "TEXT",
+    "updated_at": "TEXT",
+    "version": "INTEGER NOT NULL DEFAULT 0",
+}
+UPDATED_INDEX = "CREATE INDEX IF NOT EXISTS tasks_updated ON tasks (updated_at, id)"
+
+UPSERT = """
+INSERT INTO tasks (id, description, eta, status, created_at, updated_at, version)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    description = excluded.description, eta = excluded.eta, status = excluded.status,
+    created_at = excluded.created_at, updated_at = excluded.updated_at,
+    version = excluded.version
+"""
+
+COLUMNS = "id, description, eta, status, created_at, updated_at, version"
+
+
+def format_eta(eta):
+    """Fixed width ISO format, so etas stored as text sort chronologically"""
+    return eta.isoformat(timespec="microseconds")
+
+
+def format_time(value):
+    """format_eta for optional times, None stays NULL"""
+    return None if value is None else format_eta(value)
+
+
+def parse_time(value):
+    """Parses an optional time, NULL stays None"""
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def to_record(row):
+    """Builds a TaskRecord from a tasks table row"""
+    task_id, description, eta, status, created_at, updated_at, version = row
+    return TaskRecord(
+        task_id,
+        description,
+        datetime.fromisoformat(eta),
+        status,
+        parse_time(created_at),
+        parse_time(updated_at),
+        version,
+    )
+
+
+class SqliteStorage(TaskStorage):  # pylint: disable=too-many-instance-attributes
+    """
+    Tasks stored in the SQLite database settings.TASK_DATABASE_FILE, in WAL mode with
+    indexes on eta, status and updated_at. Every query reads from the database, so the tasks do
+    not need to fit in memory, and each change only writes the rows it touches.
+    Each thread gets its own connection so that reads run concurrently.
+
+    Every change also bumps the version in the store_version table, which tells
+    refresh about changes made through other processes. Versions bumped through this
+    storage are noted before they are committed, so that a thread refreshing between
+    the commit and the end of the change does not take it for another process's.
+
+    write_lock holds a thread lock and an immediate transaction, which keeps other
+    processes from writing, so no change comes between the reads of a
+    read-modify-write change and its write. The write commits the transaction.
+    """
+
+    def __init__(self):
+        self.path = settings.TASK_DATABASE_FILE
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._version = 0
+        self._own_versions = set()
+        self._version_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self.shared = settings.MULTI_PROCESS
+
+    def _connection(self):
+        """
+        Gets the connection of the calling thread, opening it on first use
+        :return: sqlite3.Connection
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute(
+                "PRAGMA synchronous = "
+                + ("FULL" if settings.PERSISTENCE_MODE == SYNC else "NORMAL")
+            )
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+
+        return connection
+
+    def _query(self, sql, parameters=()):
+        """
+        Runs a query and builds records from its rows
+        :return: list: TaskRecord
+        """
+        return [to_record(x) for x in self._connection().execute(sql, parameters)]
+
+    def load(self):
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(SCHEMA)
+        columns = {x[1] for x in connection.execute("PRAGMA table_info(tasks)")}
+        with connection:
+            for name, definition in ADDED_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(
+                        f"ALTER TABLE tasks ADD COLUMN {name} {definition}"
+                    )
+            connection.execute(UPDATED_INDEX)
+        self._version = self._read_version(connection)
+
+    def save(self):
+        connection = self._connection()
+        _, _, checkpointed_pages = connection.execute(
+            "PRAGMA wal_checkpoint(TRUNCATE)"
+        ).fetchone()
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+
+        return max(checkpointed_pages, 0) * page_size
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @contextmanager
+    def write_lock(self):
+        with self._write_lock:
+            connection = self._connection()
+            if connection.in_transaction:
+                # Nested in another write_lock
+                yield
+                return
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            finally:
+                # Still open if nothing was written or the write failed
+                if connection.in_transaction:
+                    connection.rollback()
+
+    def refresh(self):
+        version = self._read_version(self._connection())
+        with self._version_lock:
+            self._advance(version)
+
+    @staticmethod
+    def _read_version(connection):
+        """Reads the version of the store"""
+        return connection.execute("SELECT version FROM store_version").fetchone()[0]
+
+    @contextmanager
+    def _change(self):
+        """
+        Transaction of a change made through this storage
+        :return: context manager giving the connection and a list _bump_version adds
+            the new version to
+        """
+        versions = []
+        try:
+            with self._connection() as connection:
+                yield connection, versions
+        except BaseException:
+            with self._version_lock:
+                self._own_versions.difference_update(versions)
+            raise
+
+        with self._version_lock:
+            for version in versions:
+                self._advance(version)
+
+    def _bump_version(self, connection, versions):
+        """
+        Bumps the version of the store as part of a change, noting the new version as
+        this storage's own
+        :param connection: sqlite3.Connection: connection in the change's transaction
+        :param versions: list: versions of the change, from _change
+        :return: None
+        """
+        connection.execute("UPDATE store_version SET version = version + 1")
+        version = self._read_version(connection)
+        with self._version_lock:
+            self._own_versions.add(version)
+        versions.append(version)
+
+    def _advance(self, version):
+        """
+        Moves the known version up to a committed version, reporting changes made
+        elsewhere in between: versions that are not this storage's own. Hold the
+        version lock.
+        :param version: int: committed version
+        :return: None
+        """
+        if version <= self._version:
+            return
+
+        passed = range(self._version + 1, version + 1)
+        if len(passed) > len(self._own_versions) or not self._own_versions.issuperset(
+            passed
+        ):
+            self._notify_external_change(None)
+        self._own_versions = {x for x in self._own_versions if x > version}
+        self._version = version
+
+    def get(self, task_id):
+        records = self._query(f"SELECT {COLUMNS} FROM tasks WHERE id = ?", (task_id,))
+        return records[0] if records else None
+
+    def all(self):
+        return self._query(f"SELECT {COLUMNS} FROM tasks ORDER BY rowid")
+
+    def put(self, records):
+        if not records:
+            return
+
+        with self._change() as (connection, versions):
+            connection.executemany(
+                UPSERT,
+                [
+                    (
+                        x.task_id,
+                        x.description,
+                        format_eta(x.eta),
+                        x.status,
+                        format_time(x.created_at),
+                        format_time(x.updated_at),
+                        x.version,
+                    )
+                    for x in records
+                ],
+            )
+            self._bump_version(connection, versions)
+
+    def delete(self, task_ids):
+        deleted_ids = []
+        with self._change() as (connection, versions):
+            for task_id in task_ids:
+                cursor = connection.execute(
+                    "DELETE FROM tasks WHERE id = ?", (task_id,)
+                )
+                if cursor.rowcount:
+                    deleted_ids.append(task_id)
+            if deleted_ids:
+                self._bump_version(connection, versions)
+
+        return deleted_ids
+
+    def range_by_eta(
+        self, start=None, end=None, status=None, after=None, limit=None
+    ):  # pylint: disable=too-many-arguments
+        where, parameters = self._eta_conditions(start, end, status, after)
+
+        sql = f"SELECT {COLUMNS} FROM tasks{where} ORDER BY eta, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+
+        return self._query(sql, parameters)
+
+    @staticmethod
+    def _eta_conditions(start=None, end=None, status=None, after=None):
+        """
+        Builds the WHERE clause of range_by_eta and count_by_eta
+        :return: tuple: SQL clause, empty if there are no conditions, and its parameters
+        """
+        conditions = []
+        parameters = []
+        if status is not None:
+            conditions.append("status = ?")
+            parameters.append(status)
+        if start is not None:
+            conditions.append("eta >= ?")
+            parameters.append(format_eta(start))
+        if end is not None:
+            conditions.append("eta <= ?")
+            parameters.append(format_eta(end))
+        if after is not None:
+            conditions.append("(eta, id) > (?, ?)")
+            parameters.extend((format_eta(after[0]), after[1]))
+
+        if not conditions:
+            return "", parameters
+        return " WHERE " + " AND ".join(conditions), parameters
+
+    def range_by_update(self, start):
+        return self._query(
+            f"SELECT {COLUMNS} FROM tasks WHERE updated_at >= ? ORDER BY updated_at, id",
+            (format_eta(start),),
+        )
+
+    def count_by_eta(self, start=None, end=None, status=None):
+        sql, parameters = self._eta_conditions(start, end, status)
+        return (
+            self._connection()
+            .execute(f"SELECT COUNT(*) FROM tasks{sql}", parameters)
+            .fetchone()[0]
+        )
+
+    def filter_by_status(self, status):
+        return self._query(
+            f"SELECT {COLUMNS} FROM tasks WHERE status = ? ORDER BY rowid", (status,)
+        )
+
+    def count_by_status(self):
+        return dict(
+            self._connection().execute(
+                "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+            )
+        )
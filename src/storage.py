@@ -0,0 +1,614 @@
+"""
+Storage backends for tasks
+"""
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from changes import CREATED, DELETED, UPDATED
+from indexes import EtaIndex, StatusIndex, UpdateIndex
+from journal import Journal, remove_file, write_snapshot
+from locks import ReadWriteLock, StoreLock
+from persistence import JournalWriter, SYNC
+from records import TaskRecord
+from snapshot import (
+    CorruptSnapshotError,
+    IndexedSnapshot,
+    SnapshotRecords,
+    prepare_snapshot,
+    read_snapshot,
+)
+import settings
+
+# Number of tasks the warm-up thread decodes each time it takes the lock
+WARM_UP_BATCH = 1000
+
+
+class TaskStorage(ABC):
+    """
+    Interface of task storage backends. Backends store TaskRecords and are
+    responsible for persisting every change they are given.
+    """
+
+    # Called with (operation, task_id) pairs of the changes made outside this storage
+    # (e.g. by another process) when refresh picks them up, operations as in
+    # changes.py, or with None if any task may have changed
+    change_listener = None
+
+    # Whether other processes share the store, with settings.MULTI_PROCESS
+    shared = False
+
+    @abstractmethod
+    def load(self):
+        """
+        Loads the stored tasks, replacing anything held in memory
+        :return: None
+        """
+
+    @abstractmethod
+    def save(self):
+        """
+        Brings the on-disk copy of the store into its compact form
+        :return: int: number of bytes written
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Persists outstanding changes and releases files and threads
+        :return: None
+        """
+
+    def write_lock(self):
+        """
+        Context manager for read-modify-write changes that must not interleave with
+        changes by other processes. Backends without such a risk need no lock.
+        :return: context manager
+        """
+        return nullcontext()
+
+    def refresh(self):
+        """
+        Picks up changes made outside this storage and reports them to the
+        change_listener. Backends only changed through themselves have none.
+        :return: None
+        """
+
+    def _notify_external_change(self, changes):
+        """
+        Reports tasks changed outside this storage to the change_listener
+        :param changes: list: (operation, task_id) pairs, None if any task may have
+            changed
+        :return: None
+        """
+        if self.change_listener is not None:
+            self.change_listener(changes)
+
+    @abstractmethod
+    def get(self, task_id):
+        """
+        Gets a task by id
+        :param task_id: id of the task
+        :return: TaskRecord or None if there is no such task
+        """
+
+    @abstractmethod
+    def all(self):
+        """
+        Gets every task, in the order they were created
+        :return: list: TaskRecord
+        """
+
+    @abstractmethod
+    def put(self, records):
+        """
+        Stores records, replacing tasks with the same ids, as one atomic change
+        :param records: list: TaskRecord
+        :return: None
+        """
+
+    @abstractmethod
+    def delete(self, task_ids):
+        """
+        Deletes tasks as one atomic change, ignoring ids with no task
+        :param task_ids: list: ids of the tasks to delete
+        :return: list: ids of the tasks that were deleted
+        """
+
+    @abstractmethod
+    def range_by_eta(
+        self, start=None, end=None, status=None, after=None, limit=None
+    ):  # pylint: disable=too-many-arguments
+        """
+        Gets tasks with start <= eta <= end, ordered by (eta, task_id)
+        :param start: datetime: lower bound, unbounded if None
+        :param end: datetime: upper bound, unbounded if None
+        :param status: str: only return tasks with this status
+        :param after: tuple: only return tasks whose (eta, task_id) sorts after this
+        :param limit: int: maximum number of tasks, unlimited if None
+        :return: list: TaskRecord
+        """
+
+    @abstractmethod
+    def range_by_update(self, start):
+        """
+        Gets tasks updated at or after start, ordered by (updated_at, task_id).
+        Tasks without an updated_at are left out.
+        :param start: datetime: earliest updated_at
+        :return: list: TaskRecord
+        """
+
+    def count_by_eta(self, start=None, end=None, status=None):
+        """
+        Counts tasks with start <= eta <= end
+        :param start: datetime: lower bound, unbounded if None
+        :param end: datetime: upper bound, unbounded if None
+        :param status: str: only count tasks with this status
+        :return: int: number of tasks
+        """
+        return len(self.range_by_eta(start, end, status))
+
+    @abstractmethod
+    def filter_by_status(self, status):
+        """
+        Gets the tasks with a status, in the order they were created
+        :param status: str: status to filter by
+        :return: list: TaskRecord
+        """
+
+    def count_by_status(self):
+        """
+        Counts tasks by status
+        :return: dict: number of tasks per status that has any
+        """
+        return dict(Counter(record.status for record in self.all()))
+
+
+class PickleStorage(TaskStorage):  # pylint: disable=too-many-instance-attributes
+    """
+    Tasks held in memory with eta and status indexes, persisted as a pickled
+    snapshot in settings.TASK_DATA_FILE plus a journal of changes since it.
+
+    Threads share the tasks under a ReadWriteLock: reads run in parallel and
+    changes one at a time. Snapshots are copied under the lock but pickled and
+    written without it, and only the journal records they cover are dropped.
+
+    Indexed snapshots (see snapshot.py) are memory-mapped at load, building the
+    indexes from their index sections alone. Tasks are decoded when first read, and
+    by a warm-up thread with settings.SNAPSHOT_WARM_UP.
+
+    With settings.MULTI_PROCESS, several processes can share the files: writes hold
+    an exclusive lock on settings.TASK_LOCK_FILE, and before each read a process
+    checks the journal size and mtime, replaying only the records other processes
+    appended since its last look, or reloading if the journal was compacted.
+    """
+
+    def __init__(self):
+        if settings.MULTI_PROCESS and settings.PERSISTENCE_MODE != SYNC:
+            raise ValueError("MULTI_PROCESS needs PERSISTENCE_MODE = 'sync'")
+
+        self.records = {}
+        self._eta_index = EtaIndex()
+        self._status_index = StatusIndex()
+        self._update_index = UpdateIndex()
+        self._journal = Journal(settings.TASK_JOURNAL_FILE)
+        self._writer = JournalWriter(
+            self._journal,
+            settings.PERSISTENCE_MODE,
+            settings.FLUSH_INTERVAL,
+            settings.FLUSH_MAX_PENDING,
+        )
+
+        self._lock = ReadWriteLock()
+        self._save_lock = threading.Lock()
+        self._warm_up_thread = None
+        self._closed = threading.Event()
+        self._store_lock = None
+        self._generation = 0
+        self._journal_offset = 0
+        self._journal_state = None
+        if settings.MULTI_PROCESS:
+            self._store_lock = StoreLock(settings.TASK_LOCK_FILE)
+            self.shared = True
+
+    def load(self):
+        with self._lock.write(), self._exclusive_lock():
+            self._load()
+
+    def _load(self):
+        """
+        Loads the snapshot and replays the journal, hold the lock while calling this
+        :return: None
+        """
+        try:
+            snapshot = read_snapshot(settings.TASK_DATA_FILE)
+        except FileNotFoundError:
+            snapshot = {}
+            write_snapshot(settings.TASK_DATA_FILE, snapshot)
+        self._load_snapshot(snapshot)
+
+        with self._writer.lock:
+            self._writer.flush()
+            # Another process may have replaced the journal the handle appends to
+            self._journal.close()
+            entries = self._journal.replay()
+        self._apply(
+            [
+                (operation, task_id, record and as_record(task_id, record))
+                for operation, task_id, record in entries
+            ]
+        )
+
+        if isinstance(self.records, SnapshotRecords) and settings.SNAPSHOT_WARM_UP:
+            self._warm_up_thread = threading.Thread(
+                target=self._warm_up,
+                args=(self.records,),
+                name="snapshot-warm-up",
+                daemon=True,
+            )
+            self._warm_up_thread.start()
+
+        if self._store_lock is not None:
+            self._generation = self._store_lock.read_generation()
+            self._journal_state = self._stat_journal()
+            self._journal_offset = self._journal_state[0] if self._journal_state else 0
+
+    def _load_snapshot(self, snapshot):
+        """
+        Replaces the tasks held in memory and their indexes with a snapshot's
+        :param snapshot: IndexedSnapshot, or dict of the tasks of a pickled snapshot
+        :return: None
+        """
+        if isinstance(snapshot, IndexedSnapshot):
+            ids, ids_by_status, eta_keys, updated_keys = snapshot.read_index()
+            self.records = SnapshotRecords(snapshot, ids)
+            self._eta_index.load(eta_keys)
+            self._status_index.load(ids_by_status)
+            self._update_index.load(updated_keys)
+        else:
+            self.records = {
+                task_id: as_record(task_id, record)
+                for task_id, record in snapshot.items()
+            }
+            self._eta_index.rebuild(self.records)
+            self._status_index.rebuild(self.records)
+            self._update_index.rebuild(self.records)
+
+    def save(self):
+        """
+        Saves a snapshot of all tasks and drops the journal records it covers
+        :return: int: size of the snapshot in bytes, 0 if another process saved one
+            while this one was being written
+        """
+        with self._save_lock:
+            return self._save()
+
+    def _save(self):
+        """
+        Saves a snapshot, hold the save lock while calling this
+        :return: int: size of the snapshot in bytes
+        """
+        with self._write_locked(), self._writer.lock:
+            # Queued changes made before the copy must be in the journal it covers
+            self._writer.flush()
+            records = self.records.copy()
+            journal_size = self._journal.size()
+            record_count = self._journal.record_count
+            generation = self._generation
+
+        # Records are immutable, so the copy is pickled without holding the lock
+        temp_path, size = prepare_snapshot(settings.TASK_DATA_FILE, records)
+
+        with self._write_locked(), self._writer.lock:
+            if self._generation != generation:
+                # Another process compacted the journal, its snapshot is newer
+                remove_file(temp_path)
+                return 0
+
+            self._writer.flush()
+            os.replace(temp_path, settings.TASK_DATA_FILE)
+            self._journal.discard_before(journal_size, record_count)
+
+            if self._store_lock is not None:
+                self._generation += 1
+                self._store_lock.write_generation(self._generation)
+
+        return size
+
+    def close(self):
+        self._closed.set()
+        if self._warm_up_thread is not None:
+            self._warm_up_thread.join()
+        self._writer.close()
+        if self._store_lock is not None:
+            self._store_lock.close()
+
+    @contextmanager
+    def write_lock(self):
+        with self._write_locked():
+            yield
+
+        # Compact once the outermost change is done, not while holding the lock
+        if (
+            not self._lock.is_writing()
+            and self._journal.record_count >= settings.JOURNAL_COMPACT_THRESHOLD
+            and self._save_lock.acquire(blocking=False)
+        ):
+            try:
+                self._save()
+            finally:
+                self._save_lock.release()
+
+    @contextmanager
+    def _write_locked(self):
+        """
+        Holds the locks of a change, after catching up with other processes
+        :return: context manager
+        """
+        with self._lock.write():
+            if self._store_lock is None:
+                yield
+                return
+
+            with self._store_lock.exclusive():
+                self._refresh_locked()
+                yield
+                # Only this process wrote to the journal while holding the lock
+                self._journal_state = self._stat_journal()
+                self._journal_offset = (
+                    self._journal_state[0] if self._journal_state else 0
+                )
+
+    def _warm_up(self, records):
+        """
+        Decodes the tasks of a loaded snapshot a batch at a time, then swaps them in
+        as a plain dict. Stops if the storage is closed or loads again meanwhile.
+        :param records: SnapshotRecords: tasks as loaded
+        :return: None
+        """
+        with self._lock.read():
+            task_ids = records.undecoded()
+
+        try:
+            for start in range(0, len(task_ids), WARM_UP_BATCH):
+                with self._lock.read():
+                    if self._closed.is_set() or self.records is not records:
+                        return
+                    for task_id in task_ids[start : start + WARM_UP_BATCH]:
+                        records.get(task_id)
+
+            with self._lock.write():
+                if self.records is records:
+                    self.records = records.to_dict()
+        except CorruptSnapshotError as corrupt_snapshot:
+            logging.error("error warming up the snapshot -- %s", corrupt_snapshot)
+
+    def _exclusive_lock(self):
+        """The exclusive store lock in multi-process mode, otherwise no lock"""
+        if self._store_lock is None:
+            return nullcontext()
+        return self._store_lock.exclusive()
+
+    def refresh(self):
+        if self._store_lock is None or self._stat_journal() == self._journal_state:
+            return
+
+        with self._lock.write(), self._store_lock.shared():
+            self._refresh_locked()
+
+    def _reading(self):
+        """
+        Holds the lock for reading, after picking up changes by other processes
+        :return: context manager
+        """
+        self.refresh()
+        return self._lock.read()
+
+    def _refresh_locked(self):
+        """
+        Refreshes from the journal, hold the lock while calling this
+        :return: None
+        """
+        journal_state = self._stat_journal()
+        if journal_state == self._journal_state:
+            return
+
+        if (
+            self._store_lock.read_generation() != self._generation
+            or journal_state is None
+            or journal_state[0] < self._journal_offset
+        ):
+            self._load()
+            self._notify_external_change(None)
+            return
+
+        entries, self._journal_offset = self._journal.read_from(self._journal_offset)
+        changes = self._describe_entries(entries)
+        self._apply(entries)
+        self._journal_state = journal_state
+        if changes:
+            self._notify_external_change(changes)
+
+    def _describe_entries(self, entries):
+        """
+        Tells what journal entries not applied yet do to the tasks in memory
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: list: (operation, task_id) pairs, CREATED, UPDATED or DELETED
+        """
+        changes = []
+        # Whether each task exists after the entries described so far
+        exists = {}
+        for operation, task_id, _ in entries:
+            if operation == "put":
+                existed = exists.get(task_id, task_id in self.records)
+                changes.append((UPDATED if existed else CREATED, task_id))
+            else:
+                changes.append((DELETED, task_id))
+            exists[task_id] = operation == "put"
+
+        return changes
+
+    def _stat_journal(self):
+        """
+        Cheap change check of the journal file
+        :return: tuple: size and modification time, None if there is no journal
+        """
+        try:
+            stat = os.stat(settings.TASK_JOURNAL_FILE)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, task_id):
+        with self._reading():
+            return self.records.get(task_id)
+
+    def all(self):
+        with self._reading():
+            return list(self.records.values())
+
+    def put(self, records):
+        with self.write_lock():
+            ticket = self._change([("put", x.task_id, x) for x in records])
+
+        # Waiting without the lock lets concurrent changes share a group commit
+        self._writer.wait(ticket)
+
+    def delete(self, task_ids):
+        with self.write_lock():
+            deleted_ids = [x for x in task_ids if x in self.records]
+            ticket = self._change(
+                [("delete", x, None) for x in dict.fromkeys(deleted_ids)]
+            )
+
+        self._writer.wait(ticket)
+
+        return deleted_ids
+
+    def _change(self, entries):
+        """
+        Queues changes for the journal as set by settings.PERSISTENCE_MODE, then
+        applies them, so changes the journal refused in sync mode are not kept in
+        memory. Hold the write lock while calling this. write_lock
+        compacts the journal into a snapshot when it grows past
+        settings.JOURNAL_COMPACT_THRESHOLD records.
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: int: ticket to wait for the changes to reach disk with, None if
+            there are no changes
+        """
+        if not entries:
+            return None
+
+        ticket = self._writer.queue(entries)
+        self._apply(entries)
+        return ticket
+
+    def _apply(self, entries):
+        """
+        Applies journal entries to the tasks held in memory
+        :param entries: list: ``(operation, task_id, task)`` tuples
+        :return: None
+        """
+        for operation, task_id, record in entries:
+            previous_record = self.records.get(task_id)
+            if previous_record is not None:
+                self._unindex(previous_record)
+
+            if operation == "put":
+                self.records[task_id] = record
+                self._eta_index.add(record.eta, task_id)
+                self._status_index.add(record.status, task_id)
+                if record.updated_at is not None:
+                    self._update_index.add(record.updated_at, task_id)
+            elif previous_record is not None:
+                del self.records[task_id]
+
+    def range_by_eta(
+        self, start=None, end=None, status=None, after=None, limit=None
+    ):  # pylint: disable=too-many-arguments
+        with self._reading():
+            return self._range_by_eta(start, end, status, after, limit)
+
+    def _range_by_eta(
+        self, start, end, status, after, limit
+    ):  # pylint: disable=too-many-arguments
+        """range_by_eta, hold the lock for reading while calling this"""
+        if status is None:
+            keys = self._eta_index.page(after, start, end, limit)
+            return [self.records[task_id] for _, task_id in keys]
+
+        status_ids = self._status_index.ids(status)
+
+        # Walk whichever of the status and eta indexes holds fewer tasks
+        if len(status_ids) < self._eta_index.count(start, end):
+            matches = sorted(
+                (
+                    record
+                    for record in map(self.records.__getitem__, status_ids)
+                    if (start is None or start <= record.eta)
+                    and (end is None or record.eta <= end)
+                    and (after is None or record.eta_key > after)
+                ),
+                key=lambda record: record.eta_key,
+            )
+            return matches[:limit]
+
+        matches = []
+        while True:
+            keys = self._eta_index.page(after, start, end, limit)
+            for _, task_id in keys:
+                if task_id in status_ids:
+                    matches.append(self.records[task_id])
+                    if len(matches) == limit:
+                        return matches
+
+            if limit is None or len(keys) < limit:
+                return matches
+            after = keys[-1]
+
+    def range_by_update(self, start):
+        with self._reading():
+            return [self.records[x] for x in self._update_index.range(start)]
+
+    def count_by_eta(self, start=None, end=None, status=None):
+        if status is not None:
+            return super().count_by_eta(start, end, status)
+
+        with self._reading():
+            return self._eta_index.count(start, end)
+
+    def filter_by_status(self, status):
+        with self._reading():
+            return [self.records[x] for x in self._status_index.ids(status)]
+
+    def count_by_status(self):
+        with self._reading():
+            return self._status_index.counts()
+
+    def _unindex(self, record):
+        """
+        Removes a task record from the indexes
+        :param record: TaskRecord: task as it was indexed
+        :return: None
+        """
+        self._eta_index.remove(record.eta, record.task_id)
+        self._status_index.remove(record.status, record.task_id)
+        if record.updated_at is not None:
+            self._update_index.remove(record.updated_at, record.task_id)
+
+
+def as_record(task_id, record):
+    """
+    Converts stored tasks to TaskRecords, as stores written before tasks became
+    TaskRecords hold plain dicts
+    :param task_id: id of the task
+    :param record: TaskRecord or dict: stored task
+    :return: TaskRecord
+    """
+    if isinstance(record, TaskRecord):
+        return record
+    return TaskRecord.from_dict(task_id, record)
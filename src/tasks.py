@@ -1,61 +1,105 @@
 """
 tasks functionality
 """
-import copy
+import atexit
+import heapq
 import logging
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
-import pickle
-from functools import wraps
 
-from schema import Schema, SchemaMissingKeyError, SchemaWrongKeyError, Optional, Use
+from schema import (
+    Schema,
+    SchemaError,
+    SchemaMissingKeyError,
+    SchemaWrongKeyError,
+    Optional,
+    Use,
+)
+from archive import Archive
+from records import TaskRecord
+from changes import (  # pylint: disable=unused-import
+    ARCHIVED,
+    COMPLETED,
+    CREATED,
+    DELETED,
+    UPDATED,
+    ChangeLog,
+    ChangesUnavailableError,
+    ResyncRequiredError,
+)
+import metrics
+from search import InvalidSearchError, SearchIndex  # pylint: disable=unused-import
+from storage import PickleStorage
+from columnar_storage import ColumnarStorage
+from sqlite_storage import SqliteStorage
 import settings
 
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
-
-def deep_copy_params_method(func):
-    """Decorator to copy input and output parameters"""
+class Status(Enum):
+    """Enum for Statuses"""
 
-    @wraps(func)
-    def decorated_method(self, *args, **kwargs):
-        # Create deep copies of input parameters
-        copied_args = copy.deepcopy(args)
-        copied_kwargs = copy.deepcopy(kwargs)
+    OPEN = "OPEN"
+    DONE = "DONE"
+    CANCELLED = "CANCELLED"
 
-        # Invoke the original function with copied parameters
-        result = func(self, *copied_args, **copied_kwargs)
 
-        # Create a deep copy of the result
-        copied_result = copy.deepcopy(result)
+# Statuses tasks are archived in once they are old enough
+TERMINAL_STATUSES = (Status.DONE.value, Status.CANCELLED.value)
 
-        # Return the deep copied result
-        return copied_result
+# Keys set by Tasks, accepted in tasks sent back as they were read but ignored
+STAMP_KEYS = ("created_at", "updated_at", "version")
 
-    return decorated_method
+TASK_SCHEMA = Schema(
+    {
+        "description": str,
+        "eta": datetime,
+        "status": str,
+        Optional("_id"): Use(str),
+        **{Optional(key): object for key in STAMP_KEYS},
+    }
+)
 
+_REQUIRED_TASK_KEYS = frozenset(("description", "eta", "status"))
+_ALLOWED_TASK_KEYS = _REQUIRED_TASK_KEYS | {"_id", *STAMP_KEYS}
+_STATUS_VALUES = frozenset(status.value for status in Status)
 
-class Status(Enum):
-    """Enum for Statuses"""
 
-    OPEN = "OPEN"
-    DONE = "DONE"
-    CANCELLED = "CANCELLED"
+def _is_valid_task_shape(task):
+    """
+    Plain type checks for the shape of a valid task, without building any error
+    :param task: dict: The task to check.
+    :return: bool: True if TASK_SCHEMA and Status would accept the task
+    """
+    if not isinstance(task, dict) or not (
+        _REQUIRED_TASK_KEYS <= task.keys() <= _ALLOWED_TASK_KEYS
+    ):
+        return False
+
+    status = task["status"]
+    return (
+        isinstance(task["description"], str)
+        and isinstance(task["eta"], datetime)
+        and isinstance(status, str)
+        and status in _STATUS_VALUES
+        and isinstance(task.get("_id", ""), str)
+    )
 
 
 def validate_task(task):
     """
     Accepts and validates a task.
+    Valid tasks are accepted by plain type checks, only tasks failing them go through
+    TASK_SCHEMA so that errors are the same schema errors as before.
     :param task: dict: The task to be accepted.
     :return: Task being passed
     """
-    schema = Schema(
-        {"description": str, "eta": datetime, "status": str, Optional("_id"): Use(str)}
-    )
-    schema.validate(task)
+    if _is_valid_task_shape(task):
+        return task
+
+    TASK_SCHEMA.validate(task)
     Status(task["status"])
 
     return task
@@ -66,14 +110,190 @@ class InvalidTaskError(Exception):
     """Exception for invalid task."""
 
 
-class Tasks:
-    """Class for tasks management."""
+class VersionConflictError(Exception):
+    """Exception for a change to a task that is no longer at the expected version."""
+
+
+class InvalidBatchError(InvalidTaskError):
+    """Exception for a batch of tasks containing invalid tasks."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid task(s) in batch")
+        self.errors = errors
+
+
+STORAGE_BACKENDS = {
+    "pickle": PickleStorage,
+    "columnar": ColumnarStorage,
+    "sqlite": SqliteStorage,
+}
+
+STORE_OPERATION_SECONDS = metrics.REGISTRY.register(
+    metrics.Histogram(
+        "task_master_store_operation_seconds",
+        "Duration of loading and saving the task store",
+        ("operation",),
+    )
+)
+SAVED_BYTES = metrics.REGISTRY.register(
+    metrics.Counter("task_master_saved_bytes_total", "Bytes written by save_tasks")
+)
+
+
+# Seconds between the checks for other processes' changes of a waiting get_changes
+CHANGES_REFRESH_INTERVAL = 1.0
+
+
+class Tasks:  # pylint: disable=too-many-public-methods,too-many-instance-attributes
+    """
+    Class for tasks management.
+
+    Every change bumps a version counter, kept for the whole store and per task, so
+    that clients can tell whether anything changed since they last read. Versions
+    are only kept in memory, with an epoch that is new for each load so that they
+    never repeat across restarts. Change listeners are told about every change, and
+    the latest changes are kept in a change log for clients to sync from.
+
+    DONE and CANCELLED tasks are moved to an archive once they are old enough, by a
+    thread of their own. Archived tasks are found by id, and listed on request, and
+    any change to one brings it back into the store.
+    """
 
     def __init__(self):
-        self._task_list = {}
+        self._storage = STORAGE_BACKENDS[settings.STORAGE_BACKEND]()
+        self._storage.change_listener = self._on_external_change
+        self._version_lock = threading.Lock()
+        self._epoch = None
+        self._version = 0
+        self._task_versions = {}
+        self._change_log = ChangeLog(settings.CHANGE_LOG_SIZE)
+        self._change_listeners = []
+        self._search_index = SearchIndex(self._storage)
+        self.add_change_listener(self._search_index.changed)
+        self._archive = Archive(settings.ARCHIVE_FILE)
         self.load_tasks()
 
-    @deep_copy_params_method
+        self._closed = threading.Event()
+        self._archiver = None
+        if settings.ARCHIVE_AFTER_DAYS is not None:
+            self._archiver = threading.Thread(
+                target=self._archive_periodically, name="archiver", daemon=True
+            )
+            self._archiver.start()
+        atexit.register(self.close)
+
+    def add_change_listener(self, listener):
+        """
+        Registers a function called after every change, with the ids of the changed
+        tasks, or with None when any task may have changed (e.g. on load).
+        :param listener: callable
+        :return: None
+        """
+        self._change_listeners.append(listener)
+
+    def get_version(self):
+        """
+        Gets the version of the store, which changes with every change to any task
+        :return: str: version
+        """
+        self._storage.refresh()
+        with self._version_lock:
+            return f"{self._epoch}.{self._version}"
+
+    def get_task_version(self, task_id):
+        """
+        Gets the version of a task, which changes with every change to the task
+        :param task_id: id of the task
+        :return: str: version
+        """
+        self._storage.refresh()
+        with self._version_lock:
+            version = self._task_versions.get(task_id)
+            if version is not None:
+                return f"{self._epoch}.{version}"
+
+        # Tasks unchanged since the load are at version 0. Missing tasks are at the
+        # store version, so a deleted task is never at a version it had before.
+        exists = self._get_record(task_id) is not None
+        with self._version_lock:
+            version = self._task_versions.get(task_id, 0 if exists else self._version)
+            return f"{self._epoch}.{version}"
+
+    def _reset_versions(self):
+        """
+        Starts a new epoch of versions, for when any task may have changed
+        :return: None
+        """
+        with self._version_lock:
+            self._epoch = uuid.uuid4().hex[:12]
+            self._version = 0
+            self._task_versions = {}
+            self._change_log.reset(self._epoch)
+
+        for listener in self._change_listeners:
+            listener(None)
+
+    def _bump_versions(
+        self,
+        changed_ids=(),
+        deleted_ids=(),
+        operation=UPDATED,
+        created_ids=(),
+        archived_ids=(),
+    ):  # pylint: disable=too-many-arguments
+        """
+        Bumps the store version and the versions of changed tasks, logs the changes
+        and tells the change listeners. Called once the change is stored, so a
+        version is never seen before the change it covers.
+        :param changed_ids: ids of updated tasks
+        :param deleted_ids: ids of deleted tasks
+        :param operation: str: what was done to the changed tasks, UPDATED or COMPLETED
+        :param created_ids: ids of created tasks
+        :param archived_ids: ids of tasks moved to the archive
+        :return: None
+        """
+        with self._version_lock:
+            self._version += 1
+            # Archived tasks are still found, so they keep a version of their own
+            for task_id in (*changed_ids, *created_ids, *archived_ids):
+                self._task_versions[task_id] = self._version
+            for task_id in deleted_ids:
+                self._task_versions.pop(task_id, None)
+
+            self._change_log.append(self._version, CREATED, created_ids)
+            self._change_log.append(self._version, operation, changed_ids)
+            self._change_log.append(self._version, DELETED, deleted_ids)
+            self._change_log.append(self._version, ARCHIVED, archived_ids)
+
+        task_ids = [*created_ids, *changed_ids, *deleted_ids, *archived_ids]
+        for listener in self._change_listeners:
+            listener(task_ids)
+
+    def _on_external_change(self, changes):
+        """
+        Bumps versions for changes the storage picked up from elsewhere
+        :param changes: list: (operation, task_id) pairs, None if any task may have
+            changed
+        :return: None
+        """
+        if changes is None:
+            self._reset_versions()
+            return
+
+        task_ids = {CREATED: [], UPDATED: [], DELETED: [], ARCHIVED: []}
+        for operation, task_id in changes:
+            # Tasks archived by another process were appended to the archive first
+            if operation == DELETED and task_id in self._archive:
+                operation = ARCHIVED
+            task_ids[operation].append(task_id)
+
+        self._bump_versions(
+            task_ids[UPDATED],
+            task_ids[DELETED],
+            created_ids=task_ids[CREATED],
+            archived_ids=task_ids[ARCHIVED],
+        )
+
     def post_task(self, task):
         """
         Posts a given task to the task list
@@ -93,36 +313,324 @@ class Tasks:
             )
             raise InvalidTaskError(wrong_status) from wrong_status
 
-        uid = str(uuid.uuid4())
-        task["_id"] = uid
-        self._task_list[uid] = task
-
-        self.save_tasks()
+        record = TaskRecord.from_dict(str(uuid.uuid4()), task).stamp(
+            None, datetime.now()
+        )
+        self._storage.put([record])
+        self._bump_versions(created_ids=[record.task_id])
 
-        return task
+        return record.to_dict()
 
-    @deep_copy_params_method
-    def get_tasks(self, task_id=None):
+    def get_tasks(self, task_id=None, status=None, include_archived=False):
         """
         Gets a list of tasks that match filter criteria, returning all if criteria is None.
+        A task asked for by id is also looked for in the archive.
+        :param task_id: id of the task to get
+        :param status: str: only return tasks with this status
+        :param include_archived: bool: list archived tasks too, after the others
         :return: list: tasks
         """
-        if task_id is None:
-            return list(self._task_list.values())
+        return [
+            x.to_dict()
+            for x in self.get_task_records(task_id, status, include_archived)
+        ]
+
+    def get_task_records(self, task_id=None, status=None, include_archived=False):
+        """
+        Same as get_tasks, returning the shared immutable records.
+        :return: list: TaskRecord
+        """
+        if task_id is not None:
+            record = self._get_record(task_id)
+            if record is None or status not in (None, record.status):
+                return []
+            return [record]
+
+        if status is None:
+            records = self._storage.all()
+        else:
+            records = self._storage.filter_by_status(self._checked_status(status))
+
+        if include_archived:
+            records = [*records, *self._archive.all(status)]
+        return records
+
+    def _get_record(self, task_id):
+        """
+        Gets a task by id from the store, or from the archive if it is archived
+        :param task_id: id of the task
+        :return: TaskRecord or None if there is no such task
+        """
+        record = self._storage.get(task_id)
 
-        return [x for x in [self._task_list.get(task_id)] if x is not None]
+        return self._archive.get(task_id) if record is None else record
 
-    @deep_copy_params_method
-    def get_due_tasks(self, due_date=None):
+    def get_due_tasks(
+        self, due_date=None, from_date=None, status=None, include_archived=False
+    ):
         """
-        Gets a list of tasks that are due to be completed.
+        Gets a list of tasks that are due to be completed, ordered by eta.
         :param: due_date: Datetime.datetime: Due date for tasks, defaults to today
+        :param: from_date: Datetime.datetime: Earliest eta to include, defaults to no limit
+        :param: status: str: only return tasks with this status
+        :param include_archived: bool: include archived tasks
+        :return: list: tasks matching criteria
+        """
+        return [
+            x.to_dict()
+            for x in self.get_due_task_records(
+                due_date, from_date, status, include_archived
+            )
+        ]
+
+    def get_due_task_records(
+        self, due_date=None, from_date=None, status=None, include_archived=False
+    ):
+        """
+        Same as get_due_tasks, returning the shared immutable records.
+        :return: list: TaskRecord
+        """
+        if due_date is None:
+            due_date = datetime.now()
+
+        records = self._storage.range_by_eta(
+            from_date, due_date, self._checked_status(status)
+        )
+        if not include_archived:
+            return records
+
+        archived = sorted(
+            self._get_archived_due(due_date, from_date, status),
+            key=lambda record: record.eta_key,
+        )
+        return list(heapq.merge(records, archived, key=lambda record: record.eta_key))
+
+    def _get_archived_due(self, due_date, from_date, status):
+        """
+        Gets the archived tasks with from_date <= eta <= due_date, unordered
+        :return: list: TaskRecord
+        """
+        return [
+            record
+            for record in self._archive.all(status)
+            if record.eta <= due_date and (from_date is None or record.eta >= from_date)
+        ]
+
+    def get_modified_tasks(
+        self, modified_since, due_date=None, from_date=None, status=None
+    ):
+        """
+        Gets the tasks created or updated at or after a time, ordered by updated_at.
+        Deleted tasks are not listed, and neither are tasks stored before tasks were
+        stamped with updated_at.
+        :param modified_since: Datetime.datetime: earliest updated_at to include
+        :param: due_date: Datetime.datetime: Latest eta to include, defaults to no limit
+        :param: from_date: Datetime.datetime: Earliest eta to include, defaults to no limit
+        :param: status: str: only return tasks with this status
+        :return: list: tasks matching criteria
+        """
+        return [
+            x.to_dict()
+            for x in self.get_modified_task_records(
+                modified_since, due_date, from_date, status
+            )
+        ]
+
+    def get_modified_task_records(
+        self, modified_since, due_date=None, from_date=None, status=None
+    ):
+        """
+        Same as get_modified_tasks, returning the shared immutable records.
+        :return: list: TaskRecord
+        """
+        status = self._checked_status(status)
+
+        return [
+            record
+            for record in self._storage.range_by_update(modified_since)
+            if status in (None, record.status)
+            and (from_date is None or record.eta >= from_date)
+            and (due_date is None or record.eta <= due_date)
+        ]
+
+    def search_tasks(self, query, due_date=None, from_date=None, status=None):
+        """
+        Searches task descriptions for words, ordered by eta.
+        :param query: str: words that must all be in the description, a word ending
+            with * matches any word starting with it
+        :param: due_date: Datetime.datetime: Latest eta to include, defaults to no limit
+        :param: from_date: Datetime.datetime: Earliest eta to include, defaults to no limit
+        :param: status: str: only return tasks with this status
         :return: list: tasks matching criteria
         """
+        return [
+            x.to_dict()
+            for x in self.search_task_records(query, due_date, from_date, status)
+        ]
+
+    def search_task_records(self, query, due_date=None, from_date=None, status=None):
+        """
+        Same as search_tasks, returning the shared immutable records.
+        :return: list: TaskRecord
+        :raises InvalidSearchError: if the query has no word
+        """
+        status = self._checked_status(status)
+        self._storage.refresh()
+
+        records = []
+        for task_id in self._search_index.search(query):
+            record = self._storage.get(task_id)
+            if record is None or status not in (None, record.status):
+                continue
+            if (from_date is None or record.eta >= from_date) and (
+                due_date is None or record.eta <= due_date
+            ):
+                records.append(record)
+
+        return sorted(records, key=lambda record: record.eta_key)
+
+    def get_changes(self, since, timeout=0):
+        """
+        Gets what changed after a version of the store, for clients to sync from.
+        Each changed task is listed once, at its latest change, with the task as it
+        is now unless it was deleted.
+        :param since: str: version as get_version returns it, e.g. the ETag of a
+            GET /tasks response
+        :param timeout: float: seconds to wait for a change if there is none yet
+        :return: tuple: list of changes as dicts with the store version number they
+            made ('seq'), the 'operation', '_id' and 'task', version to ask from next
+        :raises ResyncRequiredError: if the change log no longer has every change
+            since the version, which includes versions of an earlier load
+        :raises ChangesUnavailableError: if other processes share the store, as
+            versions and change logs are kept by each process
+        """
+        if self._storage.shared:
+            raise ChangesUnavailableError(
+                "changes are not available while processes share the store"
+            )
+
+        epoch, _, version = since.rpartition(".")
+        try:
+            version = int(version)
+        except ValueError as unknown_version:
+            raise ResyncRequiredError(
+                f"unknown version {since!r}, resync"
+            ) from unknown_version
+
+        # Waits in short steps, for the storage to pick up other processes' changes
+        deadline = time.monotonic() + timeout
+        while True:
+            self._storage.refresh()
+            remaining = deadline - time.monotonic()
+            entries, latest = self._change_log.since(
+                epoch, version, min(remaining, CHANGES_REFRESH_INTERVAL)
+            )
+            if entries or remaining <= CHANGES_REFRESH_INTERVAL:
+                break
+
+        return self._describe_changes(entries), f"{epoch}.{latest}"
+
+    def _describe_changes(self, entries):
+        """
+        Builds the changes get_changes returns from change log entries
+        :param entries: list: (version, operation, task_id) entries in version order
+        :return: list: changes
+        """
+        # Later changes to a task replace the earlier ones
+        last_changes = {}
+        for seq, operation, task_id in entries:
+            last_changes.pop(task_id, None)
+            last_changes[task_id] = seq, operation
+
+        changes = []
+        for task_id, (seq, operation) in last_changes.items():
+            record = None if operation == DELETED else self._get_record(task_id)
+            change = {"seq": seq, "operation": operation, "_id": task_id}
+            if record is None:
+                change["operation"] = DELETED
+            else:
+                change["task"] = record.to_dict()
+            changes.append(change)
+
+        return changes
+
+    def count_tasks_by_status(self):
+        """
+        Counts tasks by status
+        :return: dict: number of tasks per status, for every status
+        """
+        counts = self._storage.count_by_status()
+
+        return {status.value: counts.get(status.value, 0) for status in Status}
+
+    def count_archived_tasks(self):
+        """
+        Counts the archived tasks
+        :return: int: number of tasks
+        """
+        return len(self._archive)
+
+    def get_archived_due_version(self, due_date=None):
+        """
+        Gets a version of the archived tasks due by a date, for versions of due task
+        lists that include them, without reading the archive
+        :param due_date: Datetime.datetime: latest eta, defaults to now
+        :return: str: version
+        """
+        return self._archive.due_version(
+            datetime.now() if due_date is None else due_date
+        )
+
+    def count_due_tasks(
+        self, due_date=None, from_date=None, status=None, include_archived=False
+    ):
+        """
+        Counts the tasks get_due_tasks would return, without building them.
+        :return: int: number of tasks
+        """
         if due_date is None:
             due_date = datetime.now()
 
-        return [x for x in self._task_list.values() if x["eta"] <= due_date]
+        count = self._storage.count_by_eta(
+            from_date, due_date, self._checked_status(status)
+        )
+        if include_archived:
+            count += len(self._get_archived_due(due_date, from_date, status))
+
+        return count
+
+    def get_task_page(
+        self, limit, cursor=None, due_date=None, from_date=None, status=None
+    ):  # pylint: disable=too-many-arguments
+        """
+        Gets a page of tasks ordered by (eta, _id), for results too large for one response.
+        :param limit: int: maximum number of tasks in the page
+        :param cursor: tuple: (eta, _id) of the last task of the previous page
+        :param due_date: Datetime.datetime: Latest eta to include, defaults to no limit
+        :param from_date: Datetime.datetime: Earliest eta to include, defaults to no limit
+        :param status: str: only return tasks with this status
+        :return: tuple: list of TaskRecord, cursor of the next page or None on the last page
+        """
+        records = self._storage.range_by_eta(
+            from_date, due_date, self._checked_status(status), cursor, limit
+        )
+
+        return records, records[-1].eta_key if len(records) == limit else None
+
+    @staticmethod
+    def _checked_status(status):
+        """
+        Checks a status filter is a known status
+        :param status: str: status to check, None for no filter
+        :return: str: status
+        """
+        if status is not None:
+            try:
+                Status(status)
+            except ValueError as wrong_status:
+                raise InvalidTaskError(wrong_status) from wrong_status
+
+        return status
 
     def delete_task(self, task_id):
         """
@@ -130,16 +638,43 @@ class Tasks:
         :param task_id: id given to delete a task
         :return: None
         """
-        self._task_list.pop(task_id, None)
-        self.save_tasks()
+        self._delete([task_id])
+
+    def _delete(self, task_ids):
+        """
+        Deletes tasks from the store and from the archive
+        :param task_ids: list: ids of the tasks to delete
+        :return: list: ids of the tasks that were deleted
+        """
+        with self._storage.write_lock():
+            deleted_ids = self._storage.delete(task_ids)
+            discarded_ids = self._archive.discard(task_ids)
+            deleted_ids = list(dict.fromkeys([*deleted_ids, *discarded_ids]))
+            if deleted_ids:
+                self._bump_versions(deleted_ids=deleted_ids)
+
+        return deleted_ids
 
-    @deep_copy_params_method
-    def put_task(self, task_id, updated_task):
+    def _put(self, records):
+        """
+        Stores changed tasks, taking those that were archived out of the archive
+        :param records: list: TaskRecord
+        :return: None
+        """
+        self._storage.put(records)
+        self._archive.discard([record.task_id for record in records])
+
+    def put_task(self, task_id, updated_task, if_match=None):
         """
         Updates a task given its task_id and updated_task
         :param task_id: id given to update a task
         :param updated_task: dict: updated task
-        :return: None
+        :param if_match: collection: only update the task if it exists at one of these
+            versions, as strings: its version field or its version as
+            get_task_version gives it, the ETag of GET /task/<task_id>. At any
+            version if it holds "*"
+        :return: dict: updated task
+        :raises VersionConflictError: if the task is not at a version of if_match
         """
         try:
             validate_task(updated_task)
@@ -154,44 +689,207 @@ class Tasks:
             )
             raise InvalidTaskError(wrong_status) from wrong_status
 
-        self._task_list[task_id] = updated_task
+        with self._storage.write_lock():
+            previous = self._get_record(task_id)
+            if if_match is not None and not self._is_at_version(previous, if_match):
+                raise VersionConflictError(
+                    f"task {task_id} is not at version {', '.join(if_match)}"
+                )
 
-        self.save_tasks()
+            record = TaskRecord.from_dict(task_id, updated_task).stamp(
+                previous, datetime.now()
+            )
+            self._put([record])
+            self._bump_versions([task_id])
+
+        return record.to_dict()
+
+    def _is_at_version(self, record, if_match):
+        """
+        Tells whether a task is at one of the versions of an If-Match header
+        :param record: TaskRecord: the task, None if there is none
+        :param if_match: collection: versions as put_task takes them
+        :return: bool
+        """
+        if record is None:
+            return False
 
-        return updated_task
+        versions = {"*", str(record.version), self.get_task_version(record.task_id)}
+        return not versions.isdisjoint(if_match)
 
-    @deep_copy_params_method
     def complete_task(self, task_id):
         """
         Updates task status to DONE given task id
         :param task_id: id given to update a task
         :return: dict: updated task
         """
-        self._task_list[task_id]["status"] = "DONE"
-        self.save_tasks()
+        with self._storage.write_lock():
+            record = self._get_record(task_id)
+            if record is None:
+                raise KeyError(task_id)
 
-        return self._task_list[task_id]
+            record = record._replace(status=Status.DONE.value).stamp(
+                record, datetime.now()
+            )
+            self._put([record])
+            self._bump_versions([task_id], operation=COMPLETED)
+
+        return record.to_dict()
+
+    def post_tasks(self, new_tasks):
+        """
+        Saves many tasks at once: tasks with an '_id' replace the task with that id,
+        others are created. Nothing is saved unless every task is valid.
+        :param new_tasks: list: tasks to save
+        :return: list: saved tasks, in the order given
+        """
+        records = []
+        errors = []
+        for index, task in enumerate(new_tasks):
+            try:
+                validate_task(task)
+            except (SchemaError, ValueError) as invalid_task:
+                errors.append({"index": index, "error": str(invalid_task)})
+                continue
+
+            task_id = str(task["_id"]) if "_id" in task else str(uuid.uuid4())
+            records.append(TaskRecord.from_dict(task_id, task))
+
+        if errors:
+            logging.info("error on post_tasks, invalid tasks received -- %s", errors)
+            raise InvalidBatchError(errors)
+
+        now = datetime.now()
+        with self._storage.write_lock():
+            # Tasks of the batch with the same id are successive versions
+            latest = {}
+            created_ids = set()
+            for index, record in enumerate(records):
+                if record.task_id not in latest:
+                    latest[record.task_id] = self._get_record(record.task_id)
+                    if latest[record.task_id] is None:
+                        created_ids.add(record.task_id)
+                records[index] = latest[record.task_id] = record.stamp(
+                    latest[record.task_id], now
+                )
+
+            self._put(records)
+            if records:
+                self._bump_versions(
+                    [x for x in latest if x not in created_ids],
+                    created_ids=[x for x in latest if x in created_ids],
+                )
+
+        return [record.to_dict() for record in records]
+
+    def complete_tasks(self, task_ids):
+        """
+        Updates the status of many tasks to DONE given their ids
+        :param task_ids: list: ids of the tasks to complete
+        :return: list: updated task, or the id with an error if not found, per id
+        """
+        results = []
+        records = []
+        now = datetime.now()
+        with self._storage.write_lock():
+            for task_id in task_ids:
+                record = self._get_record(task_id)
+                if record is None:
+                    results.append({"_id": task_id, "error": "task not found"})
+                    continue
+
+                record = record._replace(status=Status.DONE.value).stamp(record, now)
+                records.append(record)
+                results.append(record.to_dict())
+
+            self._put(records)
+            if records:
+                self._bump_versions(
+                    [record.task_id for record in records], operation=COMPLETED
+                )
+
+        return results
+
+    def delete_tasks(self, task_ids):
+        """
+        Deletes many tasks given their ids
+        :param task_ids: list: ids of the tasks to delete
+        :return: list: id and whether a task was deleted, per id
+        """
+        deleted_ids = set(self._delete(task_ids))
+
+        return [{"_id": x, "deleted": x in deleted_ids} for x in task_ids]
+
+    def archive_tasks(self, before):
+        """
+        Moves DONE and CANCELLED tasks last changed before a time to the archive. Tasks
+        stored before tasks were stamped with updated_at go by their eta instead.
+        :param before: datetime: tasks last changed before this time are archived
+        :return: int: number of archived tasks
+        """
+        with self._storage.write_lock():
+            records = [
+                record
+                for status in TERMINAL_STATUSES
+                for record in self._storage.filter_by_status(status)
+                if (record.updated_at or record.eta) < before
+            ]
+            if records:
+                # Synced to the archive before leaving the store, so none can be lost
+                self._archive.append(records)
+                self._bump_versions(
+                    archived_ids=self._storage.delete([x.task_id for x in records])
+                )
+
+        if records:
+            logging.info("archived %d tasks changed before %s", len(records), before)
+        return len(records)
+
+    def _archive_periodically(self):
+        """Archiver loop, archiving old tasks every settings.ARCHIVE_INTERVAL seconds"""
+        while not self._closed.wait(settings.ARCHIVE_INTERVAL):
+            try:
+                self.archive_tasks(
+                    datetime.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+                )
+            except Exception as archive_error:  # pylint: disable=broad-exception-caught
+                logging.error("error archiving tasks -- %s", archive_error)
+
+    def close(self):
+        """
+        Persists outstanding changes and stops background persistence and archiving.
+        Also called on exit for stores that are still open.
+        :return: None
+        """
+        atexit.unregister(self.close)
+        self._closed.set()
+        if self._archiver is not None:
+            self._archiver.join()
+        self._search_index.close()
+        self._archive.close()
+        self._storage.close()
 
     def save_tasks(self):
         """
-        Saves tasks
+        Saves tasks in the compact on-disk form of the storage backend
         :return: None
         """
-        with open(settings.TASK_DATA_FILE, "wb") as file:
-            pickle.dump(self._task_list, file)
+        started = time.perf_counter()
+        written = self._storage.save()
+        STORE_OPERATION_SECONDS.observe(time.perf_counter() - started, "save")
+        SAVED_BYTES.inc(amount=written)
 
     def load_tasks(self):
         """
-        Loads tasks
+        Loads tasks from the storage backend
         :return: None
         """
-
-        tasks = {}
-        try:
-            with open(settings.TASK_DATA_FILE, "rb") as file:
-                tasks = pickle.load(file)
-        except FileNotFoundError:
-            with open(settings.TASK_DATA_FILE, "wb") as file:
-                pickle.dump(tasks, file)
-
-        self._task_list = tasks
+        started = time.perf_counter()
+        self._storage.load()
+        # Archive appends hold the write lock, so a torn tail is not one in progress
+        with self._storage.write_lock():
+            self._archive.load()
+        STORE_OPERATION_SECONDS.observe(time.perf_counter() - started, "load")
+        self._reset_versions()
+        if settings.SEARCH_WARM_UP:
+            self._search_index.warm_up()
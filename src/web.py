@@ -0,0 +1,363 @@
+"""
+Request handling shared by the Flask app and the ASGI app: query argument parsing,
+ETags, page cursors, change events and the responses to route errors
+"""
+import base64
+import logging
+from datetime import datetime
+
+from codec import dumps, parse_datetime
+import settings
+from tasks import (
+    ChangesUnavailableError,
+    InvalidTaskError,
+    InvalidBatchError,
+    InvalidSearchError,
+    ResyncRequiredError,
+    SchemaMissingKeyError,
+    VersionConflictError,
+)
+
+
+# pylint: disable=too-few-public-methods
+class InvalidQueryError(Exception):
+    """Exception for invalid query arguments."""
+
+
+# Errors answered with a 400 and their message
+INVALID_REQUEST_ERRORS = (
+    InvalidTaskError,
+    InvalidQueryError,
+    InvalidSearchError,
+    SchemaMissingKeyError,
+)
+
+
+def error_response(error):
+    """
+    Turns an error raised by a route into a response
+    :param error: Exception: error of the route
+    :return: tuple: status, bytes: body, str: mimetype, None for the default one
+    """
+    if isinstance(error, InvalidBatchError):
+        logging.info(error)
+        return 400, dumps(error.errors), "application/json"
+    if isinstance(error, INVALID_REQUEST_ERRORS):
+        logging.info(error)
+        return 400, str(error).encode(), None
+    if isinstance(error, ResyncRequiredError):
+        logging.info(error)
+        return 410, str(error).encode(), None
+    if isinstance(error, VersionConflictError):
+        logging.info(error)
+        return 412, str(error).encode(), None
+    if isinstance(error, ChangesUnavailableError):
+        logging.info(error)
+        return 501, str(error).encode(), None
+
+    logging.error(error)
+    return 500, b"Internal Server Error", None
+
+
+def datetime_arg(args, name):
+    """
+    Parses an optional datetime query argument
+    :param args: dict: query arguments
+    :param name: str: name of the argument
+    :return: datetime: None if the argument is not given
+    """
+    if name not in args:
+        return None
+
+    try:
+        return parse_datetime(args[name])
+    except ValueError as invalid_datetime:
+        raise InvalidQueryError(invalid_datetime) from invalid_datetime
+
+
+def json_list(body, item_type=None):
+    """Checks a request body is a JSON list of item_type if given"""
+    if not isinstance(body, list) or (
+        item_type is not None and not all(isinstance(x, item_type) for x in body)
+    ):
+        raise InvalidQueryError("request body must be a JSON list")
+
+    return body
+
+
+def parse_eta(task):
+    """Parses the eta of a task from a request body"""
+    task["eta"] = parse_datetime(task["eta"])
+
+
+def parse_batch_etas(new_tasks):
+    """
+    Parses the etas of a batch of tasks from a request body. Unparseable etas are
+    left as they are and reported by validation.
+    """
+    for task in new_tasks:
+        if isinstance(task, dict) and isinstance(task.get("eta"), str):
+            try:
+                parse_eta(task)
+            except ValueError:
+                pass
+
+
+def modified_since_arg(args):
+    """
+    Parses the modified_since query argument, which is not paginated
+    :param args: dict: query arguments
+    :return: datetime: earliest updated_at asked for
+    """
+    if is_paginated(args):
+        raise InvalidQueryError("modified_since cannot be paginated")
+
+    return datetime_arg(args, "modified_since")
+
+
+def include_archived_arg(args):
+    """
+    Parses the include_archived query argument, which only applies to full lists
+    :param args: dict: query arguments
+    :return: bool: whether archived tasks are asked for
+    """
+    include_archived = args.get("include_archived") == "true"
+    if include_archived and (is_paginated(args) or "modified_since" in args):
+        raise InvalidQueryError(
+            "include_archived cannot be paginated or combined with modified_since"
+        )
+
+    return include_archived
+
+
+def parse_if_match(header):
+    """
+    Parses an If-Match header
+    :param header: str: header value, None if the request has none
+    :return: set: task versions the header holds, "*" for any, None without header
+    """
+    if header is None:
+        return None
+
+    return {tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")}
+
+
+def etag_matches(header, etag):
+    """
+    Whether an If-None-Match header holds etag
+    :param header: str: header value, None if the request has none
+    :param etag: str: ETag of the response, without quotes
+    :return: bool
+    """
+    if header is None:
+        return False
+
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+
+def cached(cache, key, build):
+    """
+    Gets the encoded body and headers of a response from the cache, building them
+    and caching them on a miss. Streamed bodies are not cached.
+    :param cache: ResponseCache
+    :param key: tuple: key from cache_key
+    :param build: callable returning the body, bytes or chunks, and the headers
+    :return: tuple: body, headers
+    """
+    entry = cache.get(key)
+    if entry is None:
+        entry = build()
+        if isinstance(entry[0], bytes):
+            cache.put(key, *entry)
+
+    return entry
+
+
+def cache_key(path, query, etag):
+    """
+    Key of a response in the response cache
+    :param path: str: request path
+    :param query: iterable: (name, value) pairs of the query arguments
+    :param etag: str: ETag of the response
+    :return: tuple
+    """
+    return path, tuple(sorted(query)), etag
+
+
+def due_tasks_version(tasks, args):
+    """
+    Version of the due tasks response. Without a duedate, tasks become due as time
+    passes, so the number of due tasks is part of the version. Archived tasks are
+    not counted, which would read the whole archive: the archive's due version
+    stands for them.
+    :param tasks: Tasks
+    :param args: dict: query arguments
+    :return: str: ETag
+    """
+    version = tasks.get_version()
+    if "duedate" in args:
+        return version
+
+    count = tasks.count_due_tasks(
+        from_date=datetime_arg(args, "from"), status=args.get("status")
+    )
+    if include_archived_arg(args):
+        return f"{version}.{count}.{tasks.get_archived_due_version()}"
+
+    return f"{version}.{count}"
+
+
+def is_paginated(args):
+    """Whether the query args ask for a page or a stream instead of the full list"""
+    return any(arg in args for arg in ("limit", "cursor", "stream"))
+
+
+def task_records(tasks, args):
+    """
+    Reads the records of the full list of tasks GET /tasks asks for
+    :param tasks: Tasks
+    :param args: dict: query arguments
+    :return: list: records, None if the request asks for a page or a stream
+    """
+    include_archived = include_archived_arg(args)
+    due_date = datetime_arg(args, "duedate")
+    from_date = datetime_arg(args, "from")
+    status = args.get("status")
+
+    if "modified_since" in args:
+        return tasks.get_modified_task_records(
+            modified_since_arg(args), due_date, from_date, status
+        )
+
+    if is_paginated(args):
+        return None
+
+    if "duedate" in args:
+        return tasks.get_due_task_records(due_date, from_date, status, include_archived)
+
+    return tasks.get_task_records(status=status, include_archived=include_archived)
+
+
+def read_pages(tasks, encoder, args, filters):
+    """
+    Reads the page of tasks ordered by eta a paginated request asks for, or every
+    task from its cursor on with stream=true
+    :param tasks: Tasks
+    :param encoder: TaskEncoder
+    :param args: dict: query arguments
+    :param filters: tuple: due_date, from_date and status of Tasks.get_task_page
+    :return: tuple: JSON array of the page as bytes, or its chunks when streaming,
+        and the cursor of the next page, None if there is none or when streaming
+    """
+    cursor = decode_cursor(args.get("cursor"))
+
+    if args.get("stream") == "true":
+        # The first page is read eagerly so invalid filters still fail with a 400
+        page, cursor = tasks.get_task_page(settings.STREAM_PAGE_SIZE, cursor, *filters)
+        return stream_pages(tasks, encoder, page, cursor, filters), None
+
+    page, cursor = tasks.get_task_page(page_limit(args.get("limit")), cursor, *filters)
+    return encoder.encode_list(page), None if cursor is None else encode_cursor(cursor)
+
+
+def page_limit(limit):
+    """Parses the limit query argument, capped at settings.MAX_PAGE_SIZE"""
+    if limit is None:
+        return settings.MAX_PAGE_SIZE
+
+    try:
+        limit = min(int(limit), settings.MAX_PAGE_SIZE)
+    except ValueError as invalid_limit:
+        raise InvalidQueryError(invalid_limit) from invalid_limit
+    if limit < 1:
+        raise InvalidQueryError("limit must be at least 1")
+
+    return limit
+
+
+def stream_pages(tasks, encoder, page, cursor, filters):
+    """Yields a JSON array of tasks one page at a time"""
+    yield b"["
+    separator = b""
+    while True:
+        if page:
+            yield separator + b",".join(map(encoder.encode, page))
+            separator = b","
+        if cursor is None:
+            break
+        page, cursor = tasks.get_task_page(settings.STREAM_PAGE_SIZE, cursor, *filters)
+    yield b"]"
+
+
+def encode_cursor(key):
+    """Encodes an (eta, _id) page key as an opaque cursor"""
+    eta, task_id = key
+    return base64.urlsafe_b64encode(f"{eta.isoformat()}|{task_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor from encode_cursor, None if there is no cursor"""
+    if cursor is None:
+        return None
+
+    try:
+        eta, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(eta), task_id
+    except ValueError as invalid_cursor:
+        raise InvalidQueryError(f"invalid cursor {cursor!r}") from invalid_cursor
+
+
+def changes_since(args, headers):
+    """
+    Parses the version a request for changes asks from
+    :param args: dict: query arguments
+    :param headers: mapping of header names to values, case insensitive
+    :return: str: since argument, or the Last-Event-ID of a reconnecting stream
+    """
+    since = args.get("since", headers.get("Last-Event-ID"))
+    if since is None:
+        raise InvalidQueryError("since is required")
+
+    return since
+
+
+def changes_wait(wait):
+    """Parses the wait query argument, in seconds, capped at settings.CHANGES_MAX_WAIT"""
+    if wait is None:
+        return 0
+
+    try:
+        wait = min(float(wait), settings.CHANGES_MAX_WAIT)
+    except ValueError as invalid_wait:
+        raise InvalidQueryError(invalid_wait) from invalid_wait
+    if not wait >= 0:
+        raise InvalidQueryError("wait must be a number of seconds")
+
+    return wait
+
+
+def wants_event_stream(headers):
+    """Whether a request for changes asks for server-sent events"""
+    return "text/event-stream" in headers.get("Accept", "")
+
+
+def change_event(changes, since):
+    """
+    Encodes a batch of changes as a server-sent event
+    :param changes: list: changes from Tasks.get_changes
+    :param since: str: version to resume from
+    :return: bytes: event, or a comment if there are no changes
+    """
+    if not changes:
+        return b": waiting for changes\n\n"
+    return b"id: " + since.encode() + b"\ndata: " + dumps(changes) + b"\n\n"
+
+
+def resync_event(resync):
+    """
+    Encodes the event telling a client it fell behind the change log
+    :param resync: ResyncRequiredError: error of get_changes
+    :return: bytes: event
+    """
+    return b"event: resync\ndata: " + dumps(str(resync)) + b"\n\n"
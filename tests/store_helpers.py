@@ -0,0 +1,56 @@
+"""
+Helpers for tests that need a task store of their own.
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+import settings
+
+
+class TempStoreTestCase(TestCase):
+    """Points the task data files at a temporary directory for each test."""
+
+    valid_task = {
+        "description": "Shopping",
+        "eta": datetime.now() + timedelta(days=3),
+        "status": "OPEN",
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.patches = [
+            mock.patch.object(
+                settings,
+                "TASK_DATA_FILE",
+                os.path.join(self.temp_dir.name, "tasks.pkl"),
+            ),
+            mock.patch.object(
+                settings,
+                "TASK_JOURNAL_FILE",
+                os.path.join(self.temp_dir.name, "tasks.journal"),
+            ),
+            mock.patch.object(
+                settings,
+                "TASK_DATABASE_FILE",
+                os.path.join(self.temp_dir.name, "tasks.sqlite3"),
+            ),
+            mock.patch.object(
+                settings,
+                "TASK_LOCK_FILE",
+                os.path.join(self.temp_dir.name, "tasks.lock"),
+            ),
+            mock.patch.object(
+                settings,
+                "ARCHIVE_FILE",
+                os.path.join(self.temp_dir.name, "tasks.archive"),
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.temp_dir.cleanup()
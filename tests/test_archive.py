@@ -0,0 +1,202 @@
+"""
+Tests for the task archive
+"""
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from archive import Archive
+from records import TaskRecord
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+BASE_TIME = datetime(2023, 6, 20, 14, 0, 0)
+
+
+def make_record(task_id, status="DONE", days=0):
+    """Builds a record last changed some days after BASE_TIME"""
+    changed_at = BASE_TIME + timedelta(days=days)
+    return TaskRecord(
+        task_id, f"task {task_id}", BASE_TIME, status, changed_at, changed_at, 2
+    )
+
+
+# pylint: disable=missing-class-docstring
+class TestArchive(TempStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive = Archive(settings.ARCHIVE_FILE)
+        self.archive.load()
+        self.addCleanup(self.archive.close)
+
+    def test_append_get_and_discard(self):
+        """Tasks are read back by id and in order, the latest copy of each"""
+        with mock.patch("archive.BATCH_SIZE", 2):
+            self.archive.append([make_record(x) for x in "abcde"])
+        self.archive.append([make_record("b", "CANCELLED")])
+
+        self.assertEqual(self.archive.discard(["c", "missing", "c"]), ["c"])
+        self.assertEqual(self.archive.get("a"), make_record("a"))
+        self.assertEqual(self.archive.get("b"), make_record("b", "CANCELLED"))
+        self.assertIsNone(self.archive.get("c"))
+        self.assertEqual(
+            [record.task_id for record in self.archive.all()], ["a", "d", "e", "b"]
+        )
+        self.assertEqual(self.archive.all("CANCELLED"), [make_record("b", "CANCELLED")])
+        self.assertEqual(len(self.archive), 4)
+
+    def test_appends_of_others_are_picked_up(self):
+        """Another archive on the same file sees every append and discard"""
+        other = Archive(settings.ARCHIVE_FILE)
+        other.load()
+        self.addCleanup(other.close)
+
+        self.archive.append([make_record("a"), make_record("b")])
+        self.assertIn("a", other)
+        other.discard(["a"])
+
+        self.assertNotIn("a", self.archive)
+        self.assertEqual(self.archive.all(), [make_record("b")])
+
+    def test_due_version(self):
+        """The due version changes with the archive and as archived tasks become due"""
+        self.archive.append([make_record("a")])
+        before = self.archive.due_version(BASE_TIME - timedelta(days=1))
+        due = self.archive.due_version(BASE_TIME)
+        self.assertNotEqual(due, before)
+
+        self.archive.append([make_record("b")])
+        self.assertNotEqual(self.archive.due_version(BASE_TIME), due)
+        self.assertEqual(
+            self.archive.due_version(BASE_TIME - timedelta(days=1)).split(".")[1], "0"
+        )
+
+    def test_torn_tail_is_discarded(self):
+        """A partly written record is cut off on load"""
+        self.archive.append([make_record("a")])
+        self.archive.close()
+        size = os.path.getsize(settings.ARCHIVE_FILE)
+        with open(settings.ARCHIVE_FILE, "ab") as file:
+            file.write(b"\x40\x00\x00\x00torn")
+
+        self.archive.load()
+        self.assertEqual(os.path.getsize(settings.ARCHIVE_FILE), size)
+        self.archive.append([make_record("b")])
+        self.assertEqual(self.archive.get("b"), make_record("b"))
+
+
+class TestArchivedTasks(TempStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tasks = Tasks()
+        self.addCleanup(self.tasks.close)
+
+        self.open = self.tasks.post_task(dict(self.valid_task, eta=BASE_TIME))
+        self.done = self.tasks.complete_task(
+            self.tasks.post_task(dict(self.valid_task, eta=BASE_TIME))["_id"]
+        )
+        self.tasks.archive_tasks(self.done["updated_at"] + timedelta(microseconds=1))
+
+    def test_archived_tasks_leave_the_store(self):
+        """Archived tasks are found by id, and only listed on request"""
+        done, task_id = self.done, self.done["_id"]
+
+        self.assertEqual(self.tasks.get_tasks(), [self.open])
+        self.assertEqual(self.tasks.get_tasks(task_id), [done])
+        self.assertEqual(self.tasks.get_tasks(include_archived=True), [self.open, done])
+        self.assertEqual(
+            self.tasks.get_tasks(status="DONE", include_archived=True), [done]
+        )
+        self.assertEqual(self.tasks.count_tasks_by_status()["DONE"], 0)
+        self.assertEqual(self.tasks.count_archived_tasks(), 1)
+
+        due_date = BASE_TIME + timedelta(days=1)
+        self.assertEqual(
+            self.tasks.get_due_tasks(due_date, include_archived=True),
+            sorted([self.open, done], key=lambda task: task["_id"]),
+        )
+        self.assertEqual(self.tasks.count_due_tasks(due_date, include_archived=True), 2)
+        self.assertEqual(self.tasks.get_due_tasks(due_date, from_date=due_date), [])
+
+    def test_changes_bring_tasks_back(self):
+        """A changed archived task is back in the store, a deleted one is gone"""
+        since = self.tasks.get_version()
+        restored = self.tasks.put_task(
+            self.done["_id"], dict(self.done, status="OPEN"), {"2"}
+        )
+        self.assertEqual(restored["version"], 3)
+        self.assertEqual(self.tasks.count_archived_tasks(), 0)
+        self.assertEqual(len(self.tasks.get_tasks()), 2)
+
+        self.tasks.complete_task(restored["_id"])
+        self.assertEqual(self.tasks.archive_tasks(datetime.now()), 1)
+        changes, _ = self.tasks.get_changes(since)
+        self.assertEqual(changes[0]["operation"], "archived")
+        self.assertEqual(changes[0]["task"]["version"], 4)
+
+        self.assertEqual(
+            self.tasks.delete_tasks([restored["_id"]]),
+            [{"_id": restored["_id"], "deleted": True}],
+        )
+        self.assertEqual(self.tasks.get_tasks(restored["_id"]), [])
+
+    def test_deleted_tasks_change_version(self):
+        """Deleting an archived task, or one unchanged since load, changes its version"""
+        self.tasks.close()
+        self.tasks = Tasks()
+        self.addCleanup(self.tasks.close)
+        done_version = self.tasks.get_task_version(self.done["_id"])
+        open_version = self.tasks.get_task_version(self.open["_id"])
+
+        self.tasks.delete_tasks([self.done["_id"], self.open["_id"]])
+        self.assertNotEqual(self.tasks.get_task_version(self.done["_id"]), done_version)
+        self.assertNotEqual(self.tasks.get_task_version(self.open["_id"]), open_version)
+
+    def test_archived_tasks_change_version(self):
+        """Archiving a task gives it a version it never had before"""
+        self.tasks.close()
+        self.tasks = Tasks()
+        self.addCleanup(self.tasks.close)
+        loaded_version = self.tasks.get_task_version(self.open["_id"])
+        task = self.tasks.complete_task(self.open["_id"])
+        done_version = self.tasks.get_task_version(task["_id"])
+
+        self.tasks.archive_tasks(task["updated_at"] + timedelta(microseconds=1))
+        self.assertNotIn(
+            self.tasks.get_task_version(task["_id"]), (loaded_version, done_version)
+        )
+
+    def test_archive_survives_reloading(self):
+        """Archived tasks are still archived after a restart, on every backend"""
+        self.tasks.close()
+        reloaded = Tasks()
+        self.assertEqual(reloaded.get_tasks(self.done["_id"]), [self.done])
+        reloaded.close()
+
+        for backend in ("columnar", "sqlite"):
+            with mock.patch.object(settings, "STORAGE_BACKEND", backend):
+                tasks = Tasks()
+                task = tasks.post_task(dict(self.valid_task, status="CANCELLED"))
+                self.assertEqual(tasks.archive_tasks(datetime.now()), 1)
+                tasks.close()
+
+                reloaded = Tasks()
+                self.assertNotIn(task, reloaded.get_tasks())
+                self.assertEqual(reloaded.get_tasks(task["_id"]), [task])
+                reloaded.close()
+
+    def test_archiver_thread(self):
+        """Old tasks are archived every ARCHIVE_INTERVAL seconds until close"""
+        self.tasks.close()
+        with mock.patch.multiple(settings, ARCHIVE_AFTER_DAYS=0, ARCHIVE_INTERVAL=0.01):
+            tasks = Tasks()
+            tasks.complete_task(self.open["_id"])
+
+            deadline = datetime.now() + timedelta(seconds=5)
+            while tasks.count_archived_tasks() < 2:
+                self.assertLess(datetime.now(), deadline)
+                time.sleep(0.01)
+            tasks.close()
+        self.assertEqual(tasks.get_tasks(include_archived=True)[0]["status"], "DONE")
@@ -0,0 +1,106 @@
+"""
+Tests for the change log
+"""
+import threading
+import time
+from unittest import mock
+
+import pytest
+from changes import ResyncRequiredError
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+
+# pylint: disable=missing-class-docstring
+class TestChanges(TempStoreTestCase):
+    def test_changes_since_a_version(self):
+        """Each changed task is listed once, at its latest change"""
+        tasks = Tasks()
+        kept = tasks.post_task(self.valid_task)
+        since = tasks.get_version()
+
+        created = tasks.post_task(self.valid_task)
+        updated = tasks.put_task(kept["_id"], dict(self.valid_task, description="Bake"))
+        tasks.delete_task(created["_id"])
+        changes, next_version = tasks.get_changes(since)
+
+        self.assertEqual(
+            changes,
+            [
+                {"seq": 3, "operation": "updated", "_id": kept["_id"], "task": updated},
+                {"seq": 4, "operation": "deleted", "_id": created["_id"]},
+            ],
+        )
+        self.assertEqual(next_version, tasks.get_version())
+        self.assertEqual(tasks.get_changes(next_version), ([], next_version))
+
+        completed = tasks.complete_task(kept["_id"])
+        self.assertEqual(
+            tasks.get_changes(next_version)[0],
+            [
+                {
+                    "seq": 5,
+                    "operation": "completed",
+                    "_id": kept["_id"],
+                    "task": completed,
+                }
+            ],
+        )
+        tasks.close()
+
+    def test_batch_operations(self):
+        """Batches log created, updated, completed and deleted tasks"""
+        tasks = Tasks()
+        since = tasks.get_version()
+        existing = tasks.post_task(self.valid_task)
+        new, replaced = tasks.post_tasks([self.valid_task, existing])
+        changes, since = tasks.get_changes(since)
+        self.assertEqual(
+            [(x["operation"], x["_id"]) for x in changes],
+            [("created", new["_id"]), ("updated", replaced["_id"])],
+        )
+
+        tasks.complete_tasks([new["_id"]])
+        tasks.delete_tasks([existing["_id"]])
+        changes, since = tasks.get_changes(since)
+        self.assertEqual(
+            [(x["operation"], x["_id"]) for x in changes],
+            [("completed", new["_id"]), ("deleted", existing["_id"])],
+        )
+        tasks.close()
+
+    def test_resync_is_required(self):
+        """Versions the log no longer covers, or never did, need a resync"""
+        with mock.patch.object(settings, "CHANGE_LOG_SIZE", 2):
+            tasks = Tasks()
+        since = tasks.get_version()
+        tasks.post_tasks([self.valid_task, self.valid_task])
+        recent = tasks.get_version()
+        tasks.post_task(self.valid_task)
+
+        self.assertEqual(len(tasks.get_changes(recent)[0]), 1)
+        for version in (since, "unknown", f"{recent}0"):
+            with pytest.raises(ResyncRequiredError):
+                tasks.get_changes(version)
+
+        tasks.load_tasks()
+        with pytest.raises(ResyncRequiredError):
+            tasks.get_changes(recent)
+        tasks.close()
+
+    def test_waits_for_changes(self):
+        """A get_changes with a timeout returns as soon as something changes"""
+        tasks = Tasks()
+        since = tasks.get_version()
+        self.assertEqual(tasks.get_changes(since, 0.01)[0], [])
+
+        poster = threading.Timer(0.05, tasks.post_task, [self.valid_task])
+        started = time.monotonic()
+        poster.start()
+        changes, _ = tasks.get_changes(since, 10)
+        poster.join()
+
+        self.assertEqual([x["operation"] for x in changes], ["created"])
+        self.assertLess(time.monotonic() - started, 5)
+        tasks.close()
@@ -0,0 +1,97 @@
+"""
+Tests for the task codec
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase, mock
+
+import pytest
+import codec
+from codec import TaskEncoder, dumps, encode_task, parse_datetime
+from records import TaskRecord
+
+ETA = datetime(2023, 6, 20, 14, 0, 0)
+
+
+# pylint: disable=missing-class-docstring
+class TestParseDatetime(TestCase):
+    def test_naive(self):
+        """Plain and fractional second times parse as naive datetimes"""
+        self.assertEqual(parse_datetime("2023-06-20T14:00:00"), ETA)
+        self.assertEqual(
+            parse_datetime("2023-06-20T14:00:00.250000"),
+            ETA + timedelta(milliseconds=250),
+        )
+
+    def test_with_offset(self):
+        """Times with an offset are converted to naive local time"""
+        utc = datetime(2023, 6, 20, 14, 0, 0, tzinfo=timezone.utc)
+        local = utc.astimezone().replace(tzinfo=None)
+
+        self.assertEqual(parse_datetime("2023-06-20T14:00:00Z"), local)
+        self.assertEqual(parse_datetime("2023-06-20T16:00:00+02:00"), local)
+
+    def test_invalid(self):
+        """Anything but an ISO 8601 date and time is rejected"""
+        for value in ("2023-06-20", "2023-06-20 14:00:00", "2023-13-20T14:00:00", 7):
+            with pytest.raises(ValueError):
+                parse_datetime(value)
+
+
+class TestEncoding(TestCase):
+    record = TaskRecord("1", 'Clean "House" é', ETA, "OPEN")
+
+    def test_dumps_with_and_without_orjson(self):
+        """Both encoders write the same JSON, with datetimes in ISO format"""
+        value = {"eta": ETA, "ids": ["1", "2"]}
+        with mock.patch.object(codec, "orjson", None):
+            plain = dumps(value)
+
+        self.assertEqual(json.loads(plain), {"eta": ETA.isoformat(), "ids": ["1", "2"]})
+        self.assertEqual(json.loads(dumps(value)), json.loads(plain))
+        with mock.patch.object(codec, "orjson", None), pytest.raises(TypeError):
+            dumps({"unknown": object()})
+
+    def test_task_encoder(self):
+        """Tasks encode as their dict form with an ISO eta"""
+        expected = dict(self.record.to_dict(), eta=ETA.isoformat())
+        encoder = TaskEncoder()
+
+        with mock.patch.object(codec, "orjson", None):
+            self.assertEqual(json.loads(encode_task(self.record)), expected)
+
+        self.assertEqual(json.loads(encoder.encode(self.record)), expected)
+        self.assertEqual(json.loads(encoder.encode_list([])), [])
+        self.assertEqual(
+            json.loads(encoder.encode_list([self.record, self.record])),
+            [expected, expected],
+        )
+
+    def test_encodings_are_cached_until_the_task_changes(self):
+        """A task is only encoded again once its record changes or is forgotten"""
+        encoder = TaskEncoder()
+        encoded = encoder.encode(self.record)
+
+        self.assertIs(encoder.encode(self.record), encoded)
+        self.assertIs(encoder.encode(self.record._replace()), encoded)
+
+        changed = self.record._replace(eta=ETA + timedelta(days=1))
+        self.assertEqual(
+            json.loads(encoder.encode(changed))["eta"], "2023-06-21T14:00:00"
+        )
+
+        encoded = encoder.encode(changed)
+        encoder.forget(["1"])
+        self.assertIsNot(encoder.encode(changed), encoded)
+        encoded = encoder.encode(changed)
+        encoder.forget(None)
+        self.assertIsNot(encoder.encode(changed), encoded)
+
+    def test_encoder_is_bounded(self):
+        """Tasks past max_entries are not cached"""
+        encoder = TaskEncoder(max_entries=1)
+        encoded = encoder.encode(self.record)
+        other = self.record._replace(task_id="2")
+
+        self.assertIs(encoder.encode(self.record), encoded)
+        self.assertIsNot(encoder.encode(other), encoder.encode(other))
@@ -0,0 +1,192 @@
+"""
+Tests for task indexes
+"""
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import pytest
+from indexes import EtaIndex, StatusIndex
+from tasks import Tasks, InvalidTaskError, TaskRecord
+from .store_helpers import TempStoreTestCase
+
+BASE_ETA = datetime(2023, 6, 20, 14, 0, 0)
+
+
+# pylint: disable=missing-class-docstring
+class TestEtaIndex(TestCase):
+    def setUp(self):
+        self.index = EtaIndex()
+        self.index.add(BASE_ETA + timedelta(days=2), "c")
+        self.index.add(BASE_ETA, "b")
+        self.index.add(BASE_ETA, "a")
+        self.index.add(BASE_ETA + timedelta(days=1), "d")
+
+    def test_range_is_ordered_by_eta_then_id(self):
+        """Unbounded range returns every id in (eta, id) order"""
+        self.assertEqual(self.index.range(), ["a", "b", "d", "c"])
+
+    def test_range_bounds_are_inclusive(self):
+        """Tasks with eta equal to either bound are included"""
+        self.assertEqual(
+            self.index.range(BASE_ETA, BASE_ETA + timedelta(days=1)), ["a", "b", "d"]
+        )
+        self.assertEqual(self.index.range(end=BASE_ETA), ["a", "b"])
+        self.assertEqual(self.index.range(start=BASE_ETA + timedelta(days=2)), ["c"])
+
+    def test_page(self):
+        """Pages continue after the last returned key"""
+        first_page = self.index.page(limit=2)
+        second_page = self.index.page(first_page[-1], limit=2)
+
+        self.assertEqual([key[1] for key in first_page], ["a", "b"])
+        self.assertEqual([key[1] for key in second_page], ["d", "c"])
+        self.assertEqual(self.index.page(second_page[-1]), [])
+        self.assertEqual(
+            [key[1] for key in self.index.page(first_page[0], end=BASE_ETA)], ["b"]
+        )
+
+    def test_remove(self):
+        """Removed ids are no longer returned and unknown ids are ignored"""
+        self.index.remove(BASE_ETA, "a")
+        self.index.remove(BASE_ETA, "unknown")
+
+        self.assertEqual(self.index.range(), ["b", "d", "c"])
+        self.assertEqual(len(self.index), 3)
+
+    def test_rebuild(self):
+        """Rebuild replaces the index from a task dict"""
+        self.index.rebuild({"x": TaskRecord("x", "Shopping", BASE_ETA, "OPEN")})
+
+        self.assertEqual(self.index.range(), ["x"])
+
+
+class TestStatusIndex(TestCase):
+    def test_ids_by_status(self):
+        """Ids are grouped by status in insertion order"""
+        index = StatusIndex()
+        index.add("OPEN", "a")
+        index.add("DONE", "b")
+        index.add("OPEN", "c")
+        index.remove("OPEN", "a")
+        index.remove("CANCELLED", "unknown")
+
+        self.assertEqual(list(index.ids("OPEN")), ["c"])
+        self.assertEqual(list(index.ids("DONE")), ["b"])
+        self.assertEqual(list(index.ids("CANCELLED")), [])
+
+    def test_rebuild(self):
+        """Rebuild replaces the index from a task dict"""
+        index = StatusIndex()
+        index.add("OPEN", "a")
+        index.rebuild({"x": TaskRecord("x", "Shopping", BASE_ETA, "DONE")})
+
+        self.assertEqual(list(index.ids("OPEN")), [])
+        self.assertEqual(list(index.ids("DONE")), ["x"])
+
+
+class TestDueTaskQueries(TempStoreTestCase):
+    def post(self, tasks, days, description="Shopping"):
+        """Posts a task with an eta relative to BASE_ETA"""
+        return tasks.post_task(
+            {
+                "description": description,
+                "eta": BASE_ETA + timedelta(days=days),
+                "status": "OPEN",
+            }
+        )
+
+    def test_due_tasks_follow_updates_and_deletes(self):
+        """Index is kept in step with put, complete and delete"""
+        tasks = Tasks()
+        moved = self.post(tasks, 1)
+        deleted = self.post(tasks, 2)
+        completed = self.post(tasks, 3)
+
+        moved["eta"] = BASE_ETA + timedelta(days=10)
+        tasks.put_task(moved["_id"], moved)
+        tasks.delete_task(deleted["_id"])
+        tasks.complete_task(completed["_id"])
+
+        due_ids = [
+            task["_id"] for task in tasks.get_due_tasks(BASE_ETA + timedelta(days=5))
+        ]
+
+        self.assertEqual(due_ids, [completed["_id"]])
+
+    def test_due_tasks_from_date(self):
+        """from_date restricts the lower end of the eta range"""
+        tasks = Tasks()
+        self.post(tasks, 1, "early")
+        self.post(tasks, 2, "middle")
+        self.post(tasks, 3, "late")
+
+        due = tasks.get_due_tasks(
+            BASE_ETA + timedelta(days=2), from_date=BASE_ETA + timedelta(days=2)
+        )
+
+        self.assertEqual([task["description"] for task in due], ["middle"])
+
+    def test_index_is_rebuilt_on_load(self):
+        """A reloaded store answers due queries from the journal"""
+        tasks = Tasks()
+        self.post(tasks, 1)
+
+        self.assertEqual(len(Tasks().get_due_tasks(BASE_ETA + timedelta(days=1))), 1)
+
+    def test_get_tasks_by_status(self):
+        """Status filter follows completes and updates"""
+        tasks = Tasks()
+        completed = self.post(tasks, 1)
+        cancelled = self.post(tasks, 2)
+        still_open = self.post(tasks, 3)
+
+        tasks.complete_task(completed["_id"])
+        cancelled["status"] = "CANCELLED"
+        cancelled = tasks.put_task(cancelled["_id"], cancelled)
+
+        self.assertEqual(tasks.get_tasks(status="OPEN"), [still_open])
+        self.assertEqual(tasks.get_tasks(status="CANCELLED"), [cancelled])
+        self.assertEqual(tasks.get_tasks(completed["_id"], status="OPEN"), [])
+        self.assertEqual(
+            [task["_id"] for task in tasks.get_tasks(status="DONE")],
+            [completed["_id"]],
+        )
+
+    def test_get_tasks_with_invalid_status(self):
+        """Unknown statuses are rejected"""
+        with pytest.raises(InvalidTaskError):
+            Tasks().get_tasks(status="BLUE")
+
+    def test_due_tasks_by_status(self):
+        """Status and eta filters combine whichever index is smaller"""
+        tasks = Tasks()
+        for days in range(5):
+            self.post(tasks, days, f"open {days}")
+        done = [self.post(tasks, days, f"done {days}") for days in range(3)]
+        for task in done:
+            tasks.complete_task(task["_id"])
+
+        wide_range = tasks.get_due_tasks(BASE_ETA + timedelta(days=10), status="DONE")
+        narrow_range = tasks.get_due_tasks(
+            BASE_ETA + timedelta(days=1),
+            from_date=BASE_ETA + timedelta(days=1),
+            status="OPEN",
+        )
+
+        self.assertEqual(
+            [task["description"] for task in wide_range], ["done 0", "done 1", "done 2"]
+        )
+        self.assertEqual([task["description"] for task in narrow_range], ["open 1"])
+
+    def test_task_pages_with_status(self):
+        """Pages skip tasks with other statuses and end with no cursor"""
+        tasks = Tasks()
+        posted = [self.post(tasks, days, f"task {days}") for days in range(5)]
+        tasks.complete_task(posted[1]["_id"])
+
+        first_page, cursor = tasks.get_task_page(2, status="OPEN")
+        second_page, last_cursor = tasks.get_task_page(2, cursor, status="OPEN")
+
+        self.assertEqual([x.description for x in first_page], ["task 0", "task 2"])
+        self.assertEqual([x.description for x in second_page], ["task 3", "task 4"])
+        self.assertEqual(tasks.get_task_page(2, last_cursor), ([], None))
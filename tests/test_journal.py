@@ -0,0 +1,191 @@
+"""
+Tests for the task journal
+"""
+import os
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from journal import Journal
+from snapshot import prepare_snapshot, read_records
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+
+def snapshot_ids(path):
+    """Ids of the tasks in a snapshot"""
+    return list(read_records(path))
+
+
+# pylint: disable=missing-class-docstring
+class TestJournal(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.path = os.path.join(self.temp_dir.name, "tasks.journal")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_replay_returns_appended_entries(self):
+        """Entries come back in append order"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        journal.append([("put", "b", {"description": "B"}), ("delete", "a", None)])
+        journal.close()
+
+        entries = Journal(self.path).replay()
+
+        self.assertEqual(
+            entries,
+            [
+                ("put", "a", {"description": "A"}),
+                ("put", "b", {"description": "B"}),
+                ("delete", "a", None),
+            ],
+        )
+
+    def test_replay_of_missing_journal_is_empty(self):
+        """No journal file means nothing to replay"""
+        self.assertEqual(Journal(self.path).replay(), [])
+
+    def test_torn_record_is_discarded_and_truncated(self):
+        """A partly written final record is dropped and cut off the file"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        journal.close()
+        intact_size = os.path.getsize(self.path)
+
+        journal.append([("put", "b", {"description": "B"})])
+        journal.close()
+        with open(self.path, "r+b") as file:
+            file.truncate(os.path.getsize(self.path) - 3)
+
+        journal = Journal(self.path)
+        entries = journal.replay()
+
+        self.assertEqual(entries, [("put", "a", {"description": "A"})])
+        self.assertEqual(journal.record_count, 1)
+        self.assertEqual(os.path.getsize(self.path), intact_size)
+
+    def test_corrupt_record_is_discarded(self):
+        """A record failing its checksum is dropped with everything after it"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        journal.close()
+        with open(self.path, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            file.write(b"\x00")
+
+        self.assertEqual(Journal(self.path).replay(), [])
+
+    def test_truncate_empties_journal(self):
+        """Truncate removes all records"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        journal.truncate()
+
+        self.assertEqual(journal.record_count, 0)
+        self.assertEqual(Journal(self.path).replay(), [])
+
+    def test_roll_back_drops_later_records(self):
+        """Records appended after the offset are cut off"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        offset = journal.size()
+        journal.append([("put", "b", {"description": "B"})])
+
+        journal.roll_back(offset, 1)
+        journal.append([("delete", "a", None)])
+
+        self.assertEqual(journal.record_count, 2)
+        self.assertEqual(
+            Journal(self.path).replay(),
+            [("put", "a", {"description": "A"}), ("delete", "a", None)],
+        )
+
+    def test_discard_before_keeps_later_records(self):
+        """Records before the offset are dropped, later ones kept"""
+        journal = Journal(self.path)
+        journal.append([("put", "a", {"description": "A"})])
+        offset = journal.size()
+        journal.append([("put", "b", {"description": "B"})])
+
+        journal.discard_before(offset, 1)
+        journal.append([("delete", "a", None)])
+
+        self.assertEqual(journal.record_count, 2)
+        self.assertEqual(
+            Journal(self.path).replay(),
+            [("put", "b", {"description": "B"}), ("delete", "a", None)],
+        )
+
+    def test_discard_before_without_journal_file(self):
+        """A snapshot taken before anything was journaled leaves an empty journal"""
+        journal = Journal(self.path)
+
+        journal.discard_before(0, 0)
+
+        self.assertEqual(journal.replay(), [])
+
+
+class TestTasksRecovery(TempStoreTestCase):
+    def test_mutations_survive_restart_without_snapshot(self):
+        """Journal is replayed on top of the snapshot at load"""
+        tasks = Tasks()
+        kept = tasks.post_task(self.valid_task)
+        deleted = tasks.post_task(self.valid_task)
+        tasks.complete_task(kept["_id"])
+        tasks.delete_task(deleted["_id"])
+
+        reloaded = Tasks()
+
+        self.assertEqual(reloaded.get_tasks(), tasks.get_tasks())
+        self.assertEqual(reloaded.get_tasks(kept["_id"])[0]["status"], "DONE")
+
+    def test_journal_is_compacted_into_snapshot(self):
+        """Reaching the compaction threshold writes a snapshot and empties the journal"""
+        with mock.patch.object(settings, "JOURNAL_COMPACT_THRESHOLD", 2):
+            tasks = Tasks()
+            tasks.post_task(self.valid_task)
+            tasks.post_task(self.valid_task)
+
+        self.assertEqual(os.path.getsize(settings.TASK_JOURNAL_FILE), 0)
+        self.assertEqual(len(Tasks().get_tasks()), 2)
+
+    def test_changes_during_save_are_kept(self):
+        """A snapshot is written without the lock, changes meanwhile stay journaled"""
+        tasks = Tasks()
+        saved = tasks.post_task(self.valid_task)
+        changed = []
+
+        def prepare_snapshot_with_change(path, data):
+            # Runs in another thread, so it would block if save held the lock
+            thread = threading.Thread(
+                target=lambda: changed.append(tasks.post_task(self.valid_task))
+            )
+            thread.start()
+            thread.join(timeout=5)
+            return prepare_snapshot(path, data)
+
+        with mock.patch("storage.prepare_snapshot", prepare_snapshot_with_change):
+            tasks.save_tasks()
+
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(snapshot_ids(settings.TASK_DATA_FILE), [saved["_id"]])
+        self.assertEqual(
+            [x["_id"] for x in Tasks().get_tasks()], [saved["_id"], changed[0]["_id"]]
+        )
+
+    def test_torn_tail_recovers_earlier_mutations(self):
+        """A crash mid-append loses only the torn mutation"""
+        tasks = Tasks()
+        kept = tasks.post_task(self.valid_task)
+        tasks.post_task(self.valid_task)
+        tasks.close()
+        with open(settings.TASK_JOURNAL_FILE, "r+b") as file:
+            file.truncate(os.path.getsize(settings.TASK_JOURNAL_FILE) - 1)
+
+        reloaded = Tasks()
+
+        self.assertEqual(reloaded.get_tasks(), [kept])
@@ -0,0 +1,269 @@
+"""
+Tests for the locks and for sharing the pickle store between processes
+"""
+import os
+import threading
+from datetime import datetime
+from unittest import TestCase, mock
+
+import pytest
+from archive import Archive
+from changes import CREATED, DELETED, UPDATED
+from locks import ReadWriteLock, StoreLock
+from records import TaskRecord
+from storage import PickleStorage
+from tasks import ChangesUnavailableError, Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+ETA = datetime(2023, 6, 20, 14, 0, 0)
+
+
+# pylint: disable=missing-class-docstring
+class TestStoreLock(TempStoreTestCase):
+    def test_generation(self):
+        """The generation starts at 0 and is shared through the lock file"""
+        lock = StoreLock(settings.TASK_LOCK_FILE)
+        other = StoreLock(settings.TASK_LOCK_FILE)
+        self.addCleanup(lock.close)
+        self.addCleanup(other.close)
+
+        self.assertEqual(lock.read_generation(), 0)
+        with lock.exclusive(), lock.shared():
+            lock.write_generation(12)
+            lock.write_generation(3)
+        with other.shared():
+            self.assertEqual(other.read_generation(), 3)
+
+
+class TestReadWriteLock(TestCase):
+    def setUp(self):
+        self.lock = ReadWriteLock()
+
+    def test_readers_share_the_lock(self):
+        """Readers hold the lock together, a writer waits for them"""
+        events = []
+
+        def read():
+            with self.lock.read():
+                events.append("read")
+
+        def write():
+            with self.lock.write():
+                events.append("write")
+
+        with self.lock.read():
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(timeout=1)
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(timeout=0.1)
+            self.assertEqual(events, ["read"])
+        writer.join()
+
+        self.assertEqual(events, ["read", "write"])
+
+    def test_writer_excludes_readers(self):
+        """A reader waits for the writer, and runs once it is done"""
+        read = threading.Event()
+
+        def read_when_free():
+            with self.lock.read():
+                read.set()
+
+        with self.lock.write():
+            thread = threading.Thread(target=read_when_free)
+            thread.start()
+            self.assertFalse(read.wait(0.1))
+        thread.join()
+        self.assertTrue(read.is_set())
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        """New readers queue behind a waiting writer"""
+        order = []
+
+        def write():
+            with self.lock.write():
+                order.append("write")
+
+        def read():
+            with self.lock.read():
+                order.append("read")
+
+        with self.lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            while not self.lock._waiting_writers:  # pylint: disable=W0212
+                pass
+            reader = threading.Thread(target=read)
+            reader.start()
+            # A nested read by a reader does not wait for the writer
+            with self.lock.read():
+                pass
+        writer.join()
+        reader.join()
+
+        self.assertEqual(order, ["write", "read"])
+
+    def test_reentrancy(self):
+        """Writers can read and write again, readers cannot write"""
+        with self.lock.write(), self.lock.read(), self.lock.write():
+            self.assertTrue(self.lock.is_writing())
+        self.assertFalse(self.lock.is_writing())
+
+        with self.lock.read(), pytest.raises(RuntimeError):
+            with self.lock.write():
+                pass
+
+
+class TestMultiProcessStorage(TempStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(settings, "MULTI_PROCESS", True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        # Two storages on the same files stand in for two worker processes
+        self.first = PickleStorage()
+        self.second = PickleStorage()
+        for storage in (self.first, self.second):
+            storage.load()
+            self.addCleanup(storage.close)
+
+    def test_reads_see_other_writers(self):
+        """Puts and deletes by one storage show up in the other"""
+        self.first.put([TaskRecord("a", "Shopping", ETA, "OPEN")])
+        self.second.put([TaskRecord("b", "Cooking", ETA, "OPEN")])
+        self.first.delete(["a"])
+
+        self.assertIsNone(self.second.get("a"))
+        self.assertEqual(
+            [x.task_id for x in self.second.filter_by_status("OPEN")], ["b"]
+        )
+        self.assertEqual([x.task_id for x in self.first.range_by_eta()], ["b"])
+
+    def test_external_changes_are_described(self):
+        """Changes replayed from the journal are reported with their operation"""
+        changes = []
+        self.second.change_listener = changes.append
+        self.first.put([TaskRecord("a", "Shopping", ETA, "OPEN")])
+        self.first.put([TaskRecord("a", "Cooking", ETA, "OPEN")])
+        self.first.delete(["a"])
+        self.second.refresh()
+
+        self.assertEqual(changes, [[(CREATED, "a"), (UPDATED, "a"), (DELETED, "a")]])
+
+    def test_reads_see_compaction(self):
+        """A snapshot written by one storage is reloaded by the other"""
+        self.second.put([TaskRecord("a", "Shopping", ETA, "OPEN")])
+        self.assertEqual(len(self.first.all()), 1)
+
+        self.second.put([TaskRecord("b", "Cooking", ETA, "OPEN")])
+        self.second.save()
+        self.second.delete(["a"])
+
+        self.assertEqual([x.task_id for x in self.first.all()], ["b"])
+
+    def test_concurrent_compaction(self):
+        """Storages compacting at the same time lose no tasks and leave no files"""
+        errors = []
+
+        def post(storage, prefix):
+            try:
+                for number in range(300):
+                    storage.put(
+                        [TaskRecord(f"{prefix}{number}", "Shopping", ETA, "OPEN")]
+                    )
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                errors.append(error)
+
+        with mock.patch.object(settings, "JOURNAL_COMPACT_THRESHOLD", 5):
+            threads = [
+                threading.Thread(target=post, args=(storage, prefix))
+                for storage, prefix in ((self.first, "a"), (self.second, "b"))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        reloaded = PickleStorage()
+        reloaded.load()
+        self.addCleanup(reloaded.close)
+        self.assertEqual(len(reloaded.all()), 600)
+        directory = os.path.dirname(settings.TASK_DATA_FILE)
+        self.assertEqual([x for x in os.listdir(directory) if x.endswith(".tmp")], [])
+
+    def test_complete_does_not_lose_updates(self):
+        """Read-modify-write in one store sees the latest task of the other"""
+        first_tasks = Tasks()
+        second_tasks = Tasks()
+        self.addCleanup(first_tasks.close)
+        self.addCleanup(second_tasks.close)
+
+        task = first_tasks.post_task(dict(self.valid_task))
+        changed = dict(task, description="Cooking")
+        second_tasks.put_task(task["_id"], changed)
+        first_tasks.complete_task(task["_id"])
+
+        self.assertEqual(
+            second_tasks.get_task_records(task["_id"])[0].description, "Cooking"
+        )
+        self.assertEqual(second_tasks.get_tasks(task["_id"])[0]["status"], "DONE")
+
+    def test_loading_waits_for_archive_appends(self):
+        """A starting process does not truncate an archive append in progress"""
+        archive = Archive(settings.ARCHIVE_FILE)
+        archive.append([TaskRecord("a", "Shopping", ETA, "DONE")])
+        archive.close()
+        with open(settings.ARCHIVE_FILE, "r+b") as file:
+            record = file.read()
+            file.truncate(0)
+
+        started = []
+        with self.first.write_lock(), open(settings.ARCHIVE_FILE, "ab") as file:
+            file.write(record[:10])
+            file.flush()
+            starting = threading.Thread(target=lambda: started.append(Tasks()))
+            starting.start()
+            starting.join(0.2)
+            file.write(record[10:])
+        starting.join()
+        self.addCleanup(started[0].close)
+
+        reloaded = Archive(settings.ARCHIVE_FILE)
+        reloaded.load()
+        self.assertIn("a", reloaded)
+
+    def test_changes_are_unavailable(self):
+        """Versions are not shared, so processes refuse to list changes since one"""
+        first_tasks = Tasks()
+        self.addCleanup(first_tasks.close)
+
+        with pytest.raises(ChangesUnavailableError):
+            first_tasks.get_changes(first_tasks.get_version())
+
+    def test_versions_follow_other_writers(self):
+        """Changes by other processes bump versions like local ones"""
+        first_tasks = Tasks()
+        second_tasks = Tasks()
+        self.addCleanup(first_tasks.close)
+        self.addCleanup(second_tasks.close)
+        task = first_tasks.post_task(dict(self.valid_task))
+        version = second_tasks.get_version()
+        task_version = second_tasks.get_task_version(task["_id"])
+
+        first_tasks.put_task(task["_id"], dict(task, description="Cooking"))
+        self.assertNotEqual(second_tasks.get_task_version(task["_id"]), task_version)
+
+        version = second_tasks.get_version()
+        first_tasks.save_tasks()
+        self.assertNotEqual(second_tasks.get_version(), version)
+
+    def test_needs_sync_persistence(self):
+        """Writes queued in memory would be invisible to other processes"""
+        with mock.patch.object(settings, "PERSISTENCE_MODE", "async"):
+            with pytest.raises(ValueError):
+                PickleStorage()
@@ -0,0 +1,74 @@
+"""
+Tests for the logging setup
+"""
+import logging
+from logging.handlers import QueueHandler
+from unittest import TestCase, mock
+
+import logs
+from logs import configure_logging, log_body, stop_logging
+import settings
+
+
+class ListHandler(logging.Handler):
+    """Keeps the messages it handles"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+# pylint: disable=missing-class-docstring
+class TestLogging(TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        for handler in root.handlers:
+            self.addCleanup(root.addHandler, handler)
+
+    def test_records_are_written_through_the_queue(self):
+        """Records go through a queue to the handler at the configured level"""
+        handler = ListHandler()
+        with mock.patch.object(settings, "LOG_LEVEL", "INFO"):
+            configure_logging(handler)
+        self.addCleanup(configure_logging)
+
+        logging.debug("not written")
+        logging.info("written %d", 1)
+        stop_logging()
+
+        self.assertIsInstance(logging.getLogger().handlers[0], QueueHandler)
+        self.assertEqual(len(handler.messages), 1)
+        assert "level=INFO" in handler.messages[0]
+        assert handler.messages[0].endswith("written 1")
+
+    def test_log_body(self):
+        """Bodies are sampled and cut short"""
+        with mock.patch.multiple(
+            settings, LOG_BODY_MAX_CHARS=10, LOG_BODY_SAMPLE_RATE=1
+        ), self.assertLogs(level=logging.DEBUG) as captured:
+            log_body("Short", "abc")
+            log_body("Bytes", b"x" * 50)
+            log_body("Object", list(range(1000)))
+            settings.LOG_BODY_SAMPLE_RATE = 0
+            log_body("Skipped", b"[]")
+
+        self.assertEqual(
+            captured.output,
+            [
+                "DEBUG:root:Short = abc",
+                "DEBUG:root:Bytes = xxxxxxxxxx... (50 in total)",
+                "DEBUG:root:Object = [0, 1, 2, ...",
+            ],
+        )
+
+    def test_log_body_below_debug_level(self):
+        """Nothing is formatted unless DEBUG is enabled"""
+        with mock.patch.object(logs, "_body_repr") as body_repr:
+            logging.getLogger().setLevel(logging.INFO)
+            log_body("Object", [1])
+
+        body_repr.repr.assert_not_called()
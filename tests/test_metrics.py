@@ -0,0 +1,76 @@
+"""
+Tests for metrics
+"""
+from unittest import TestCase, mock
+
+import metrics
+from metrics import CallbackCounter, Counter, Gauge, Histogram, Registry
+import settings
+
+
+# pylint: disable=missing-class-docstring
+class TestMetrics(TestCase):
+    def test_counter(self):
+        """Counts are kept and rendered per label values"""
+        counter = Counter("requests_total", "Requests", ("route", "status"))
+        counter.inc("/tasks", 200)
+        counter.inc("/tasks", 200, amount=2)
+        counter.inc('/a"b', 500)
+
+        self.assertEqual(counter.get("/tasks", 200), 3)
+        self.assertEqual(
+            counter.render(),
+            [
+                'requests_total{route="/a\\"b",status="500"} 1',
+                'requests_total{route="/tasks",status="200"} 3',
+            ],
+        )
+
+    def test_histogram(self):
+        """Buckets are rendered cumulatively with the sum and count"""
+        histogram = Histogram("seconds", "Latency", ("route",), buckets=(0.1, 1))
+        histogram.observe(0.05, "/tasks")
+        histogram.observe(0.5, "/tasks")
+        histogram.observe(2, "/tasks")
+
+        self.assertEqual(histogram.count("/tasks"), 3)
+        self.assertEqual(
+            histogram.render(),
+            [
+                'seconds_bucket{route="/tasks",le="0.1"} 1',
+                'seconds_bucket{route="/tasks",le="1"} 2',
+                'seconds_bucket{route="/tasks",le="+Inf"} 3',
+                'seconds_sum{route="/tasks"} 2.55',
+                'seconds_count{route="/tasks"} 3',
+            ],
+        )
+
+    def test_sampling(self):
+        """Unsampled calls are not timed"""
+        histogram = Histogram("seconds", "Latency")
+        with mock.patch.object(settings, "METRICS_SAMPLE_RATE", 0):
+            histogram.observe_since(metrics.start_timer())
+        with mock.patch.object(settings, "METRICS_SAMPLE_RATE", 1):
+            histogram.observe_since(metrics.start_timer())
+
+        self.assertEqual(histogram.count(), 1)
+
+    def test_registry(self):
+        """Metrics are rendered with their help and type"""
+        registry = Registry()
+        registry.register(Counter("saved_bytes_total", "Bytes saved")).inc(amount=5)
+        registry.register(Gauge("tasks", "Tasks", ("status",), lambda: {("OPEN",): 2}))
+        registry.register(CallbackCounter("hits_total", "Hits", (), lambda: {(): 3}))
+
+        self.assertEqual(
+            registry.render(),
+            "# HELP saved_bytes_total Bytes saved\n"
+            "# TYPE saved_bytes_total counter\n"
+            "saved_bytes_total 5\n"
+            "# HELP tasks Tasks\n"
+            "# TYPE tasks gauge\n"
+            'tasks{status="OPEN"} 2\n'
+            "# HELP hits_total Hits\n"
+            "# TYPE hits_total counter\n"
+            "hits_total 3\n",
+        )
@@ -0,0 +1,99 @@
+"""
+Tests for task stamps, If-Match updates and modified_since queries
+"""
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from tasks import InvalidTaskError, Tasks, VersionConflictError
+import settings
+from .store_helpers import TempStoreTestCase
+
+BASE_TIME = datetime(2023, 6, 20, 14, 0, 0)
+
+
+# pylint: disable=missing-class-docstring
+class TestModified(TempStoreTestCase):
+    def test_changes_are_stamped(self):
+        """Tasks keep their creation time, their update time and version follow changes"""
+        tasks = Tasks()
+        created = tasks.post_task(self.valid_task)
+        self.assertEqual(created["updated_at"], created["created_at"])
+        self.assertEqual(created["version"], 1)
+
+        updated = tasks.put_task(created["_id"], dict(created, description="Baking"))
+        completed = tasks.complete_task(created["_id"])
+        batch = tasks.post_tasks([completed, completed, self.valid_task])
+
+        self.assertEqual(updated["created_at"], created["created_at"])
+        self.assertGreaterEqual(updated["updated_at"], created["updated_at"])
+        self.assertEqual(
+            [x["version"] for x in (updated, completed, *batch)], [2, 3, 4, 5, 1]
+        )
+        self.assertEqual(tasks.complete_tasks([created["_id"]])[0]["version"], 6)
+        tasks.close()
+        self.assertEqual(Tasks().get_tasks(created["_id"])[0]["version"], 6)
+
+    def test_put_with_if_match(self):
+        """Updates only go through at one of the versions given"""
+        tasks = Tasks()
+        task = tasks.post_task(self.valid_task)
+
+        with pytest.raises(VersionConflictError):
+            tasks.put_task(task["_id"], dict(task, description="Stale"), {"0", "2"})
+        self.assertEqual(tasks.get_tasks(task["_id"]), [task])
+
+        etag = tasks.get_task_version(task["_id"])
+        updated = tasks.put_task(task["_id"], dict(task, description="Fresh"), {"1"})
+        with pytest.raises(VersionConflictError):
+            tasks.put_task(task["_id"], task, {etag})
+        tasks.put_task(task["_id"], updated, {tasks.get_task_version(task["_id"])})
+        self.assertEqual(
+            tasks.put_task(task["_id"], updated, {"*"})["description"], "Fresh"
+        )
+        with pytest.raises(VersionConflictError):
+            tasks.put_task("missing", self.valid_task, {"*"})
+        self.assertEqual(tasks.get_tasks("missing"), [])
+        tasks.close()
+
+    def test_modified_since(self):
+        """Tasks changed since a time are listed in update order, filtered by eta"""
+        tasks = Tasks()
+        early = tasks.post_task(dict(self.valid_task, eta=BASE_TIME))
+        late = tasks.post_task(dict(self.valid_task, eta=BASE_TIME + timedelta(days=1)))
+        deleted = tasks.post_task(self.valid_task)
+        early = tasks.complete_task(early["_id"])
+        tasks.delete_task(deleted["_id"])
+
+        since = late["updated_at"]
+        self.assertEqual(tasks.get_modified_tasks(since), [late, early])
+        self.assertEqual(tasks.get_modified_tasks(since, status="DONE"), [early])
+        self.assertEqual(
+            tasks.get_modified_tasks(since, due_date=BASE_TIME + timedelta(hours=1)),
+            [early],
+        )
+        self.assertEqual(
+            tasks.get_modified_tasks(since, from_date=BASE_TIME + timedelta(hours=1)),
+            [late],
+        )
+        self.assertEqual(
+            tasks.get_modified_tasks(early["updated_at"] + timedelta(seconds=1)), []
+        )
+        with pytest.raises(InvalidTaskError):
+            tasks.get_modified_tasks(since, status="BLUE")
+        tasks.close()
+
+    def test_modified_since_on_every_backend(self):
+        """Every storage backend answers modified_since queries"""
+        for backend in ("pickle", "columnar", "sqlite"):
+            with mock.patch.object(settings, "STORAGE_BACKEND", backend):
+                tasks = Tasks()
+                first = tasks.post_task(self.valid_task)
+                second = tasks.post_task(self.valid_task)
+                first = tasks.put_task(first["_id"], first, {"1"})
+
+                self.assertEqual(
+                    tasks.get_modified_tasks(first["created_at"]), [second, first]
+                )
+                tasks.delete_tasks([first["_id"], second["_id"]])
+                tasks.close()
@@ -0,0 +1,181 @@
+"""
+Tests for journal durability modes
+"""
+import os
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+import pytest
+from journal import Journal
+from persistence import JournalWriter, ASYNC, GROUP_COMMIT, SYNC, deferred_waits
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+
+# pylint: disable=missing-class-docstring
+class TestJournalWriter(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.path = os.path.join(self.temp_dir.name, "tasks.journal")
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        self.temp_dir.cleanup()
+
+    def test_unknown_mode_is_rejected(self):
+        """Only the known modes are accepted"""
+        with pytest.raises(ValueError):
+            JournalWriter(self.journal, "eventually")
+
+    def test_sync_mode_fsyncs_every_write(self):
+        """Each write is on disk when it returns"""
+        writer = JournalWriter(self.journal, SYNC)
+
+        with mock.patch("os.fsync") as fsync:
+            writer.write([("put", "a", None)])
+            writer.write([("put", "b", None)])
+
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(len(Journal(self.path).replay()), 2)
+
+    def test_group_commit_batches_concurrent_writes(self):
+        """Concurrent writers share fsyncs and each waits for its batch"""
+        writer = JournalWriter(self.journal, GROUP_COMMIT, interval=0.05)
+        written = []
+
+        def write(task_id):
+            writer.write([("put", task_id, None)])
+            written.append(len(Journal(self.path).replay()))
+
+        with mock.patch("os.fsync") as fsync:
+            threads = [
+                threading.Thread(target=write, args=(str(x),)) for x in range(10)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            writer.close()
+
+        # Every writer found at least its own record on disk when write returned
+        assert all(count >= 1 for count in written)
+        self.assertEqual(len(Journal(self.path).replay()), 10)
+        self.assertLess(fsync.call_count, 10)
+
+    def test_async_writes_are_flushed_by_threshold(self):
+        """A full batch is written without waiting for the interval"""
+        writer = JournalWriter(self.journal, ASYNC, interval=60, max_pending=2)
+        flushed = threading.Event()
+        original_sync = self.journal.sync
+
+        def sync():
+            original_sync()
+            flushed.set()
+
+        with mock.patch.object(self.journal, "sync", sync):
+            writer.write([("put", "a", None)])
+            writer.write([("put", "b", None)])
+
+            assert flushed.wait(5)
+        self.assertEqual(len(Journal(self.path).replay()), 2)
+        writer.close()
+
+    def test_close_flushes_async_writes(self):
+        """Queued writes are on disk after close"""
+        writer = JournalWriter(self.journal, ASYNC, interval=60)
+        writer.write([("put", "a", None)])
+
+        writer.close()
+
+        self.assertEqual(Journal(self.path).replay(), [("put", "a", None)])
+
+    def test_group_commit_raises_write_errors(self):
+        """Writers waiting on a failed batch get the error"""
+        writer = JournalWriter(self.journal, GROUP_COMMIT)
+
+        with mock.patch.object(self.journal, "sync", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                writer.write([("put", "a", None)])
+
+        writer.close()
+
+    def test_failed_batches_are_written_again(self):
+        """Records of a failed batch reach disk once it recovers, errors then clear"""
+        writer = JournalWriter(self.journal, GROUP_COMMIT)
+
+        with mock.patch.object(self.journal, "sync", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                writer.write([("put", "a", None)])
+        writer.write([("put", "b", None)])
+        writer.close()
+
+        self.assertEqual(
+            Journal(self.path).replay(), [("put", "a", None), ("put", "b", None)]
+        )
+
+    def test_sync_write_errors_leave_no_record(self):
+        """A failed sync write is cut off the journal, so later writes survive"""
+        writer = JournalWriter(self.journal, SYNC)
+
+        with mock.patch.object(self.journal, "sync", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                writer.write([("put", "a", None)])
+        writer.write([("put", "b", None)])
+        writer.close()
+
+        self.assertEqual(Journal(self.path).replay(), [("put", "b", None)])
+
+    def test_deferred_waits(self):
+        """Writes inside deferred_waits return before their batch is on disk"""
+        writer = JournalWriter(self.journal, GROUP_COMMIT, interval=60)
+
+        with deferred_waits() as waits:
+            writer.write([("put", "a", None)])
+        self.assertEqual(waits, [(writer, 1)])
+        self.assertEqual(Journal(self.path).replay(), [])
+
+        writer.flush()
+        writer.wait(1)
+        self.assertEqual(Journal(self.path).replay(), [("put", "a", None)])
+        writer.close()
+
+
+class TestTasksPersistenceModes(TempStoreTestCase):
+    def test_modes_persist_tasks(self):
+        """Tasks written in every mode are loaded back after close"""
+        for mode in (SYNC, GROUP_COMMIT, ASYNC):
+            with mock.patch.object(settings, "PERSISTENCE_MODE", mode):
+                tasks = Tasks()
+                saved = tasks.post_task(self.valid_task)
+                tasks.close()
+
+            self.assertEqual(Tasks().get_tasks(saved["_id"]), [saved])
+
+    def test_failed_writes_are_not_applied(self):
+        """A change the journal refused is not kept in memory, nor lost after it"""
+        tasks = Tasks()
+        with mock.patch("os.fsync", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                tasks.post_task(self.valid_task)
+        self.assertEqual(tasks.get_tasks(), [])
+
+        saved = tasks.post_task(self.valid_task)
+        tasks.close()
+        self.assertEqual(Tasks().get_tasks(), [saved])
+
+    def test_save_tasks_writes_queued_changes(self):
+        """A snapshot taken with changes still queued loses none of them"""
+        with mock.patch.object(settings, "PERSISTENCE_MODE", ASYNC), mock.patch.object(
+            settings, "FLUSH_INTERVAL", 60
+        ):
+            tasks = Tasks()
+            saved = tasks.post_task(self.valid_task)
+            tasks.save_tasks()
+            tasks.post_task(self.valid_task)
+            tasks.close()
+
+        self.assertEqual(len(Tasks().get_tasks()), 2)
+        self.assertEqual(Tasks().get_tasks(saved["_id"]), [saved])
@@ -0,0 +1,47 @@
+"""
+Tests for the response cache
+"""
+from unittest import TestCase
+
+from response_cache import ResponseCache
+
+
+# pylint: disable=missing-class-docstring
+class TestResponseCache(TestCase):
+    def test_hits_and_misses(self):
+        """Lookups are counted as hits or misses"""
+        cache = ResponseCache(100)
+        cache.put("a", b"[]", {"X-Next-Cursor": "c"})
+
+        self.assertEqual(cache.get("a"), (b"[]", {"X-Next-Cursor": "c"}))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 1, "entries": 1, "bytes": 2}
+        )
+
+    def test_least_recently_used_are_evicted(self):
+        """Entries over the byte budget are evicted, least recently used first"""
+        cache = ResponseCache(10)
+        cache.put("a", b"aaaa", {})
+        cache.put("b", b"bbbb", {})
+        cache.get("a")
+        cache.put("c", b"cccc", {})
+        cache.put("huge", b"x" * 11, {})
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertIsNone(cache.get("huge"))
+        self.assertEqual(cache.size, 8)
+
+    def test_replace_and_clear(self):
+        """Replacing an entry frees its old body and clear drops everything"""
+        cache = ResponseCache(10)
+        cache.put("a", b"aaaa", {})
+        cache.put("a", b"aa", {})
+        self.assertEqual(cache.size, 2)
+
+        cache.clear(["task id"])
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
@@ -0,0 +1,156 @@
+"""
+Tests for the due task scheduler
+"""
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import scheduler
+from scheduler import DISPATCH_LAG_SECONDS, DISPATCHED_TASKS, DISPATCH_RETRIES
+from scheduler import DueScheduler
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Records posted JSON bodies, answering 503 to the first `failures` posts"""
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handles a webhook post"""
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            failing = server.failures > 0
+            server.failures -= 1
+        self.send_response(503 if failing else 204)
+        self.end_headers()
+        if not failing:
+            server.received.put(json.loads(body))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keeps the test output quiet"""
+
+
+# pylint: disable=missing-class-docstring
+class TestDueScheduler(TempStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tasks = Tasks()
+        self.scheduler = DueScheduler(self.tasks)
+        self.tasks.add_change_listener(self.scheduler.changed)
+        self.received = queue.Queue()
+
+    def tearDown(self):
+        self.scheduler.close()
+        self.tasks.close()
+        super().tearDown()
+
+    def post(self, seconds, **task):
+        """Posts a task due some seconds from now"""
+        eta = datetime.now() + timedelta(seconds=seconds)
+        return self.tasks.post_task(dict(self.valid_task, eta=eta, **task))
+
+    def next_batch(self):
+        """Waits for the callback to receive a batch"""
+        return self.received.get(timeout=5)
+
+    def test_tasks_are_sent_as_they_become_due(self):
+        """Only OPEN tasks are sent, at their latest eta, and only once"""
+        self.post(-60, description="Due before the callback")
+        self.scheduler.add_callback("test", self.received.put)
+        overdue = self.post(-60, description="Posted overdue")
+        self.assertEqual(self.next_batch(), [overdue])
+
+        later = self.post(0.6, description="Later")
+        sooner = self.post(0.8, description="Sooner")
+        sooner = self.tasks.put_task(
+            sooner["_id"], dict(sooner, eta=datetime.now() + timedelta(seconds=0.2))
+        )
+        completed = self.post(0.1, description="Completed")
+        self.tasks.complete_task(completed["_id"])
+        deleted = self.post(0.1, description="Deleted")
+        self.tasks.delete_task(deleted["_id"])
+
+        self.assertEqual(self.next_batch(), [sooner])
+        self.assertEqual(self.next_batch(), [later])
+
+        self.tasks.put_task(later["_id"], dict(later, description="Renamed"))
+        self.post(0.1, description="Next")
+        self.assertEqual([x["description"] for x in self.next_batch()], ["Next"])
+        self.assertEqual(self.scheduler.scheduled_count(), 0)
+
+    def test_due_tasks_are_batched(self):
+        """Tasks due together are sent in batches of at most DUE_BATCH_SIZE"""
+        with mock.patch.object(settings, "DUE_BATCH_SIZE", 2):
+            self.scheduler.add_callback("batched", self.received.put)
+        self.tasks.post_tasks(
+            [dict(self.valid_task, eta=datetime.now()) for _ in range(5)]
+        )
+
+        sizes = [len(self.next_batch())]
+        while sum(sizes) < 5:
+            sizes.append(len(self.next_batch()))
+        self.assertLessEqual(max(sizes), 2)
+
+    def test_failed_sends_are_retried_then_dropped(self):
+        """Sends are retried with backoff, up to DUE_RETRIES times"""
+        calls = []
+
+        def fail(tasks):
+            calls.append(tasks)
+            raise ValueError("unreachable")
+
+        failed = DISPATCHED_TASKS.get("failing", "failed")
+        with mock.patch.multiple(settings, DUE_RETRIES=2, DUE_RETRY_BACKOFF=0.01):
+            self.scheduler.add_callback("failing", fail)
+        self.post(-1)
+
+        deadline = time.monotonic() + 5
+        while DISPATCHED_TASKS.get("failing", "failed") == failed:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(DISPATCH_RETRIES.get("failing"), 2)
+
+    def test_webhook_against_a_stand_in_server(self):
+        """Due tasks are posted to webhooks as JSON, retried after errors"""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        server.lock = threading.Lock()
+        server.failures = 1
+        server.received = self.received
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/due"
+
+        with mock.patch.object(settings, "DUE_RETRY_BACKOFF", 0.01):
+            self.scheduler.add_webhook(url)
+        task = self.post(0.05)
+
+        self.assertEqual([x["_id"] for x in self.next_batch()], [task["_id"]])
+        self.scheduler.close()
+        self.assertEqual(DISPATCH_RETRIES.get(url), 1)
+        self.assertEqual(DISPATCHED_TASKS.get(url, "delivered"), 1)
+        self.assertEqual(DISPATCH_LAG_SECONDS.count(url), 1)
+
+    def test_stale_heap_entries_are_dropped(self):
+        """Rescheduled tasks do not pile up in the heap"""
+        with mock.patch.object(scheduler, "COMPACT_MIN_STALE", 0):
+            self.scheduler.add_callback("test", self.received.put)
+            task = self.post(60)
+            for minutes in range(2, 6):
+                self.tasks.put_task(
+                    task["_id"],
+                    dict(task, eta=datetime.now() + timedelta(minutes=minutes)),
+                )
+            self.post(-1)
+            self.next_batch()
+
+        # pylint: disable=protected-access
+        self.assertLessEqual(len(self.scheduler._heap), 2)
+        self.assertEqual(self.scheduler.scheduled_count(), 1)
@@ -0,0 +1,133 @@
+"""
+Tests for full-text search
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+import search
+from search import InvalidSearchError, parse_query, tokenize
+from tasks import InvalidTaskError, Tasks
+from .store_helpers import TempStoreTestCase
+
+
+# pylint: disable=missing-class-docstring
+class TestSearch(TempStoreTestCase):
+    def post(self, tasks, description, **task):
+        """Posts a task with a description, due a minute after the one before"""
+        self.posted += 1
+        eta = datetime(2023, 6, 20) + timedelta(minutes=self.posted)
+        return tasks.post_task(
+            dict(self.valid_task, description=description, eta=eta, **task)
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.posted = 0
+
+    def test_tokenize_and_parse_query(self):
+        """Words are case-insensitive, a trailing * makes the last word a prefix"""
+        self.assertEqual(tokenize("Buy milk, buy EGGS!"), {"buy", "eggs", "milk"})
+        self.assertEqual(
+            parse_query("Milk  e-mail*"),
+            [("milk", False), ("e", False), ("mail", True)],
+        )
+        with pytest.raises(InvalidSearchError):
+            parse_query(" * - ")
+
+    def test_search_follows_changes(self):
+        """Posted, updated, completed and deleted tasks are found as they now are"""
+        tasks = Tasks()
+        milk = self.post(tasks, "Buy milk")
+        eggs = self.post(tasks, "Buy eggs")
+        self.assertEqual(tasks.search_tasks("buy"), [milk, eggs])
+
+        oats = tasks.put_task(milk["_id"], dict(self.valid_task, description="Oats"))
+        self.assertEqual(tasks.search_tasks("milk"), [])
+        self.assertEqual(tasks.search_tasks("oats"), [oats])
+
+        done = tasks.complete_task(eggs["_id"])
+        self.assertEqual(tasks.search_tasks("eggs", status="DONE"), [done])
+        self.assertEqual(tasks.search_tasks("eggs", status="OPEN"), [])
+
+        tasks.delete_task(eggs["_id"])
+        self.assertEqual(tasks.search_tasks("buy"), [])
+        self.assertEqual(tasks.search_tasks("egg* b*"), [])
+        tasks.close()
+
+    def test_prefix_and_multi_term_queries(self):
+        """All words must match, prefixes match any word starting with them"""
+        tasks = Tasks()
+        paint = self.post(tasks, "Paint the garden fence")
+        garage = self.post(tasks, "Clean the garage")
+        self.post(tasks, "Water the plants")
+
+        self.assertEqual(tasks.search_tasks("gar*"), [paint, garage])
+        self.assertEqual(tasks.search_tasks("the gar* clean"), [garage])
+        self.assertEqual(tasks.search_tasks("fen* gar*"), [paint])
+        self.assertEqual(tasks.search_tasks("gardening"), [])
+        self.assertEqual(tasks.search_tasks("zz*"), [])
+        with mock.patch.object(search, "PREFIX_CHECK_LIMIT", 0):
+            self.assertEqual(tasks.search_tasks("the gar* clean"), [garage])
+        with mock.patch.object(search, "SORT_WORDS_LIMIT", 0):
+            gardener = self.post(tasks, "Call the gardener")
+            self.assertEqual(tasks.search_tasks("garde*"), [paint, gardener])
+        tasks.close()
+
+    def test_due_filters(self):
+        """Matches are filtered by eta and ordered by it"""
+        tasks = Tasks()
+        late = tasks.put_task(
+            self.post(tasks, "Call Bob")["_id"],
+            dict(self.valid_task, description="Call Bob", eta=datetime(2023, 6, 22)),
+        )
+        early = self.post(tasks, "Call Ann")
+
+        self.assertEqual(tasks.search_tasks("call"), [early, late])
+        self.assertEqual(
+            tasks.search_tasks("call", due_date=datetime(2023, 6, 21)), [early]
+        )
+        self.assertEqual(
+            tasks.search_tasks("call", from_date=datetime(2023, 6, 21)), [late]
+        )
+        with pytest.raises(InvalidTaskError):
+            tasks.search_tasks("call", status="BLUE")
+        tasks.close()
+
+    def test_index_is_rebuilt_after_load(self):
+        """A restarted store finds the saved and journaled tasks"""
+        tasks = Tasks()
+        saved = self.post(tasks, "Renew passport")
+        tasks.save_tasks()
+        journaled = self.post(tasks, "Passport photos")
+        tasks.close()
+
+        reloaded = Tasks()
+        self.assertEqual(reloaded.search_tasks("passport"), [saved, journaled])
+        reloaded.load_tasks()
+        self.assertEqual(reloaded.search_tasks("photo*"), [journaled])
+        reloaded.close()
+
+    def test_index_is_built_at_load_and_kept(self):
+        """The index is built in the background, and reloads keep what is unchanged"""
+        tasks = Tasks()
+        passport = self.post(tasks, "Renew passport")
+        photos = self.post(tasks, "Passport photos")
+        tasks.close()
+
+        tasks = Tasks()
+        self.addCleanup(tasks.close)
+        while any(x.name == "search-warm-up" for x in threading.enumerate()):
+            time.sleep(0.01)
+
+        with mock.patch("search.tokenize", wraps=search.tokenize) as tokenizer:
+            self.assertEqual(tasks.search_tasks("passport"), [passport, photos])
+            tasks.load_tasks()
+            self.assertEqual(tasks.search_tasks("photos"), [photos])
+            self.assertEqual(tokenizer.call_count, 0)
+
+            tasks.put_task(photos["_id"], dict(photos, description="Visa photos"))
+            self.assertEqual(tasks.search_tasks("passport"), [passport])
+            self.assertEqual(tokenizer.call_count, 2)
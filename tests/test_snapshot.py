@@ -0,0 +1,182 @@
+"""
+Tests for indexed snapshots
+"""
+import os
+import pickle
+import zlib
+from datetime import datetime
+from unittest import mock
+
+import pytest
+from records import TaskRecord
+from snapshot import (
+    CorruptSnapshotError,
+    ENTRY,
+    HEADER,
+    HEADERS,
+    IndexedSnapshot,
+    SnapshotRecords,
+    prepare_snapshot,
+    read_records,
+    read_snapshot,
+)
+from tasks import Tasks
+import settings
+from .store_helpers import TempStoreTestCase
+
+RECORDS = {
+    "b": TaskRecord(
+        "b",
+        "Shopping",
+        datetime(2023, 6, 21, 14, 0, 0),
+        "OPEN",
+        datetime(2023, 6, 1),
+        datetime(2023, 6, 2),
+        2,
+    ),
+    "a": TaskRecord(
+        "a",
+        "Cook 🍳 \udcff",
+        datetime(2023, 6, 20),
+        "DONE",
+        datetime(2023, 6, 1),
+        datetime(2023, 6, 1, 12),
+        1,
+    ),
+    "c": TaskRecord("c", "", datetime(1960, 1, 1, 0, 0, 0, 5), "OPEN"),
+}
+
+
+def write_version_1(path):
+    """Rewrites the snapshot at path as a version 1 snapshot, without the stamps"""
+    with open(path, "rb") as file:
+        data = file.read()
+    fields = HEADERS[2].unpack_from(data)
+    ids_offset, stamps_offset, entries_offset = fields[3], fields[8], fields[10]
+    shift = HEADERS[2].size - HEADERS[1].size
+    entries = b"".join(
+        ENTRY.pack(offset - shift, length, checksum)
+        for offset, length, checksum in ENTRY.iter_unpack(data[entries_offset:])
+    )
+    sections = data[ids_offset:stamps_offset] + entries
+    offsets = [x - shift for x in fields[3:8]] + [stamps_offset - shift]
+
+    with open(path, "wb") as file:
+        file.write(
+            HEADERS[1].pack(fields[0], 1, fields[2], *offsets, zlib.crc32(sections))
+        )
+        file.write(data[HEADERS[2].size : ids_offset] + sections)
+
+
+# pylint: disable=missing-class-docstring
+class TestIndexedSnapshot(TempStoreTestCase):
+    def write(self, records):
+        """Writes records as the snapshot"""
+        temp_path, _ = prepare_snapshot(settings.TASK_DATA_FILE, records)
+        os.replace(temp_path, settings.TASK_DATA_FILE)
+
+    def corrupt(self, position):
+        """Flips a byte of the snapshot"""
+        with open(settings.TASK_DATA_FILE, "r+b") as file:
+            file.seek(position)
+            byte = file.read(1)
+            file.seek(position)
+            file.write(bytes([byte[0] ^ 0xFF]))
+
+    def test_roundtrip(self):
+        """Tasks, lone surrogates included, read back as written"""
+        self.write(RECORDS)
+
+        snapshot = read_snapshot(settings.TASK_DATA_FILE)
+        ids, ids_by_status, eta_keys, updated_keys = snapshot.read_index()
+
+        assert isinstance(snapshot, IndexedSnapshot)
+        self.assertEqual(ids, ["b", "a", "c"])
+        self.assertEqual(ids_by_status, {"OPEN": ["b", "c"], "DONE": ["a"]})
+        self.assertEqual(eta_keys, sorted(x.eta_key for x in RECORDS.values()))
+        self.assertEqual(
+            updated_keys, [(datetime(2023, 6, 1, 12), "a"), (datetime(2023, 6, 2), "b")]
+        )
+        self.assertEqual(read_records(settings.TASK_DATA_FILE), RECORDS)
+
+    def test_version_1_snapshots_load(self):
+        """Snapshots written before tasks were stamped load with no stamps"""
+        self.write(RECORDS)
+        write_version_1(settings.TASK_DATA_FILE)
+
+        snapshot = read_snapshot(settings.TASK_DATA_FILE)
+
+        self.assertEqual(snapshot.read_index()[3], [])
+        self.assertEqual(
+            read_records(settings.TASK_DATA_FILE),
+            {task_id: TaskRecord(*record[:4]) for task_id, record in RECORDS.items()},
+        )
+        tasks = Tasks()
+        self.assertEqual(len(tasks.get_tasks()), 3)
+        self.assertEqual(tasks.get_modified_tasks(datetime(2000, 1, 1)), [])
+        tasks.close()
+
+    def test_records_are_decoded_on_first_read(self):
+        """Tasks stay undecoded until read, then are kept"""
+        self.write(RECORDS)
+        snapshot = read_snapshot(settings.TASK_DATA_FILE)
+        records = SnapshotRecords(snapshot, snapshot.read_index()[0])
+
+        first_read = records["a"]
+
+        self.assertEqual(first_read, RECORDS["a"])
+        assert records.get("a") is first_read
+        self.assertEqual(records.undecoded(), ["b", "c"])
+        self.assertEqual(records.copy().undecoded(), ["b", "c"])
+        self.assertEqual(records.to_dict(), RECORDS)
+
+    def test_corrupt_index_is_detected(self):
+        """A snapshot whose index fails the checksum is not loaded"""
+        self.write(RECORDS)
+        self.corrupt(os.path.getsize(settings.TASK_DATA_FILE) - 1)
+
+        with pytest.raises(CorruptSnapshotError):
+            read_snapshot(settings.TASK_DATA_FILE)
+
+    def test_corrupt_record_is_detected(self):
+        """A task failing its checksum raises when it is decoded"""
+        self.write(RECORDS)
+        self.corrupt(HEADER.size)
+        snapshot = read_snapshot(settings.TASK_DATA_FILE)
+        records = SnapshotRecords(snapshot, snapshot.read_index()[0])
+
+        self.assertEqual(records["a"], RECORDS["a"])
+        with pytest.raises(CorruptSnapshotError):
+            records.get("b")
+
+    def test_pickle_format(self):
+        """Snapshots are pickled with SNAPSHOT_FORMAT = "pickle", and still load"""
+        tasks = Tasks()
+        task = tasks.post_task(self.valid_task)
+        with mock.patch.object(settings, "SNAPSHOT_FORMAT", "pickle"):
+            tasks.save_tasks()
+
+        with open(settings.TASK_DATA_FILE, "rb") as file:
+            self.assertEqual(list(pickle.load(file)), [task["_id"]])
+        self.assertEqual(Tasks().get_tasks(task["_id"]), [task])
+
+    def test_storage_loads_lazily_and_warms_up(self):
+        """The store serves tasks straight from the snapshot, then from a dict"""
+        tasks = Tasks()
+        saved = [tasks.post_task(self.valid_task) for _ in range(3)]
+        tasks.save_tasks()
+        tasks.close()
+
+        with mock.patch.object(settings, "SNAPSHOT_WARM_UP", False):
+            lazy_tasks = Tasks()
+        # pylint: disable=protected-access
+        assert isinstance(lazy_tasks._storage.records, SnapshotRecords)
+        self.assertEqual(lazy_tasks.get_tasks(saved[1]["_id"]), saved[1:2])
+        self.assertEqual(lazy_tasks.get_tasks(), saved)
+        lazy_tasks.close()
+
+        warm_tasks = Tasks()
+        warm_tasks._storage._warm_up_thread.join()
+        assert isinstance(warm_tasks._storage.records, dict)
+        self.assertEqual(warm_tasks.get_tasks(), saved)
+        warm_tasks.close()
@@ -0,0 +1,351 @@
+"""
+Tests for the storage backends
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from columnar_storage import ColumnarStorage, TaskColumns
+from records import TaskRecord
+from storage import PickleStorage
+from sqlite_storage import SqliteStorage
+from tasks import Tasks, VersionConflictError
+import settings
+from .store_helpers import TempStoreTestCase
+
+BASE_ETA = datetime(2023, 6, 20, 14, 0, 0)
+
+
+def make_record(task_id, days, status="OPEN"):
+    """Builds a record with an eta relative to BASE_ETA"""
+    return TaskRecord(
+        task_id, f"task {task_id}", BASE_ETA + timedelta(days=days), status
+    )
+
+
+def make_stamped(task_id, hours, version=1):
+    """Builds a record updated some hours after BASE_ETA"""
+    updated_at = BASE_ETA + timedelta(hours=hours)
+    return make_record(task_id, 0)._replace(
+        created_at=BASE_ETA, updated_at=updated_at, version=version
+    )
+
+
+# pylint: disable=missing-class-docstring
+class StorageContract:
+    """
+    Behaviour every storage backend must have, mixed into a TempStoreTestCase
+    for each backend below.
+    """
+
+    # pylint: disable=no-member,invalid-name
+    storage_class = None
+
+    def setUp(self):
+        """Opens a storage holding four tasks"""
+        super().setUp()
+        self.storage = self.open_storage()
+        self.storage.put(
+            [
+                make_record("c", 2),
+                make_record("a", 1, "DONE"),
+                make_record("b", 1),
+                make_record("d", 3, "CANCELLED"),
+            ]
+        )
+
+    def tearDown(self):
+        """Closes the storage"""
+        self.storage.close()
+        super().tearDown()
+
+    def open_storage(self):
+        """Opens and loads a storage of the backend under test"""
+        storage = self.storage_class()  # pylint: disable=not-callable
+        storage.load()
+        return storage
+
+    def test_get_and_all(self):
+        """Tasks are found by id and listed in creation order"""
+        self.assertEqual(self.storage.get("a"), make_record("a", 1, "DONE"))
+        self.assertIsNone(self.storage.get("missing"))
+        self.assertEqual(
+            [record.task_id for record in self.storage.all()], ["c", "a", "b", "d"]
+        )
+
+    def test_put_replaces_task(self):
+        """Putting an existing id replaces the task and keeps its position"""
+        self.storage.put([make_record("c", 0, "DONE")])
+
+        self.assertEqual(self.storage.get("c"), make_record("c", 0, "DONE"))
+        self.assertEqual(
+            [record.task_id for record in self.storage.all()], ["c", "a", "b", "d"]
+        )
+        self.assertEqual(
+            [record.task_id for record in self.storage.filter_by_status("OPEN")], ["b"]
+        )
+
+    def test_delete(self):
+        """Only deleted ids are reported"""
+        self.assertEqual(self.storage.delete(["a", "missing"]), ["a"])
+        self.assertIsNone(self.storage.get("a"))
+        self.assertEqual(self.storage.filter_by_status("DONE"), [])
+
+    def test_range_by_eta(self):
+        """Ranges are ordered by (eta, id) and combine with status and paging"""
+
+        def ids(**kwargs):
+            return [record.task_id for record in self.storage.range_by_eta(**kwargs)]
+
+        self.assertEqual(ids(), ["a", "b", "c", "d"])
+        self.assertEqual(
+            ids(start=BASE_ETA + timedelta(days=2), end=BASE_ETA + timedelta(days=3)),
+            ["c", "d"],
+        )
+        self.assertEqual(
+            ids(end=BASE_ETA + timedelta(days=2), status="OPEN"), ["b", "c"]
+        )
+        self.assertEqual(ids(status="DONE"), ["a"])
+        self.assertEqual(ids(limit=2), ["a", "b"])
+        self.assertEqual(ids(after=(BASE_ETA + timedelta(days=1), "b"), limit=1), ["c"])
+        self.assertEqual(
+            ids(after=(BASE_ETA + timedelta(days=1), "a"), status="OPEN"), ["b", "c"]
+        )
+
+    def test_count_by_eta(self):
+        """Counts match the ranges they count"""
+        self.assertEqual(self.storage.count_by_eta(), 4)
+        self.assertEqual(self.storage.count_by_eta(end=BASE_ETA + timedelta(days=2)), 3)
+        self.assertEqual(
+            self.storage.count_by_eta(
+                start=BASE_ETA + timedelta(days=2), status="OPEN"
+            ),
+            1,
+        )
+
+    def test_count_by_status(self):
+        """Only statuses with tasks are counted"""
+        self.storage.delete(["d"])
+
+        self.assertEqual(self.storage.count_by_status(), {"OPEN": 2, "DONE": 1})
+
+    def test_range_by_update(self):
+        """Stamped tasks are ranged by (updated_at, id), through changes and reopening"""
+
+        def ids(storage, hours):
+            start = BASE_ETA + timedelta(hours=hours)
+            return [record.task_id for record in storage.range_by_update(start)]
+
+        self.storage.put([make_stamped("e", 2), make_stamped("f", 1)])
+        self.storage.put([make_stamped("g", 1), make_stamped("e", 3, 2)])
+        self.storage.delete(["g"])
+
+        self.assertEqual(ids(self.storage, 0), ["f", "e"])
+        self.assertEqual(ids(self.storage, 3), ["e"])
+        self.assertEqual(self.storage.range_by_update(BASE_ETA)[1].version, 2)
+        self.storage.save()
+        self.storage.put([make_stamped("h", 4)])
+        self.storage.close()
+
+        reopened = self.open_storage()
+        self.assertEqual(ids(reopened, 1), ["f", "e", "h"])
+        self.assertEqual(reopened.get("e"), make_stamped("e", 3, 2))
+        reopened.close()
+
+    def test_changes_survive_reopening(self):
+        """A reopened storage has every change"""
+        self.storage.delete(["d"])
+        self.storage.put([make_record("e", 4)])
+        self.storage.save()
+        self.storage.put([make_record("a", 1)])
+        self.storage.close()
+
+        reopened = self.open_storage()
+
+        self.assertEqual(
+            [record.task_id for record in reopened.all()], ["c", "a", "b", "e"]
+        )
+        self.assertEqual(reopened.get("a"), make_record("a", 1))
+        reopened.close()
+
+
+class TestPickleStorage(StorageContract, TempStoreTestCase):
+    storage_class = PickleStorage
+
+
+class TestColumnarStorage(StorageContract, TempStoreTestCase):
+    storage_class = ColumnarStorage
+
+    def test_deleted_rows_are_compacted(self):
+        """Rows of deleted tasks are dropped once they outnumber the live ones"""
+        self.storage.put([make_record(str(x), x % 5) for x in range(100)])
+        with mock.patch("columnar_storage.COMPACT_MIN_DELETED", 0):
+            self.storage.delete([str(x) for x in range(99)])
+
+        self.assertLessEqual(len(self.storage.records.ids), 10)
+        self.assertEqual(
+            [record.task_id for record in self.storage.all()],
+            ["c", "a", "b", "d", "99"],
+        )
+        self.assertEqual(
+            [record.task_id for record in self.storage.range_by_eta(limit=3)],
+            ["a", "b", "c"],
+        )
+
+    def test_columns_round_trip(self):
+        """Tasks read back as stored through replacements, deletes and growth"""
+        columns = TaskColumns()
+        expected = {}
+        for number in range(200):
+            record = make_record(f"id {number} \udcff", number % 7)
+            columns[record.task_id] = expected[record.task_id] = record
+        for number in range(0, 200, 3):
+            record = make_record(f"id {number} \udcff", 1, "DONE")
+            record = record._replace(description="x" * (number % 20))
+            columns[record.task_id] = expected[record.task_id] = record
+        for number in range(0, 200, 5):
+            del columns[f"id {number} \udcff"]
+            del expected[f"id {number} \udcff"]
+
+        self.assertEqual(dict(columns), expected)
+        self.assertNotIn("id 0 \udcff", columns)
+        columns.compact()
+        self.assertEqual(list(columns.values()), list(expected.values()))
+
+    def test_copies_are_independent(self):
+        """Changes after a copy do not reach it"""
+        columns = TaskColumns()
+        columns["a"] = make_record("a", 1)
+        copy = columns.copy()
+
+        columns["a"] = make_record("a", 2, "DONE")
+        del columns["a"]
+
+        self.assertEqual(dict(copy), {"a": make_record("a", 1)})
+        self.assertEqual(copy.count_by_status(), {"OPEN": 1})
+
+
+class TestSqliteStorage(StorageContract, TempStoreTestCase):
+    storage_class = SqliteStorage
+
+    def test_databases_without_stamps_are_migrated(self):
+        """Tables created before tasks were stamped get the new columns"""
+        self.storage.close()
+        with sqlite3.connect(settings.TASK_DATABASE_FILE) as connection:
+            connection.executescript(
+                "DROP TABLE tasks; CREATE TABLE tasks (id TEXT PRIMARY KEY, "
+                "description TEXT NOT NULL, eta TEXT NOT NULL, status TEXT NOT NULL);"
+                "INSERT INTO tasks VALUES ('a', 'task a', '2023-06-21T14:00:00', 'OPEN')"
+            )
+        connection.close()
+
+        self.storage = self.open_storage()
+        self.assertEqual(self.storage.get("a"), make_record("a", 1))
+        self.storage.put([make_stamped("b", 1)])
+        self.assertEqual(self.storage.range_by_update(BASE_ETA), [make_stamped("b", 1)])
+
+    def test_database_is_in_wal_mode(self):
+        """The database uses write-ahead logging"""
+        # pylint: disable=protected-access
+        journal_mode = self.storage._connection().execute("PRAGMA journal_mode")
+
+        self.assertEqual(journal_mode.fetchone()[0], "wal")
+
+    def test_refresh_reports_changes_by_other_connections(self):
+        """Changes through another storage on the same database are reported"""
+        changes = []
+        self.storage.change_listener = changes.append
+        other = self.open_storage()
+        self.addCleanup(other.close)
+
+        self.storage.put([make_record("e", 4)])
+        self.storage.refresh()
+        self.assertEqual(changes, [])
+
+        other.delete(["a"])
+        self.storage.refresh()
+        self.storage.put([make_record("f", 4)])
+        self.storage.refresh()
+        self.assertEqual(changes, [None])
+
+        other.put([make_record("g", 4)])
+        self.storage.put([make_record("h", 4)])
+        self.assertEqual(changes, [None, None])
+
+    def test_refresh_during_own_changes_reports_nothing(self):
+        """Threads refreshing while this storage writes never see an external change"""
+        changes = []
+        self.storage.change_listener = changes.append
+        done = threading.Event()
+
+        def refresh():
+            while not done.is_set():
+                self.storage.refresh()
+
+        threads = [threading.Thread(target=refresh) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for number in range(300):
+            self.storage.put([make_record(str(number), 4)])
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(changes, [])
+
+
+class TestTasksWithSqlite(TempStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        backend = mock.patch.object(settings, "STORAGE_BACKEND", "sqlite")
+        backend.start()
+        self.addCleanup(backend.stop)
+
+    def test_task_lifecycle(self):
+        """Tasks works the same on the SQLite backend"""
+        tasks = Tasks()
+        saved = tasks.post_task(self.valid_task)
+        other = tasks.post_task(dict(self.valid_task, eta=BASE_ETA))
+        completed = tasks.complete_task(saved["_id"])
+        tasks.delete_task(other["_id"])
+        tasks.close()
+
+        reloaded = Tasks()
+
+        self.assertEqual(reloaded.get_tasks(), [completed])
+        self.assertEqual(reloaded.get_due_tasks(BASE_ETA), [])
+        self.assertEqual(reloaded.get_tasks(status="OPEN"), [])
+        reloaded.close()
+
+    def test_conditional_puts_do_not_interleave(self):
+        """Of puts conditional on the same version, through any store, one wins"""
+        stores = [Tasks(), Tasks()]
+        for store in stores:
+            self.addCleanup(store.close)
+        task = stores[0].post_task(self.valid_task)
+        updated = []
+        original_get = SqliteStorage.get
+
+        def slow_get(storage, task_id):
+            record = original_get(storage, task_id)
+            time.sleep(0.02)
+            return record
+
+        def put(store):
+            try:
+                updated.append(store.put_task(task["_id"], dict(task), {"1"}))
+            except VersionConflictError:
+                pass
+
+        with mock.patch.object(SqliteStorage, "get", slow_get):
+            threads = [
+                threading.Thread(target=put, args=(stores[x % 2],)) for x in range(6)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([x["version"] for x in updated], [2])
@@ -3,12 +3,25 @@ Main test file for TaskMaster
 """
 import copy
 import pickle
+import sys
+import threading
 from datetime import datetime, timedelta
-from unittest import TestCase
+from unittest import TestCase, mock
 import pytest
-from schema import SchemaMissingKeyError
-from tasks import validate_task, Tasks, InvalidTaskError
+from schema import SchemaError, SchemaMissingKeyError, SchemaWrongKeyError
+from tasks import (
+    TASK_SCHEMA,
+    validate_task,
+    Tasks,
+    InvalidTaskError,
+    InvalidBatchError,
+    TaskRecord,
+    STORE_OPERATION_SECONDS,
+    SAVED_BYTES,
+)
+from snapshot import read_records
 import settings
+from .store_helpers import TempStoreTestCase
 
 
 # pylint: disable=missing-class-docstring
@@ -52,6 +65,274 @@ class TestValidateTask(TestCase):
         with pytest.raises(ValueError):
             validate_task(invalid_status_task)
 
+    def test_non_string_id_is_accepted(self):
+        """_id is converted by the schema rather than type checked"""
+        task_with_id = dict(self.clean_task, _id=5)
+
+        self.assertEqual(validate_task(task_with_id), task_with_id)
+
+    def test_errors_match_schema_errors(self):
+        """Invalid tasks raise the same errors as the task schema"""
+        invalid_tasks = [
+            dict(self.clean_task, colour="BLUE"),
+            dict(self.clean_task, eta="2020-06-20T14:00:00"),
+            dict(self.clean_task, status=None),
+            ["not", "a", "task"],
+        ]
+
+        for invalid_task in invalid_tasks:
+            with pytest.raises(SchemaError) as schema_error:
+                TASK_SCHEMA.validate(invalid_task)
+            with pytest.raises(type(schema_error.value)) as validate_error:
+                validate_task(invalid_task)
+
+            self.assertEqual(str(validate_error.value), str(schema_error.value))
+
+        with pytest.raises(SchemaWrongKeyError):
+            validate_task(invalid_tasks[0])
+
+
+class TestTaskRecord(TempStoreTestCase):
+    def test_records_are_immutable(self):
+        """Stored records cannot be changed in place"""
+        record = TaskRecord.from_dict("a", self.valid_task)
+
+        with pytest.raises(AttributeError):
+            record.status = "DONE"
+
+    def test_callers_do_not_share_task_dicts(self):
+        """Changing input or returned dicts does not change the store"""
+        tasks = Tasks()
+        input_task = copy.deepcopy(self.valid_task)
+        returned_task = tasks.post_task(input_task)
+
+        input_task["description"] = "Changed input"
+        returned_task["description"] = "Changed output"
+
+        assert "_id" not in input_task
+        assert tasks.get_tasks(returned_task["_id"])[0]["description"] == "Shopping"
+
+    def test_records_are_shared_between_reads(self):
+        """Record reads hand out the stored instance instead of copies"""
+        tasks = Tasks()
+        task_id = tasks.post_task(self.valid_task)["_id"]
+
+        first_read = tasks.get_task_records(task_id)[0]
+
+        assert first_read is tasks.get_task_records(task_id)[0]
+
+        tasks.complete_task(task_id)
+
+        assert first_read.status == "OPEN"
+        assert tasks.get_task_records(task_id)[0].status == "DONE"
+
+    def test_dict_snapshots_are_loaded_as_records(self):
+        """Snapshots written before TaskRecord are converted on load"""
+        with open(settings.TASK_DATA_FILE, "wb") as file:
+            pickle.dump({"a": dict(self.valid_task, _id="a")}, file)
+
+        tasks = Tasks()
+
+        self.assertEqual(
+            tasks.get_task_records("a"), [TaskRecord.from_dict("a", self.valid_task)]
+        )
+
+    def test_unstamped_tasks_change_next_to_stamped_ones(self):
+        """Tasks of snapshots without updated_at change after stamped tasks exist"""
+        with open(settings.TASK_DATA_FILE, "wb") as file:
+            pickle.dump({x: dict(self.valid_task, _id=x) for x in "ab"}, file)
+
+        tasks = Tasks()
+        self.addCleanup(tasks.close)
+        posted = tasks.post_task(self.valid_task)
+        completed = tasks.complete_task("a")
+        tasks.delete_task("b")
+
+        self.assertEqual(tasks.get_tasks(), [completed, posted])
+        self.assertEqual(
+            tasks.get_modified_tasks(datetime(2000, 1, 1)), [posted, completed]
+        )
+
+
+class TestClose(TempStoreTestCase):
+    def test_open_stores_are_closed_on_exit(self):
+        """Stores close on exit, stopping their threads, unless closed before"""
+        with mock.patch("atexit.register") as register, mock.patch(
+            "atexit.unregister"
+        ) as unregister:
+            tasks = Tasks()
+            tasks.close()
+
+        register.assert_any_call(tasks.close)
+        unregister.assert_called_once_with(tasks.close)
+
+
+class TestBatchOperations(TempStoreTestCase):
+    def test_post_tasks_creates_and_updates(self):
+        """Tasks with an id are replaced, others created, in one journal record"""
+        tasks = Tasks()
+        existing = tasks.post_task(self.valid_task)
+        existing["description"] = "Cleaning Car"
+
+        saved = tasks.post_tasks([self.valid_task, existing])
+
+        self.assertEqual(
+            saved[1], dict(existing, updated_at=saved[1]["updated_at"], version=2)
+        )
+        self.assertEqual(len(tasks.get_tasks()), 2)
+        journal_records = tasks._storage._journal.record_count  # pylint: disable=W0212
+        self.assertEqual(journal_records, 2)
+        self.assertEqual(Tasks().get_tasks(saved[0]["_id"]), [saved[0]])
+
+    def test_post_tasks_saves_nothing_if_any_task_is_invalid(self):
+        """Every invalid task is reported and no task is saved"""
+        tasks = Tasks()
+        invalid_status = dict(self.valid_task, status="BLUE")
+
+        with pytest.raises(InvalidBatchError) as invalid_batch:
+            tasks.post_tasks([self.valid_task, invalid_status, "not a task"])
+
+        self.assertEqual(
+            [error["index"] for error in invalid_batch.value.errors], [1, 2]
+        )
+        self.assertEqual(tasks.get_tasks(), [])
+
+    def test_complete_and_delete_tasks(self):
+        """Bulk complete and delete report missing ids per item"""
+        tasks = Tasks()
+        first = tasks.post_task(self.valid_task)
+        second = tasks.post_task(self.valid_task)
+
+        completed = tasks.complete_tasks([first["_id"], "missing"])
+        deleted = tasks.delete_tasks([second["_id"], "missing"])
+
+        self.assertEqual(
+            completed[0],
+            dict(
+                first, status="DONE", updated_at=completed[0]["updated_at"], version=2
+            ),
+        )
+        self.assertEqual(completed[1], {"_id": "missing", "error": "task not found"})
+        self.assertEqual(
+            deleted,
+            [
+                {"_id": second["_id"], "deleted": True},
+                {"_id": "missing", "deleted": False},
+            ],
+        )
+        self.assertEqual(Tasks().get_tasks(), [completed[0]])
+
+
+class TestVersions(TempStoreTestCase):
+    def test_changes_bump_versions(self):
+        """The store version follows every change, task versions only their task"""
+        tasks = Tasks()
+        first = tasks.post_task(self.valid_task)
+        second = tasks.post_task(self.valid_task)
+        versions = (
+            tasks.get_version(),
+            tasks.get_task_version(first["_id"]),
+            tasks.get_task_version(second["_id"]),
+        )
+
+        tasks.complete_task(second["_id"])
+        tasks.delete_tasks(["missing"])
+
+        self.assertNotEqual(tasks.get_version(), versions[0])
+        self.assertEqual(tasks.get_task_version(first["_id"]), versions[1])
+        self.assertNotEqual(tasks.get_task_version(second["_id"]), versions[2])
+
+        version = tasks.get_version()
+        tasks.delete_tasks(["missing"])
+        tasks.complete_tasks(["missing"])
+        self.assertEqual(tasks.get_version(), version)
+
+    def test_versions_do_not_repeat_after_reload(self):
+        """A reloaded store starts a new epoch of versions"""
+        tasks = Tasks()
+        version = tasks.get_version()
+
+        tasks.load_tasks()
+
+        self.assertNotEqual(tasks.get_version(), version)
+        self.assertNotEqual(Tasks().get_version(), version)
+
+
+class TestStoreMetrics(TempStoreTestCase):
+    def test_load_and_save_are_measured(self):
+        """Load and save durations and saved bytes are recorded"""
+        loads = STORE_OPERATION_SECONDS.count("load")
+        saved_bytes = SAVED_BYTES.get()
+
+        tasks = Tasks()
+        tasks.post_task(self.valid_task)
+        tasks.save_tasks()
+
+        self.assertEqual(STORE_OPERATION_SECONDS.count("load"), loads + 1)
+        self.assertGreater(SAVED_BYTES.get(), saved_bytes)
+        self.assertEqual(
+            tasks.count_tasks_by_status(), {"OPEN": 1, "DONE": 0, "CANCELLED": 0}
+        )
+
+
+class TestConcurrency(TempStoreTestCase):
+    def test_threads_hammering_tasks(self):
+        """Concurrent reads, changes and saves neither fail nor lose changes"""
+        errors = []
+
+        def hammer(seed):
+            try:
+                for i in range(150):
+                    task = tasks.post_task(dict(self.valid_task))
+                    tasks.get_tasks(status="OPEN")
+                    tasks.get_due_tasks(self.valid_task["eta"], status="DONE")
+                    tasks.get_task_page(50, status="OPEN")
+                    if i % 3 == 0:
+                        tasks.complete_task(task["_id"])
+                    elif i % 3 == 1:
+                        tasks.put_task(
+                            task["_id"], dict(self.valid_task, description=str(seed))
+                        )
+                    else:
+                        tasks.delete_task(task["_id"])
+                    if i % 25 == seed:
+                        tasks.save_tasks()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                errors.append(error)
+
+        # Switching threads often makes races show up within a short test
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        with mock.patch.multiple(
+            settings,
+            PERSISTENCE_MODE="group-commit",
+            FLUSH_INTERVAL=0.001,
+            JOURNAL_COMPACT_THRESHOLD=200,
+        ):
+            tasks = Tasks()
+            threads = [threading.Thread(target=hammer, args=(x,)) for x in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            tasks.close()
+
+            reloaded = Tasks()
+            reloaded.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(tasks.get_tasks()), 8 * 100)
+        self.assertEqual(
+            tasks.count_tasks_by_status(), {"OPEN": 400, "DONE": 400, "CANCELLED": 0}
+        )
+        self.assertEqual(len(tasks.get_due_tasks(self.valid_task["eta"])), 800)
+        self.assertEqual(
+            sorted(map(repr, reloaded.get_task_records())),
+            sorted(map(repr, tasks.get_task_records())),
+        )
+
 
 class TestTaskManagement(TestCase):
     """Tests for task management"""
@@ -69,6 +350,11 @@ class TestTaskManagement(TestCase):
 
         return_task = self.tasks.post_task(self.valid_task)
         expected_task["_id"] = return_task["_id"]
+        expected_task.update(
+            created_at=return_task["created_at"],
+            updated_at=return_task["created_at"],
+            version=1,
+        )
 
         self.assertEqual(expected_task, return_task, "Tasks don't match")
 
@@ -139,6 +425,7 @@ class TestTaskManagement(TestCase):
         self.tasks.put_task(task_id, input_task)
 
         result_task = self.tasks.get_tasks(task_id)[0]
+        input_task.update(updated_at=result_task["updated_at"], version=2)
         self.assertEqual(result_task, input_task, "Tasks don't match")
 
     def test_save_tasks(self):
@@ -146,23 +433,21 @@ class TestTaskManagement(TestCase):
 
         self.tasks.save_tasks()
 
-        with open(settings.TASK_DATA_FILE, "rb") as file:
-            task_list = pickle.load(file)
+        task_list = read_records(settings.TASK_DATA_FILE)
         # pylint: disable=protected-access
-        self.assertEqual(self.tasks._task_list, task_list, "Tasks don't match")
+        self.assertEqual(self.tasks._storage.records, task_list, "Tasks don't match")
 
     def test_load_tasks(self):
         """Test loading tasks"""
 
         self.tasks.save_tasks()
 
-        with open(settings.TASK_DATA_FILE, "rb") as file:
-            task_list = pickle.load(file)
+        task_list = read_records(settings.TASK_DATA_FILE)
 
         self.tasks.load_tasks()
 
         # pylint: disable=protected-access
-        self.assertEqual(self.tasks._task_list, task_list, "Tasks don't match")
+        self.assertEqual(self.tasks._storage.records, task_list, "Tasks don't match")
 
     def test_complete_task(self):
         """Test for complete task"""
@@ -189,11 +474,11 @@ class TestTaskManagement(TestCase):
         assert len(response) == 1
 
         response[0].pop("_id")
-        assert past_task == response[0]
+        assert response[0].items() >= past_task.items()
 
     @classmethod
     def teardown_class(cls):
         """Teardown for tests"""
         # pylint: disable=protected-access
-        cls.tasks._task_list = {}
+        cls.tasks._storage.records = {}
         cls.tasks.save_tasks()